@@ -0,0 +1,227 @@
+import os
+import re
+import json
+import time
+import logging
+import socket
+from collections import deque
+from common.variables import *
+from common.utils import is_channel
+from errors import AttachmentError
+
+# Инициализация логирования сервера.
+logger = logging.getLogger('server')
+
+# Имя вложения (new_attachment_id): 32 шестнадцатеричных символа.
+_ATTACHMENT_ID = re.compile(r'[0-9a-f]{32}')
+
+
+# Ограничение неотправленных данных в буфере сокета при скачивании: ядро не принимает больше
+# ATTACHMENT_NOTSENT_LOWAT байт сверх уже отправленного, поэтому сообщения чата, поставленные после куска файла,
+# не ждут в ядре за мегабайтами файла. Где TCP_NOTSENT_LOWAT нет, буфер не ограничивается.
+def limit_unsent(sock):
+    if sock is None or not hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, ATTACHMENT_NOTSENT_LOWAT)
+    except OSError:
+        pass
+
+
+# Сообщение получателю о загруженном файле, доставляется как обычное сообщение (в том числе в канал
+# и пользователю не в сети).
+def attachment_message(meta):
+    return {ACTION: MESSAGE, SENDER: meta[SENDER], DESTINATION: meta[DESTINATION], TIME: time.time(),
+            MESSAGE_TEXT: f'Файл {meta[FILE_NAME]} ({meta[SIZE]} байт), вложение {meta[ATTACHMENT]}',
+            ATTACHMENT: meta[ATTACHMENT], FILE_NAME: meta[FILE_NAME], SIZE: meta[SIZE]}
+
+
+# Загружаемый файл: открытый дескриптор недокачанного файла, заявленный размер и сколько уже принято.
+class Upload:
+    __slots__ = ('id', 'fd', 'size', 'received', 'meta')
+
+    def __init__(self, attachment_id, fd, meta):
+        self.id = attachment_id
+        self.fd = fd
+        self.size = meta[SIZE]
+        self.received = 0
+        self.meta = meta
+
+
+# Скачиваемый файл: дескриптор и смещение следующего куска.
+class Download:
+    __slots__ = ('id', 'fd', 'size', 'offset')
+
+    def __init__(self, attachment_id, fd, size, offset):
+        self.id = attachment_id
+        self.fd = fd
+        self.size = size
+        self.offset = offset
+
+
+# Ожидание кадра данных куска, который нужно отбросить (кусок неизвестной или прерванной загрузки).
+DISCARD = object()
+
+
+# Хранилище вложений: каталог с файлами, у каждого файла - описание <имя>.json (отправитель, получатель,
+# имя и размер). Загрузка пишет куски сразу в файл <имя>.part, файл целиком в памяти не собирается;
+# после последнего куска он переименовывается, и получателю отправляется сообщение о вложении. Скачивание
+# отдаёт файл кусками, сервер отправляет их из файла напрямую в сокет (sendfile или срезы mmap).
+# Каталог может быть общим для нескольких рабочих процессов сервера.
+# downloading - подключения, которым сейчас отправляются файлы (как replaying у OfflineStore).
+class AttachmentSpool:
+    def __init__(self, directory, max_size=ATTACHMENT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.downloading = set()
+        os.makedirs(directory, exist_ok=True)
+        self.prune()
+
+    def path(self, attachment_id, suffix=''):
+        return os.path.join(self.directory, attachment_id + suffix)
+
+    # Удаление недокачанных файлов старше ATTACHMENT_PART_TTL: их загрузку прервал перезапуск сервера.
+    def prune(self):
+        deadline = time.time() - ATTACHMENT_PART_TTL
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.part') and entry.stat().st_mtime < deadline:
+                os.unlink(entry.path)
+
+    # Начало загрузки файла (сообщение upload): имя вложения, получатель, имя и размер файла.
+    def upload(self, client, message):
+        attachment_id = message.get(ATTACHMENT)
+        if not isinstance(attachment_id, str) or not _ATTACHMENT_ID.fullmatch(attachment_id):
+            raise AttachmentError(attachment_id, 'Некорректное имя вложения.')
+        size, file_name, destination = message.get(SIZE), message.get(FILE_NAME), message.get(DESTINATION)
+        if not isinstance(size, int) or not 0 < size <= self.max_size:
+            raise AttachmentError(attachment_id, f'Размер файла должен быть от 1 до {self.max_size} байт.')
+        if not isinstance(file_name, str) or not file_name or not isinstance(destination, str) or not destination:
+            raise AttachmentError(attachment_id, 'Не указаны имя файла или получатель.')
+        if is_channel(destination) and destination not in (client.channels or ()):
+            raise AttachmentError(attachment_id, 'Пользователь не состоит в канале.')
+        if client.uploads is None:
+            client.uploads = dict()
+        if len(client.uploads) >= ATTACHMENT_MAX_UPLOADS:
+            raise AttachmentError(attachment_id, 'Слишком много одновременных загрузок.')
+        try:
+            fd = os.open(self.path(attachment_id, '.part'), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            raise AttachmentError(attachment_id, 'Вложение с таким именем уже существует.')
+        except OSError as err:
+            logger.error('Не удалось создать файл вложения %s: %s', attachment_id, err)
+            raise AttachmentError(attachment_id, 'Не удалось сохранить файл.')
+        client.uploads[attachment_id] = Upload(attachment_id, fd, {
+            ATTACHMENT: attachment_id, SENDER: client.account, DESTINATION: destination,
+            FILE_NAME: os.path.basename(file_name)[:255] or attachment_id, SIZE: size, TIME: time.time()})
+        logger.info('Пользователь %s загружает файл %s (%s байт) для %s.', client.account, file_name, size,
+                    destination)
+
+    # Заголовок куска загрузки (сообщение chunk): следующий кадр подключения - данные куска. Кадр принимается
+    # и для неизвестной загрузки, чтобы не принять данные за сообщение.
+    def chunk(self, client, message):
+        upload = (client.uploads or {}).get(message.get(ATTACHMENT))
+        if upload is None or message.get(OFFSET) != upload.received:
+            client.receiving = DISCARD
+            if upload is not None:
+                self.abort(client, upload)
+            raise AttachmentError(message.get(ATTACHMENT), 'Нет такой загрузки или кусок не по порядку.')
+        client.receiving = upload
+
+    # Данные куска. Возвращает описание вложения, если файл принят целиком.
+    def write(self, client, data):
+        upload = client.receiving
+        client.receiving = None
+        if upload is DISCARD or upload.fd is None:
+            return None
+        if upload.received + len(data) > upload.size:
+            self.abort(client, upload)
+            raise AttachmentError(upload.id, 'Принято больше данных, чем заявлено.')
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(upload.fd, view):]
+        except OSError as err:
+            logger.error('Не удалось записать файл вложения %s: %s', upload.id, err)
+            self.abort(client, upload)
+            raise AttachmentError(upload.id, 'Не удалось сохранить файл.')
+        upload.received += len(data)
+        if upload.received < upload.size:
+            return None
+        return self.finish(client, upload)
+
+    # Файл принят: сначала записывается описание, затем файл переименовывается - скачивание видит только
+    # целиком принятые файлы.
+    def finish(self, client, upload):
+        del client.uploads[upload.id]
+        os.close(upload.fd)
+        upload.fd = None
+        try:
+            with open(self.path(upload.id, '.json.part'), 'w', encoding=ENCODING) as file:
+                json.dump(upload.meta, file)
+            os.replace(self.path(upload.id, '.json.part'), self.path(upload.id, '.json'))
+            os.replace(self.path(upload.id, '.part'), self.path(upload.id))
+        except OSError as err:
+            logger.error('Не удалось сохранить файл вложения %s: %s', upload.id, err)
+            raise AttachmentError(upload.id, 'Не удалось сохранить файл.')
+        logger.info('Пользователь %s загрузил файл %s.', client.account, upload.id)
+        return upload.meta
+
+    def abort(self, client, upload):
+        client.uploads.pop(upload.id, None)
+        if upload.fd is not None:
+            os.close(upload.fd)
+            upload.fd = None
+        try:
+            os.unlink(self.path(upload.id, '.part'))
+        except OSError:
+            pass
+
+    # Запрос скачивания (сообщение download). Скачивать могут отправитель, получатель и участники канала-получателя.
+    # Возвращает описание вложения для ответа, файл ставится в очередь скачиваний подключения.
+    def download(self, client, message):
+        attachment_id = message.get(ATTACHMENT)
+        offset = message.get(OFFSET) or 0
+        if not isinstance(attachment_id, str) or not _ATTACHMENT_ID.fullmatch(attachment_id):
+            raise AttachmentError(attachment_id, 'Некорректное имя вложения.')
+        try:
+            with open(self.path(attachment_id, '.json'), encoding=ENCODING) as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            raise AttachmentError(attachment_id, 'Вложение не найдено.')
+        if client.account not in (meta[SENDER], meta[DESTINATION]) and meta[DESTINATION] not in (client.channels or ()):
+            raise AttachmentError(attachment_id, 'Вложение не найдено.')
+        if not isinstance(offset, int) or not 0 <= offset < meta[SIZE]:
+            raise AttachmentError(attachment_id, 'Некорректное смещение.')
+        try:
+            fd = os.open(self.path(attachment_id), os.O_RDONLY)
+        except OSError:
+            raise AttachmentError(attachment_id, 'Вложение не найдено.')
+        if client.downloads is None:
+            client.downloads = deque()
+        client.downloads.append(Download(attachment_id, fd, meta[SIZE], offset))
+        self.downloading.add(client)
+        logger.info('Пользователь %s скачивает файл %s.', client.account, attachment_id)
+        return meta
+
+    # Следующий кусок текущего скачивания подключения: (скачивание, смещение, длина, заголовок куска).
+    # Законченные скачивания закрываются, None - скачивать больше нечего.
+    def next_chunk(self, client):
+        while client.downloads:
+            download = client.downloads[0]
+            if download.offset < download.size:
+                offset = download.offset
+                count = min(ATTACHMENT_CHUNK_SIZE, download.size - offset)
+                download.offset += count
+                return download, offset, count, {ACTION: CHUNK, ATTACHMENT: download.id, OFFSET: offset, SIZE: count}
+            os.close(client.downloads.popleft().fd)
+        self.downloading.discard(client)
+        return None
+
+    # Отключение клиента: незаконченные загрузки удаляются, скачивания закрываются.
+    def release(self, client):
+        for upload in list((client.uploads or {}).values()):
+            self.abort(client, upload)
+        while client.downloads:
+            os.close(client.downloads.popleft().fd)
+        self.downloading.discard(client)
+        client.receiving = None
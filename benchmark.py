@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import logging
+import socket
+import asyncio
+import argparse
+import subprocess
+from common.variables import *
+from common.utils import run_event_loop
+from client_async import ClientPool
+
+# Нагрузочный тест сервера. Для каждого сочетания числа подключений и размера сообщения запускается отдельный
+# сервер, N имитируемых пользователей регистрируются обычным PRESENCE и по кругу отправляют друг другу MESSAGE
+# (пользователь i - пользователю i+1) с заданной скоростью. В текст сообщения записывается время отправки,
+# задержка считается при получении. Результаты: пропускная способность, перцентили и гистограмма задержек,
+# память сервера на подключение и загрузка процессора сервера. Итог выводится в JSON для сравнения режимов.
+#
+# Нагрузка создаётся одним процессом на asyncio, при больших скоростях предел может быть на его стороне:
+# сравнивайте server_cpu_percent с 100%.
+#
+# Пример: python benchmark.py --clients 100,1000 --sizes 32,1024 --messages 20000 -o result.json -- --mode asyncio
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+# Процесс сервера и все его потомки (рабочие процессы в режиме --workers).
+def process_tree(pid):
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f'/proc/{current}/task/{current}/children') as file:
+                pids.extend(int(child) for child in file.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+# Резидентная память (байт) и процессорное время (секунд) процесса сервера вместе с потомками, по данным /proc.
+def process_usage(pid):
+    rss = cpu = 0
+    for current in process_tree(pid):
+        try:
+            with open(f'/proc/{current}/statm') as file:
+                rss += int(file.read().split()[1]) * PAGE_SIZE
+            with open(f'/proc/{current}/stat') as file:
+                fields = file.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        except (OSError, IndexError, ValueError):
+            pass
+    return rss, cpu
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+# Гистограмма задержек: верхняя граница корзины в микросекундах (степени двойки) - число сообщений.
+def histogram(values):
+    buckets = {}
+    for value in values:
+        bound = 1
+        while bound < value * 1e6:
+            bound *= 2
+        buckets[bound] = buckets.get(bound, 0) + 1
+    return dict(sorted(buckets.items()))
+
+
+# Запуск сервера и ожидание готовности порта.
+def start_server(port, server_args):
+    # ограничения нагрузки выключены: все имитируемые пользователи подключаются с одного адреса
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, '-p', str(port), '--log-level', 'WARNING',
+                                '--offline-db', '', '--history-db', '', '--attachment-dir', '', '--contacts-db', '',
+                                '--rate-limit', '0', '--ip-rate-limit', '0', '--ip-accept-rate', '0',
+                                '--ip-max-connections', '0']
+                               + server_args,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Сервер завершился с кодом {process.returncode}')
+        try:
+            socket.create_connection((DEFAULT_IP_ADDRESS, port), timeout=1).close()
+            # в режиме нескольких процессов подключение мог принять ещё не весь набор рабочих процессов
+            time.sleep(0.2)
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('Сервер не начал принимать подключения')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+# Один прогон на запущенном сервере: clients пользователей, messages сообщений размером size байт, rate сообщений
+# в секунду (0 - без ограничения). Память сервера замеряется до и после подключения пользователей, процессорное
+# время - на время отправки и доставки.
+async def run_load(port, server_pid, clients, size, messages, rate, timeout, compressions=(), multiplex=0):
+    latencies = []
+    done = asyncio.Event()
+
+    def on_message(client, message):
+        sent = int(message[MESSAGE_TEXT].split(' ', 1)[0])
+        latencies.append((time.perf_counter_ns() - sent) / 1e9)
+        if len(latencies) >= messages:
+            done.set()
+
+    rss_idle, _ = process_usage(server_pid)
+    pool = ClientPool(DEFAULT_IP_ADDRESS, port, on_message, compressions=compressions, multiplex=multiplex)
+    names = [f'bench{i}' for i in range(clients)]
+    started = time.perf_counter()
+    errors = await pool.connect(names)
+    connect_time = time.perf_counter() - started
+    if errors:
+        await pool.close()
+        raise RuntimeError(f'Не удалось подключить {len(errors)} пользователей: {next(iter(errors.values()))!r}')
+    rss_connected, cpu_before = process_usage(server_pid)
+
+    padding = 'x' * max(0, size - 20)
+    # отправка пачками раз в 10 мс, чтобы выдерживать заданную скорость без таймера на каждое сообщение
+    batch = max(1, int(rate / 100)) if rate else 1000
+    started = time.perf_counter()
+    for sent in range(0, messages, batch):
+        for i in range(sent, min(sent + batch, messages)):
+            sender = i % clients
+            pool.send(names[sender], names[(sender + 1) % clients], f'{time.perf_counter_ns()} {padding}')
+        await pool.drain()
+        if rate:
+            delay = started + (sent + batch) / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+    _, cpu_after = process_usage(server_pid)
+    await pool.close()
+
+    latencies.sort()
+    return {
+        'clients': clients,
+        'size': size,
+        'rate': rate,
+        'sent': messages,
+        'delivered': len(latencies),
+        'elapsed': round(elapsed, 4),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'connect_time': round(connect_time, 4),
+        'latency': {f'p{p:g}': percentile(latencies, p) for p in PERCENTILES},
+        'latency_max': latencies[-1] if latencies else None,
+        'latency_histogram_us': histogram(latencies),
+        'rss_idle': rss_idle,
+        'rss_per_connection': round((rss_connected - rss_idle) / clients),
+        'server_cpu': round(cpu_after - cpu_before, 3),
+        'server_cpu_percent': round((cpu_after - cpu_before) / elapsed * 100, 1),
+    }
+
+
+def run_case(port, server_args, clients, size, messages, rate, timeout, compressions=(), multiplex=0):
+    server = start_server(port, server_args)
+    try:
+        return run_event_loop(run_load(port, server.pid, clients, size, messages, rate, timeout, compressions,
+                                       multiplex))
+    finally:
+        stop_server(server)
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест сервера мессенджера.')
+    parser.add_argument('--clients', default=[100], type=int_list, help='число подключений, через запятую')
+    parser.add_argument('--sizes', default=[64], type=int_list, help='размер сообщения в байтах, через запятую')
+    parser.add_argument('--messages', default=10000, type=int, help='сообщений в одном прогоне')
+    parser.add_argument('--rate', default=0, type=int, help='сообщений в секунду, 0 - без ограничения')
+    parser.add_argument('--timeout', default=30, type=float, help='ожидание доставки после отправки, секунд')
+    parser.add_argument('--compression', default='', help='схемы сжатия пользователей, через запятую')
+    parser.add_argument('--multiplex', default=0, type=int,
+                        help='пользователей в одном мультиплексированном подключении, 0 - подключение на пользователя')
+    parser.add_argument('--port', default=17777, type=int)
+    parser.add_argument('-o', '--output', default=None, help='файл для результатов в JSON, по умолчанию stdout')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='параметры сервера после --, например -- --mode asyncio')
+    namespace = parser.parse_args(sys.argv[1:])
+    if namespace.server_args[:1] == ['--']:
+        namespace.server_args = namespace.server_args[1:]
+    return namespace
+
+
+def main():
+    namespace = arg_parser()
+    # журналы клиента и сервера в этом процессе только замедляют отправку
+    for name in ('client', 'server'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    results = []
+    for clients in namespace.clients:
+        for size in namespace.sizes:
+            result = run_case(namespace.port, namespace.server_args, clients, size, namespace.messages,
+                              namespace.rate, namespace.timeout, namespace.compression.split(',') if
+                              namespace.compression else [], namespace.multiplex)
+            result['server_args'] = namespace.server_args
+            result['compression'] = namespace.compression
+            result['multiplex'] = namespace.multiplex
+            results.append(result)
+            print(f'clients={clients} size={size}: {result["throughput"]} msg/s, '
+                  f'p50={result["latency"]["p50"]} p99={result["latency"]["p99"]} '
+                  f'p99.9={result["latency"]["p99.9"]}, {result["rss_per_connection"]} B/conn, '
+                  f'cpu {result["server_cpu_percent"]}%, delivered {result["delivered"]}/{result["sent"]}',
+                  file=sys.stderr)
+    output = json.dumps(results, indent=2)
+    if namespace.output:
+        with open(namespace.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import os
 import sys
 import json
 import socket
@@ -9,11 +10,22 @@ import logs.config_client_log
 from common.variables import *
 from common.utils import *
 from errors import IncorrectDataRecivedError, ReqFieldMissingError, ServerError
-from decos import log
+from decos import log, set_logging_level
 
 # Инициализация клиентского логера
 logger = logging.getLogger('client')
 
+# Сокет используют два потока: поток приёма отвечает на проверку связи, поток пользователя отправляет сообщения
+# и куски файлов. Любая отправка в сокет после запуска потоков идёт под этой блокировкой (send_shared),
+# чтобы кадры разных потоков не перемешались.
+send_lock = threading.Lock()
+
+
+# Отправка сообщения в сокет, общий для потоков приёма и пользователя.
+def send_shared(sock, message, stream):
+    with send_lock:
+        send_message(sock, message, stream)
+
 
 # Функция создаёт словарь с сообщением о выходе.
 @log
@@ -25,41 +37,258 @@ def create_exit_message(account_name):
     }
 
 
+# Функция создаёт словарь с запросом на вход в канал (JOIN) или выход из него (LEAVE).
+@log
+def create_channel_message(action, account_name, room):
+    return {
+        ACTION: action,
+        TIME: time.time(),
+        ACCOUNT_NAME: account_name,
+        ROOM: room
+    }
+
+
+# Функция создаёт запрос поиска по истории сообщений: слова запроса, интервал времени since - until
+# (необязательно), before - номер сообщения, с которого продолжить (следующая страница), limit - размер страницы.
+@log
+def create_search_message(account_name, query, since=None, until=None, before=None, limit=None):
+    out = {
+        ACTION: SEARCH,
+        TIME: time.time(),
+        ACCOUNT_NAME: account_name,
+        QUERY: query
+    }
+    for key, value in ((SINCE, since), (UNTIL, until), (BEFORE, before), (LIMIT, limit)):
+        if value:
+            out[key] = value
+    return out
+
+
+# Функция проверяет, что сообщение с сервера - результаты поиска по истории.
+def is_search_results(message):
+    return message.get(RESPONSE) == 200 and RESULTS in message
+
+
+# Вывод результатов поиска пользователю, от новых сообщений к старым.
+def print_search_results(message):
+    results = message[RESULTS]
+    print(f'\nНайдено сообщений: {len(results)}')
+    for item in results:
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(item[TIME]))
+        print(f'[{item[MESSAGE_ID]}] {when} {item[SENDER]} -> {item[DESTINATION]}: {item[MESSAGE_TEXT]}')
+    if results:
+        print(f'Следующая страница: search с продолжением от номера {results[-1][MESSAGE_ID]}')
+
+
+# Функция создаёт запрос к списку контактов: добавление (ADD_CONTACT) или удаление (DEL_CONTACT) контакта contact,
+# запрос всего списка (GET_CONTACTS).
+@log
+def create_contact_message(action, account_name, contact=None):
+    out = {
+        ACTION: action,
+        TIME: time.time(),
+        ACCOUNT_NAME: account_name
+    }
+    if contact is not None:
+        out[CONTACT] = contact
+    return out
+
+
+# Функция проверяет, что сообщение с сервера - список контактов с их присутствием (ответ на GET_CONTACTS).
+def is_contacts(message):
+    return message.get(RESPONSE) == 202 and isinstance(message.get(CONTACTS), dict)
+
+
+# Функция проверяет, что сообщение с сервера - изменение присутствия контактов.
+def is_status(message):
+    return message.get(ACTION) == STATUS and isinstance(message.get(CONTACTS), dict)
+
+
+# Вывод присутствия контактов пользователю.
+def print_contacts(contacts):
+    for contact, online in sorted(contacts.items()):
+        print(f'{contact} - {"в сети" if online else "не в сети"}')
+
+
+# Функция создаёт сообщение о начале загрузки файла для получателя to (пользователя или канала).
+@log
+def create_upload_message(account_name, to, attachment_id, file_name, size):
+    return {
+        ACTION: UPLOAD,
+        TIME: time.time(),
+        SENDER: account_name,
+        DESTINATION: to,
+        ATTACHMENT: attachment_id,
+        FILE_NAME: file_name,
+        SIZE: size
+    }
+
+
+# Функция создаёт заголовок куска файла, следующий за ним кадр - данные куска.
+def create_chunk_message(attachment_id, offset):
+    return {
+        ACTION: CHUNK,
+        ATTACHMENT: attachment_id,
+        OFFSET: offset
+    }
+
+
+# Функция создаёт запрос скачивания вложения, offset - с какого байта (для продолжения прерванного скачивания).
+@log
+def create_download_message(account_name, attachment_id, offset=0):
+    out = {
+        ACTION: DOWNLOAD,
+        TIME: time.time(),
+        ACCOUNT_NAME: account_name,
+        ATTACHMENT: attachment_id
+    }
+    if offset:
+        out[OFFSET] = offset
+    return out
+
+
+# Функция проверяет, что сообщение с сервера - заголовок куска скачиваемого файла.
+def is_chunk(message):
+    return message.get(ACTION) == CHUNK and ATTACHMENT in message and OFFSET in message
+
+
+# Путь для скачиваемого файла: от имени файла из ответа сервера берётся только последняя часть, перед ней -
+# начало имени вложения, чтобы файлы с одинаковыми именами не перезаписывали друг друга.
+def download_path(message, directory=DOWNLOAD_DIR):
+    name = os.path.basename(str(message.get(FILE_NAME) or '').replace('\\', '/')) or 'file'
+    return os.path.join(directory, f'{message[ATTACHMENT][:8]}_{name}')
+
+
+# Функция создаёт ответ на проверку связи сервером.
+def create_pong_message():
+    return {
+        ACTION: PONG,
+        TIME: time.time()
+    }
+
+
+# Функция проверяет, что сообщение с сервера - проверка связи (PING), на него нужно ответить PONG.
+def is_ping(message):
+    return message.get(ACTION) == PING
+
+
+# Функция проверяет, что сообщение с сервера - ответ 429: клиент отправляет сообщения слишком часто,
+# сервер временно не читает его данные.
+def is_rate_limited(message):
+    return message.get(RESPONSE) == 429
+
+
+# Функция проверяет, что сообщение с сервера - корректное сообщение для этого пользователя или его канала.
+def is_user_message(message, my_username):
+    return ACTION in message and message[ACTION] == MESSAGE and SENDER in message and DESTINATION in message \
+        and MESSAGE_TEXT in message and (message[DESTINATION] == my_username or is_channel(message[DESTINATION]))
+
+
+# Отправитель принятого сообщения для вывода пользователю, для сообщений канала - с именем канала.
+def message_source(message):
+    if is_channel(message[DESTINATION]):
+        return f'{message[SENDER]} в канале {message[DESTINATION]}'
+    return message[SENDER]
+
+
 @log
 # Функция - обработчик сообщений других пользователей, поступающих с сервера.
-def message_from_server(sock, my_username):
+# Скачиваемые файлы записываются в каталог DOWNLOAD_DIR, downloads - открытые файлы по имени вложения.
+def message_from_server(sock, my_username, stream=None):
+    downloads = {}
     while True:
         try:
-            message = get_message(sock)
-            if ACTION in message and message[ACTION] == MESSAGE and SENDER in message and DESTINATION in message \
-                    and MESSAGE_TEXT in message and message[DESTINATION] == my_username:
-                print(f'\nПолучено сообщение от пользователя {message[SENDER]}:\n{message[MESSAGE_TEXT]}')
-                logger.info(f'Получено сообщение от пользователя {message[SENDER]}:\n{message[MESSAGE_TEXT]}')
+            message = get_message(sock, stream)
+            if is_ping(message):
+                send_shared(sock, create_pong_message(), stream)
+            elif is_chunk(message):
+                receive_chunk(downloads, message, get_frame(sock, stream))
+            elif is_rate_limited(message):
+                logger.warning('Сервер ограничил частоту отправки: %s', message.get(ERROR))
+            elif is_search_results(message):
+                print_search_results(message)
+            elif is_contacts(message):
+                print(f'\nКонтактов: {len(message[CONTACTS])}')
+                print_contacts(message[CONTACTS])
+            elif is_status(message):
+                print()
+                print_contacts(message[CONTACTS])
+            elif message.get(RESPONSE) == 400:
+                print(f'\nСервер вернул ошибку: {message.get(ERROR)}')
+                if message.get(ATTACHMENT) in downloads:
+                    downloads.pop(message[ATTACHMENT])[0].close()
+            elif message.get(RESPONSE) == 200 and FILE_NAME in message:
+                os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+                downloads[message[ATTACHMENT]] = (open(download_path(message), 'wb'), message[SIZE])
+            elif message.get(RESPONSE) == 200 and ATTACHMENT in message:
+                print(f'\nФайл загружен на сервер, вложение {message[ATTACHMENT]}')
+            elif is_user_message(message, my_username):
+                print(f'\nПолучено сообщение от пользователя {message_source(message)}:\n{message[MESSAGE_TEXT]}')
+                logger.info('Получено сообщение от пользователя %s:\n%s', message_source(message),
+                            message[MESSAGE_TEXT])
+                if ATTACHMENT in message:
+                    print('Скачать файл: download')
             else:
-                logger.error(f'Получено некорректное сообщение с сервера: {message}')
+                logger.error('Получено некорректное сообщение с сервера: %s', message)
         except IncorrectDataRecivedError:
-            logger.error(f'Не удалось декодировать полученное сообщение.')
+            logger.error('Не удалось декодировать полученное сообщение.')
         except (OSError, ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError):
-            logger.critical(f'Потеряно соединение с сервером.')
+            logger.critical('Потеряно соединение с сервером.')
             break
 
 
+# Запись принятого куска скачиваемого файла. downloads - имя вложения: (файл, размер), после последнего куска
+# файл закрывается.
+def receive_chunk(downloads, message, data):
+    if message[ATTACHMENT] not in downloads:
+        logger.error('Получен кусок неизвестного вложения %s.', message[ATTACHMENT])
+        return
+    file, size = downloads[message[ATTACHMENT]]
+    file.seek(message[OFFSET])
+    file.write(data)
+    if message[OFFSET] + len(data) >= size:
+        del downloads[message[ATTACHMENT]]
+        file.close()
+        print(f'\nФайл сохранён: {file.name}')
+        logger.info('Скачан файл %s.', file.name)
+
+
+# Функция загружает файл на сервер: сообщение upload, затем куски - заголовок chunk и кадр с данными,
+# данные куска передаются из файла в сокет вызовом sendfile. Ответ сервера принимает поток приёма сообщений.
+def upload_file(sock, account_name, path, to, stream):
+    size = os.path.getsize(path)
+    attachment_id = new_attachment_id()
+    with open(path, 'rb') as file:
+        send_shared(sock, create_upload_message(account_name, to, attachment_id, os.path.basename(path), size),
+                    stream)
+        for offset in range(0, size, ATTACHMENT_CHUNK_SIZE):
+            count = min(ATTACHMENT_CHUNK_SIZE, size - offset)
+            with send_lock:
+                sock.sendall(stream.encode(create_chunk_message(attachment_id, offset)) + FRAME_HEADER.pack(count))
+                sock.sendfile(file, offset, count)
+    return attachment_id
+
 @log
-# Функция запрашивает кому отправить сообщение и само сообщение, и отправляет полученные данные на сервер.
-def create_message(sock, account_name='Guest'):
-    to = input('Введите получателя сообщения: ')
-    message = input('Введите сообщение для отправки: ')
-    message_dict = {
+def create_text_message(account_name, to, text):
+    return {
         ACTION: MESSAGE,
         SENDER: account_name,
         DESTINATION: to,
         TIME: time.time(),
-        MESSAGE_TEXT: message
+        MESSAGE_TEXT: text
     }
-    logger.debug(f'Сформирован словарь сообщения: {message_dict}')
+
+
+@log
+# Функция запрашивает кому отправить сообщение и само сообщение, и отправляет полученные данные на сервер.
+def create_message(sock, account_name='Guest', stream=None):
+    to = input('Введите получателя сообщения: ')
+    message = input('Введите сообщение для отправки: ')
+    message_dict = create_text_message(account_name, to, message)
+    logger.debug('Сформирован словарь сообщения: %s', message_dict)
     try:
-        send_message(sock, message_dict)
-        logger.info(f'Отправлено сообщение для пользователя {to}')
+        send_shared(sock, message_dict, stream)
+        logger.info('Отправлено сообщение для пользователя %s', to)
     except:
         logger.critical('Потеряно соединение с сервером.')
         exit(1)
@@ -67,16 +296,59 @@ def create_message(sock, account_name='Guest'):
 
 @log
 # Функция взаимодействия с пользователем, запрашивает команды, отправляет сообщения
-def user_interactive(sock, username):
+def user_interactive(sock, username, stream=None):
     print_help()
     while True:
         command = input('Введите команду: ')
         if command == 'message':
-            create_message(sock, username)
+            create_message(sock, username, stream)
+        elif command in (JOIN, LEAVE):
+            room = input('Введите имя канала (начинается с #): ')
+            try:
+                send_shared(sock, create_channel_message(command, username, room), stream)
+            except OSError:
+                logger.critical('Потеряно соединение с сервером.')
+                exit(1)
+        elif command == 'search':
+            query = input('Введите слова для поиска: ')
+            before = input('Продолжить от номера сообщения (Enter - с последних): ')
+            try:
+                send_shared(sock, create_search_message(username, query, before=int(before or 0)), stream)
+            except ValueError:
+                print('Номер сообщения должен быть числом.')
+            except OSError:
+                logger.critical('Потеряно соединение с сервером.')
+                exit(1)
+        elif command in ('contacts', ADD_CONTACT, DEL_CONTACT):
+            contact = input('Введите имя контакта: ') if command != 'contacts' else None
+            try:
+                send_shared(sock, create_contact_message(GET_CONTACTS if contact is None else command, username,
+                                                         contact), stream)
+            except OSError:
+                logger.critical('Потеряно соединение с сервером.')
+                exit(1)
+        elif command == 'upload':
+            path = input('Введите путь к файлу: ')
+            to = input('Введите получателя файла: ')
+            try:
+                attachment_id = upload_file(sock, username, path, to, stream)
+                logger.info('Файл %s отправлен на сервер, вложение %s', path, attachment_id)
+            except FileNotFoundError:
+                print('Файл не найден.')
+            except OSError:
+                logger.critical('Потеряно соединение с сервером.')
+                exit(1)
+        elif command == 'download':
+            attachment_id = input('Введите имя вложения: ')
+            try:
+                send_shared(sock, create_download_message(username, attachment_id), stream)
+            except OSError:
+                logger.critical('Потеряно соединение с сервером.')
+                exit(1)
         elif command == 'help':
             print_help()
         elif command == 'exit':
-            send_message(sock, create_exit_message(username))
+            send_shared(sock, create_exit_message(username), stream)
             print('Завершение соединения.')
             logger.info('Завершение работы по команде пользователя.')
             # Задержка неоходима, чтобы успело уйти сообщение о выходе
@@ -86,9 +358,10 @@ def user_interactive(sock, username):
             print('Команда не распознана, попробойте снова. help - вывести поддерживаемые команды.')
 
 
-# Функция генерирует запрос о присутствии клиента
+# Функция генерирует запрос о присутствии клиента, при необходимости запрашивает формат кадров и предлагает кодеки
+# и схемы сжатия, multiplex - запрос мультиплексированного подключения для нескольких пользователей
 @log
-def create_presence(account_name):
+def create_presence(account_name, framing=None, codecs=None, compressions=None, multiplex=False):
     out = {
         ACTION: PRESENCE,
         TIME: time.time(),
@@ -96,7 +369,15 @@ def create_presence(account_name):
             ACCOUNT_NAME: account_name
         }
     }
-    logger.debug(f'Сформировано {PRESENCE} сообщение для пользователя {account_name}')
+    if framing:
+        out[FRAMING] = framing
+    if codecs:
+        out[CODECS_OFFER] = list(codecs)
+    if compressions:
+        out[COMPRESSIONS_OFFER] = list(compressions)
+    if multiplex:
+        out[MULTIPLEX] = True
+    logger.debug('Сформировано %s сообщение для пользователя %s', PRESENCE, account_name)
     return out
 
 
@@ -104,6 +385,10 @@ def create_presence(account_name):
 def print_help():
     print('Поддерживаемые команды:')
     print('message - отправить сообщение. Кому и текст будет запрошены отдельно.')
+    print('join - войти в канал, leave - выйти из канала. Сообщение в канал: message с получателем #канал.')
+    print('search - поиск по истории своих сообщений и сообщений своих каналов.')
+    print('contacts - список контактов, add_contact и del_contact - добавить и удалить контакт.')
+    print('upload - отправить файл пользователю или в канал, download - скачать файл по имени вложения.')
     print('help - вывести подсказки по командам')
     print('exit - выход из программы')
 
@@ -112,12 +397,12 @@ def print_help():
 # ошибке.
 @log
 def process_response_ans(message):
-    logger.debug(f'Разбор приветственного сообщения от сервера: {message}')
+    logger.debug('Разбор приветственного сообщения от сервера: %s', message)
     if RESPONSE in message:
         if message[RESPONSE] == 200:
             return '200 : OK'
-        elif message[RESPONSE] == 400:
-            raise ServerError(f'400 : {message[ERROR]}')
+        elif message[RESPONSE] in (400, 429):
+            raise ServerError(f'{message[RESPONSE]} : {message[ERROR]}')
     raise ReqFieldMissingError(RESPONSE)
 
 
@@ -128,63 +413,100 @@ def arg_parser():
     parser.add_argument('addr', default=DEFAULT_IP_ADDRESS, nargs='?')
     parser.add_argument('port', default=DEFAULT_PORT, type=int, nargs='?')
     parser.add_argument('-n', '--name', default=None, nargs='?')
+    parser.add_argument('--async', dest='async_mode', action='store_true')
+    parser.add_argument('--log-level', default=None, choices=LOGGING_LEVELS)
+    parser.add_argument('--no-compression', action='store_true')
+    # режим без интерфейса: команды JSONL из файла или стандартного ввода ('-'), принятые сообщения - JSONL
+    # в стандартный вывод
+    parser.add_argument('--headless', default=None, nargs='?', const='-', metavar='FILE')
+    parser.add_argument('--linger', default=HEADLESS_LINGER, type=float)
     namespace = parser.parse_args(sys.argv[1:])
-    server_address = namespace.addr
     server_port = namespace.port
-    client_name = namespace.name
 
     # проверим подходящий номер порта
     if not 1023 < server_port < 65536:
         logger.critical(
-            f'Попытка запуска клиента с неподходящим номером порта: {server_port}. Допустимы адреса с 1024 до 65535. Клиент завершается.')
+            'Попытка запуска клиента с неподходящим номером порта: %s. Допустимы адреса с 1024 до 65535. Клиент завершается.',
+            server_port)
         exit(1)
 
-    return server_address, server_port, client_name
+    if namespace.headless is not None and not namespace.name:
+        logger.critical('В режиме без интерфейса имя пользователя задаётся параметром --name.')
+        exit(1)
+
+    return namespace
 
 
 def main():
+    # Загружаем параметы коммандной строки
+    namespace = arg_parser()
+    if namespace.log_level:
+        set_logging_level(namespace.log_level)
+    server_address = namespace.addr
+    server_port = namespace.port
+    client_name = namespace.name
+    compressions = [] if namespace.no_compression else None
+
+    # Без интерфейса стандартный вывод занят принятыми сообщениями, приветствие не выводится.
+    if namespace.headless is not None:
+        from client_async import main_headless
+        exit(run_event_loop(main_headless(server_address, server_port, client_name, namespace.headless,
+                                          namespace.linger, compressions=compressions)))
+
     # Сообщаем о запуске
     print('Консольный месседжер. Клиентский модуль.')
 
-    # Загружаем параметы коммандной строки
-    server_address, server_port, client_name = arg_parser()
-
     # Если имя пользователя не было задано, необходимо запросить пользователя.
     if not client_name:
         client_name = input('Введите имя пользователя: ')
 
     logger.info(
-        f'Запущен клиент с парамертами: адрес сервера: {server_address} , порт: {server_port}, имя пользователя: {client_name}')
+        'Запущен клиент с парамертами: адрес сервера: %s , порт: %s, имя пользователя: %s',
+        server_address, server_port, client_name)
+
+    # Асинхронный вариант: приём и взаимодействие с пользователем в одном цикле событий вместо двух потоков.
+    if namespace.async_mode:
+        from client_async import main_async
+        exit(run_event_loop(main_async(server_address, server_port, client_name, compressions)))
 
     # Инициализация сокета и сообщение серверу о нашем появлении
     try:
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # каждая команда пользователя - одно сообщение, ждать задержку Нейгла незачем
+        transport.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         transport.connect((server_address, server_port))
-        send_message(transport, create_presence(client_name))
-        answer = process_response_ans(get_message(transport))
-        logger.info(f'Установлено соединение с сервером. Ответ сервера: {answer}')
+        # Запрашиваем кадры с префиксом длины и предлагаем доступные кодеки и сжатие, сервер без их поддержки
+        # ответит без полей framing, codec и compression.
+        stream = MessageStream()
+        send_message(transport, create_presence(client_name, FRAMING_LENGTH, CODECS,
+                                                None if namespace.no_compression else COMPRESSIONS), stream)
+        response = get_message(transport, stream)
+        answer = process_response_ans(response)
+        stream.configure(response)
+        logger.info('Установлено соединение с сервером. Ответ сервера: %s', answer)
         print(f'Установлено соединение с сервером.')
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, IncorrectDataRecivedError):
         logger.error('Не удалось декодировать полученную Json строку.')
         exit(1)
     except ServerError as error:
-        logger.error(f'При установке соединения сервер вернул ошибку: {error.text}')
+        logger.error('При установке соединения сервер вернул ошибку: %s', error.text)
         exit(1)
     except ReqFieldMissingError as missing_error:
-        logger.error(f'В ответе сервера отсутствует необходимое поле {missing_error.missing_field}')
+        logger.error('В ответе сервера отсутствует необходимое поле %s', missing_error.missing_field)
         exit(1)
     except (ConnectionRefusedError, ConnectionError):
         logger.critical(
-            f'Не удалось подключиться к серверу {server_address}:{server_port}, конечный компьютер отверг запрос на подключение.')
+            'Не удалось подключиться к серверу %s:%s, конечный компьютер отверг запрос на подключение.',
+            server_address, server_port)
         exit(1)
     else:
         # Если соединение с сервером установлено корректно, запускаем клиенский процесс приёма сообщний
-        receiver = threading.Thread(target=message_from_server, args=(transport, client_name))
+        receiver = threading.Thread(target=message_from_server, args=(transport, client_name, stream))
         receiver.daemon = True
         receiver.start()
 
         # затем запускаем отправку сообщений и взаимодействие с пользователем.
-        user_interface = threading.Thread(target=user_interactive, args=(transport, client_name))
+        user_interface = threading.Thread(target=user_interactive, args=(transport, client_name, stream))
         user_interface.daemon = True
         user_interface.start()
         logger.debug('Запущены процессы')
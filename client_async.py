@@ -0,0 +1,816 @@
+import os
+import sys
+import json
+import mmap
+import asyncio
+import logging
+import threading
+from collections import deque
+import logs.config_client_log
+from common.variables import *
+from common.utils import *
+from errors import IncorrectDataRecivedError, ReqFieldMissingError, ServerError
+from client import create_presence, process_response_ans, create_exit_message, create_text_message, \
+    create_channel_message, create_pong_message, create_search_message, is_ping, is_rate_limited, is_search_results, \
+    is_user_message, message_source, print_help, print_search_results, create_upload_message, create_chunk_message, \
+    create_download_message, is_chunk, download_path, create_contact_message, is_contacts, is_status, print_contacts
+
+# Инициализация клиентского логера
+logger = logging.getLogger('client')
+
+
+# Скачиваемый файл: ожидание результата, путь, открытый файл (после ответа сервера) и размер.
+class IncomingFile:
+    __slots__ = ('future', 'directory', 'file', 'size')
+
+    def __init__(self, future, directory):
+        self.future = future
+        self.directory = directory
+        self.file = None
+        self.size = 0
+
+
+# Асинхронный клиент мессенджера: одно подключение для одного пользователя. Сообщения для пользователя
+# передаются в обработчик on_message(client, message), а если он не задан - складываются в очередь messages.
+# codecs и compressions - предлагаемые серверу кодеки и схемы сжатия в порядке предпочтения, по умолчанию
+# все доступные.
+# contacts - присутствие контактов по сообщениям сервера (имя - в сети ли он), об изменениях сообщается
+# в обработчик on_status(client, changes), если он задан.
+# Кадры, отправленные за один проход цикла событий, передаются транспорту одним вызовом writelines.
+class AsyncClient:
+    def __init__(self, account_name, server_address=DEFAULT_IP_ADDRESS, server_port=DEFAULT_PORT, on_message=None,
+                 codecs=None, compressions=None):
+        self.account_name = account_name
+        self.codecs = list(CODECS) if codecs is None else codecs
+        self.compressions = list(COMPRESSIONS) if compressions is None else compressions
+        self.server_address = server_address
+        self.server_port = server_port
+        self.on_message = on_message
+        self.messages = asyncio.Queue()
+        self.stream = MessageStream()
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.pending = None
+        self.searches = deque()
+        # загрузки и скачивания файлов, ожидающие ответа, по имени вложения
+        self.uploads = {}
+        self.downloads = {}
+        self.contacts = {}
+        self.contact_requests = deque()
+        self.on_status = None
+
+    # Подключение и регистрация на сервере. Ответ сервера разбирает process_response_ans, при ошибке
+    # регистрации исключение ServerError передаётся вызывающему.
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.server_address, self.server_port)
+        presence = self.presence()
+        self.writer.write(self.stream.encode(presence))
+        response = await self.read_message()
+        answer = process_response_ans(response)
+        self.stream.configure(response)
+        self.receiver = asyncio.create_task(self.receive())
+        return answer
+
+    def presence(self):
+        return create_presence(self.account_name, FRAMING_LENGTH, self.codecs, self.compressions)
+
+    # Чтение следующего кадра из потока соединения без декодирования.
+    async def read_frame(self):
+        while True:
+            payload = self.stream.next_frame()
+            if payload is not None:
+                return payload
+            data = await self.reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionResetError
+            self.stream.feed(data)
+
+    # Чтение следующего сообщения из потока соединения.
+    async def read_message(self):
+        return self.stream.decode(await self.read_frame())
+
+    # Приём сообщений с сервера, завершается при потере соединения. Ожидающие ответа запросы поиска, загрузки
+    # и скачивания завершаются ошибкой ConnectionResetError.
+    async def receive(self):
+        try:
+            await self.receive_messages()
+        finally:
+            futures = list(self.searches) + list(self.uploads.values()) + list(self.contact_requests) + \
+                [incoming.future for incoming in self.downloads.values()]
+            self.searches.clear()
+            self.contact_requests.clear()
+            self.uploads.clear()
+            for incoming in self.downloads.values():
+                if incoming.file is not None:
+                    incoming.file.close()
+            self.downloads.clear()
+            for future in futures:
+                if not future.done():
+                    future.set_exception(ConnectionResetError())
+
+    async def receive_messages(self):
+        while True:
+            try:
+                payload = await self.read_frame()
+                try:
+                    message = self.stream.decode(payload)
+                except IncorrectDataRecivedError:
+                    # кадр принят целиком, но не декодируется (сервер пересылает кадры других клиентов без
+                    # разбора) - пропускаем его, следующие кадры принимаются как обычно
+                    logger.error('Не удалось декодировать полученное сообщение.')
+                    continue
+                data = await self.read_frame() if is_chunk(message) else None
+            except IncorrectDataRecivedError:
+                logger.error('Нарушен формат кадров, полученных с сервера.')
+                return
+            except (OSError, ConnectionError, json.JSONDecodeError):
+                logger.critical('Потеряно соединение с сервером.')
+                return
+            self.dispatch(message, data)
+
+    # Обработка принятого сообщения, data - данные куска файла для заголовка chunk.
+    def dispatch(self, message, data):
+        if is_ping(message):
+            self.write(create_pong_message())
+        elif data is not None:
+            self.receive_chunk(message, data)
+        elif RESPONSE in message and ATTACHMENT in message:
+            self.attachment_response(message)
+        elif is_rate_limited(message):
+            logger.warning('Сервер ограничил частоту отправки: %s', message.get(ERROR))
+        elif is_status(message):
+            self.contacts.update(message[CONTACTS])
+            if self.on_status is not None:
+                self.on_status(self, message[CONTACTS])
+        elif is_contacts(message) and self.contact_requests:
+            future = self.contact_requests.popleft()
+            if not future.done():
+                future.set_result(message[CONTACTS])
+        elif self.searches and (is_search_results(message) or message.get(RESPONSE) == 400):
+            # сервер отвечает на запросы поиска по порядку
+            future = self.searches.popleft()
+            if not future.done():
+                future.set_result(message)
+        elif not is_user_message(message, self.account_name):
+            logger.error('Получено некорректное сообщение с сервера: %s', message)
+        elif self.on_message is not None:
+            self.on_message(self, message)
+        else:
+            self.messages.put_nowait(message)
+
+    # Постановка кадра в очередь отправки. Очередь передаётся транспорту в конце текущего прохода цикла событий
+    # или при drain().
+    def write(self, message):
+        if self.pending is None:
+            self.pending = []
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.pending.append(self.stream.encode(message))
+
+    def flush(self):
+        pending = self.pending
+        self.pending = None
+        if pending and not self.writer.is_closing():
+            self.writer.writelines(pending)
+
+    # Отправка сообщения без ожидания, для ожидания отправки - drain().
+    def send(self, to, text):
+        self.write(create_text_message(self.account_name, to, text))
+
+    # Вход в канал и выход из него, без ожидания.
+    def join(self, room):
+        self.write(create_channel_message(JOIN, self.account_name, room))
+
+    def leave(self, room):
+        self.write(create_channel_message(LEAVE, self.account_name, room))
+
+    # Поиск по истории сообщений, возвращает список найденных сообщений от новых к старым. Параметры -
+    # как у create_search_message. При ошибке в параметрах - исключение ServerError.
+    async def search(self, query, since=None, until=None, before=None, limit=None):
+        future = asyncio.get_running_loop().create_future()
+        self.searches.append(future)
+        self.write(create_search_message(self.account_name, query, since, until, before, limit))
+        await self.drain()
+        message = await future
+        if not is_search_results(message):
+            raise ServerError(f'{message[RESPONSE]} : {message.get(ERROR)}')
+        return message[RESULTS]
+
+    # Добавление и удаление контакта, без ожидания. Присутствие добавленного контакта сервер пришлёт
+    # сообщением status.
+    def add_contact(self, contact):
+        self.write(create_contact_message(ADD_CONTACT, self.account_name, contact))
+
+    def del_contact(self, contact):
+        self.contacts.pop(contact, None)
+        self.write(create_contact_message(DEL_CONTACT, self.account_name, contact))
+
+    # Список контактов с присутствием: словарь имя - в сети ли он.
+    async def get_contacts(self):
+        future = asyncio.get_running_loop().create_future()
+        self.contact_requests.append(future)
+        self.write(create_contact_message(GET_CONTACTS, self.account_name))
+        await self.drain()
+        self.contacts = dict(await future)
+        return self.contacts
+
+    async def drain(self):
+        self.flush()
+        await self.writer.drain()
+
+    # Загрузка файла для пользователя или канала to. Файл отображается в память, куски передаются транспорту
+    # срезами без копирования, следующий - после drain. Возвращает имя вложения после ответа сервера,
+    # при отказе сервера - исключение ServerError.
+    async def upload(self, path, to):
+        size = os.path.getsize(path)
+        attachment_id = new_attachment_id()
+        future = asyncio.get_running_loop().create_future()
+        self.uploads[attachment_id] = future
+        self.write(create_upload_message(self.account_name, to, attachment_id, os.path.basename(path), size))
+        mapped = None
+        try:
+            with open(path, 'rb') as file:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+            for offset in range(0, size, ATTACHMENT_CHUNK_SIZE):
+                # сервер отказал в загрузке - остальные куски не отправляются
+                if future.done():
+                    break
+                count = min(ATTACHMENT_CHUNK_SIZE, size - offset)
+                self.write(create_chunk_message(attachment_id, offset))
+                self.flush()
+                self.writer.write(FRAME_HEADER.pack(count))
+                self.writer.write(memoryview(mapped)[offset:offset + count])
+                await self.writer.drain()
+            await self.drain()
+        finally:
+            close_mapping(mapped)
+        message = await future
+        if message[RESPONSE] != 200:
+            raise ServerError(f'{message[RESPONSE]} : {message.get(ERROR)}')
+        return attachment_id
+
+    # Скачивание вложения в каталог directory, возвращает путь к сохранённому файлу. Если вложения нет
+    # или оно недоступно пользователю - исключение ServerError.
+    async def download(self, attachment_id, directory=DOWNLOAD_DIR):
+        future = asyncio.get_running_loop().create_future()
+        self.downloads[attachment_id] = IncomingFile(future, directory)
+        self.write(create_download_message(self.account_name, attachment_id))
+        await self.drain()
+        return await future
+
+    # Ответ сервера на загрузку или скачивание: 200 на загрузку - файл принят, 200 на скачивание - имя
+    # и размер файла, дальше идут куски; 400 - отказ.
+    def attachment_response(self, message):
+        attachment_id = message[ATTACHMENT]
+        incoming = self.downloads.get(attachment_id)
+        if incoming is not None:
+            if message[RESPONSE] == 200 and FILE_NAME in message:
+                os.makedirs(incoming.directory, exist_ok=True)
+                incoming.file = open(download_path(message, incoming.directory), 'wb')
+                incoming.size = message[SIZE]
+                return
+            del self.downloads[attachment_id]
+            if incoming.file is not None:
+                incoming.file.close()
+            if not incoming.future.done():
+                incoming.future.set_exception(ServerError(f'{message[RESPONSE]} : {message.get(ERROR)}'))
+            return
+        future = self.uploads.pop(attachment_id, None)
+        if future is None:
+            logger.debug('Ответ сервера по вложению %s: %s', attachment_id, message)
+        elif not future.done():
+            future.set_result(message)
+
+    # Запись принятого куска скачиваемого файла, после последнего куска скачивание завершается.
+    def receive_chunk(self, message, data):
+        incoming = self.downloads.get(message[ATTACHMENT])
+        if incoming is None or incoming.file is None:
+            logger.error('Получен кусок неизвестного вложения %s.', message[ATTACHMENT])
+            return
+        incoming.file.seek(message[OFFSET])
+        incoming.file.write(data)
+        if message[OFFSET] + len(data) >= incoming.size:
+            del self.downloads[message[ATTACHMENT]]
+            incoming.file.close()
+            if not incoming.future.done():
+                incoming.future.set_result(incoming.file.name)
+
+    # Сообщение о выходе и закрытие подключения.
+    async def close(self):
+        if self.writer is None or self.writer.is_closing():
+            return
+        try:
+            self.write(create_exit_message(self.account_name))
+            await self.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+        if self.receiver is not None:
+            self.receiver.cancel()
+
+
+# Мультиплексированное подключение (шлюз): через одно подключение работают много пользователей. Первый
+# пользователь регистрируется при подключении, остальные - вызовом register(). Перед кадрами пользователя
+# ставится его метка (только при смене пользователя). Принятые сообщения передаются в on_message(account, message),
+# где account - MultiplexAccount получателя, а без обработчика складываются в очередь messages парами
+# (account, message).
+class MultiplexClient(AsyncClient):
+    def __init__(self, account_name, server_address=DEFAULT_IP_ADDRESS, server_port=DEFAULT_PORT, on_message=None,
+                 codecs=None, compressions=None):
+        super().__init__(account_name, server_address, server_port, on_message, codecs, compressions)
+        # пользователь, метка которого отправлена последней (None - первый пользователь)
+        self.tag = None
+        self.accounts = {account_name: MultiplexAccount(self, account_name)}
+        self.registrations = {}
+
+    def presence(self):
+        return create_presence(self.account_name, FRAMING_LENGTH, self.codecs, self.compressions, multiplex=True)
+
+    async def connect(self):
+        answer = await super().connect()
+        if not self.stream.multiplex:
+            await self.close()
+            raise ServerError('Сервер не поддерживает мультиплексированные подключения.')
+        return answer
+
+    # Регистрация ещё одного пользователя в подключении, возвращает его MultiplexAccount. Если имя занято -
+    # исключение ServerError.
+    async def register(self, account_name):
+        future = asyncio.get_running_loop().create_future()
+        self.registrations[account_name] = future
+        self.write_as(account_name, create_presence(account_name))
+        await self.drain()
+        process_response_ans(await future)
+        account = self.accounts[account_name] = MultiplexAccount(self, account_name)
+        return account
+
+    def write(self, message):
+        self.write_as(self.account_name, message)
+
+    # Постановка кадра пользователя account_name в очередь отправки, при смене пользователя - после его метки.
+    def write_as(self, account_name, message):
+        if self.pending is None:
+            self.pending = []
+            asyncio.get_running_loop().call_soon(self.flush)
+        tag = None if account_name == self.account_name else account_name
+        if tag != self.tag:
+            self.tag = tag
+            self.pending.append(multiplex_tag(account_name))
+        self.pending.append(self.stream.encode(message))
+
+    async def receive(self):
+        try:
+            await super().receive()
+        finally:
+            for future in self.registrations.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError())
+            self.registrations.clear()
+
+    # Сообщение относится к пользователю из последней принятой метки. Ответы на регистрацию и сообщения
+    # пользователей обрабатываются здесь, остальное (проверка связи, ошибки, поиск первого пользователя) -
+    # как в AsyncClient.
+    def dispatch(self, message, data):
+        account_name = self.stream.tag or self.account_name
+        if RESPONSE in message and account_name in self.registrations:
+            future = self.registrations.pop(account_name)
+            if not future.done():
+                future.set_result(message)
+        elif account_name in self.accounts and is_user_message(message, account_name):
+            if self.on_message is not None:
+                self.on_message(self.accounts[account_name], message)
+            else:
+                self.messages.put_nowait((self.accounts[account_name], message))
+        elif account_name != self.account_name and account_name in self.accounts and is_status(message):
+            if self.on_status is not None:
+                self.on_status(self.accounts[account_name], message[CONTACTS])
+        else:
+            super().dispatch(message, data)
+
+
+# Пользователь мультиплексированного подключения: отправка, как у AsyncClient (send, join, leave, add_contact,
+# del_contact, drain, close), через общее подключение. Изменения присутствия контактов передаются
+# в on_status(account, changes) подключения.
+class MultiplexAccount:
+    __slots__ = ('connection', 'account_name')
+
+    def __init__(self, connection, account_name):
+        self.connection = connection
+        self.account_name = account_name
+
+    @property
+    def writer(self):
+        return self.connection.writer
+
+    def write(self, message):
+        self.connection.write_as(self.account_name, message)
+
+    def send(self, to, text):
+        self.write(create_text_message(self.account_name, to, text))
+
+    def join(self, room):
+        self.write(create_channel_message(JOIN, self.account_name, room))
+
+    def leave(self, room):
+        self.write(create_channel_message(LEAVE, self.account_name, room))
+
+    def add_contact(self, contact):
+        self.write(create_contact_message(ADD_CONTACT, self.account_name, contact))
+
+    def del_contact(self, contact):
+        self.write(create_contact_message(DEL_CONTACT, self.account_name, contact))
+
+    async def drain(self):
+        await self.connection.drain()
+
+    # Выход пользователя. Выход первого пользователя закрывает всё подключение.
+    async def close(self):
+        if self.account_name == self.connection.account_name:
+            await self.connection.close()
+            return
+        if self.connection.writer.is_closing():
+            return
+        try:
+            self.write(create_exit_message(self.account_name))
+            await self.drain()
+        except ConnectionError:
+            pass
+        self.connection.accounts.pop(self.account_name, None)
+
+
+# Пул подключений: по одному подключению на пользователя, повторный запрос возвращает уже установленное.
+# Позволяет держать тысячи имитируемых пользователей в одном процессе, одновременная установка подключений
+# ограничена connect_limit. При multiplex > 0 пользователи регистрируются в мультиплексированных подключениях,
+# до multiplex пользователей в каждом.
+class ClientPool:
+    def __init__(self, server_address=DEFAULT_IP_ADDRESS, server_port=DEFAULT_PORT, on_message=None,
+                 connect_limit=100, codecs=None, compressions=None, multiplex=0):
+        self.server_address = server_address
+        self.server_port = server_port
+        self.on_message = on_message
+        self.codecs = codecs
+        self.compressions = compressions
+        self.connect_limit = connect_limit
+        self.multiplex = multiplex
+        self.clients = {}
+        self.gateways = []
+        self._connecting = None
+        # подключение текущего шлюза (задача) и число пользователей, назначенных ему
+        self._gateway = None
+        self._gateway_accounts = 0
+
+    # Получение подключения пользователя, при необходимости подключение устанавливается.
+    async def acquire(self, account_name):
+        client = self.clients.get(account_name)
+        if client is not None and not client.writer.is_closing():
+            return client
+        if self._connecting is None:
+            self._connecting = asyncio.Semaphore(self.connect_limit)
+        if self.multiplex:
+            client = await self.acquire_multiplexed(account_name)
+        else:
+            async with self._connecting:
+                client = AsyncClient(account_name, self.server_address, self.server_port, self.on_message,
+                                     self.codecs, self.compressions)
+                await client.connect()
+        self.clients[account_name] = client
+        return client
+
+    # Пользователь мультиплексированного подключения: первый пользователь шлюза открывает подключение,
+    # следующие ждут его и регистрируются в нём.
+    async def acquire_multiplexed(self, account_name):
+        if self._gateway is None or self._gateway_accounts >= self.multiplex:
+            gateway = MultiplexClient(account_name, self.server_address, self.server_port, self.on_message,
+                                      self.codecs, self.compressions)
+            self._gateway = asyncio.ensure_future(self.open_gateway(gateway))
+            self._gateway_accounts = 1
+            await self._gateway
+            return gateway.accounts[account_name]
+        self._gateway_accounts += 1
+        gateway = await self._gateway
+        return await gateway.register(account_name)
+
+    async def open_gateway(self, gateway):
+        async with self._connecting:
+            await gateway.connect()
+        self.gateways.append(gateway)
+        return gateway
+
+    # Подключение пачки пользователей, возвращает словарь имя - ошибка для неудачных подключений.
+    async def connect(self, account_names):
+        results = await asyncio.gather(*(self.acquire(name) for name in account_names), return_exceptions=True)
+        return {name: result for name, result in zip(account_names, results) if isinstance(result, Exception)}
+
+    def send(self, account_name, to, text):
+        self.clients[account_name].send(to, text)
+
+    async def drain(self):
+        clients = self.gateways if self.multiplex else self.clients.values()
+        await asyncio.gather(*(client.drain() for client in clients), return_exceptions=True)
+
+    async def close(self):
+        await asyncio.gather(*(client.close() for client in self.clients.values()), return_exceptions=True)
+        self.clients.clear()
+        self.gateways.clear()
+
+
+# Вывод принятого сообщения пользователю консольного клиента.
+def print_incoming(client, message):
+    print(f'\nПолучено сообщение от пользователя {message_source(message)}:\n{message[MESSAGE_TEXT]}')
+    logger.info('Получено сообщение от пользователя %s:\n%s', message_source(message), message[MESSAGE_TEXT])
+    if ATTACHMENT in message:
+        print('Скачать файл: download')
+
+
+# Вывод изменений присутствия контактов пользователю консольного клиента.
+def print_status(client, changes):
+    print()
+    print_contacts(changes)
+
+
+# Чтение стандартного ввода в фоновом потоке: строки передаются в цикл событий через очередь,
+# None означает конец ввода. Поток завершается и после закрытия цикла событий.
+def read_stdin(loop, lines):
+    try:
+        for line in sys.stdin:
+            loop.call_soon_threadsafe(lines.put_nowait, line.rstrip('\n'))
+        loop.call_soon_threadsafe(lines.put_nowait, None)
+    except RuntimeError:
+        pass
+
+
+async def read_input(lines, prompt):
+    print(prompt, end='', flush=True)
+    line = await lines.get()
+    if line is None:
+        raise EOFError
+    return line
+
+
+# Загрузка или скачивание файла в фоне, по завершении пользователю выводится результат. Ссылки на задачи
+# хранятся в transfers, пока они не завершатся.
+def start_transfer(transfers, transfer, done_text):
+    task = asyncio.create_task(report_transfer(transfer, done_text))
+    transfers.add(task)
+    task.add_done_callback(transfers.discard)
+
+
+async def report_transfer(transfer, done_text):
+    try:
+        result = await transfer
+    except FileNotFoundError:
+        print('\nФайл не найден.')
+    except ServerError as error:
+        print(f'\nСервер вернул ошибку: {error.text}')
+    except ConnectionError:
+        logger.critical('Потеряно соединение с сервером.')
+    else:
+        print(f'\n{done_text} {result}')
+
+
+# Асинхронный вариант user_interactive: запрашивает команды, отправляет сообщения. Конец ввода равносилен exit.
+async def user_interactive_async(client, lines):
+    print_help()
+    transfers = set()
+    while True:
+        try:
+            command = await read_input(lines, 'Введите команду: ')
+            if command == 'message':
+                to = await read_input(lines, 'Введите получателя сообщения: ')
+                text = await read_input(lines, 'Введите сообщение для отправки: ')
+            elif command in (JOIN, LEAVE):
+                room = await read_input(lines, 'Введите имя канала (начинается с #): ')
+            elif command == 'search':
+                query = await read_input(lines, 'Введите слова для поиска: ')
+                before = await read_input(lines, 'Продолжить от номера сообщения (Enter - с последних): ')
+            elif command == 'upload':
+                path = await read_input(lines, 'Введите путь к файлу: ')
+                to = await read_input(lines, 'Введите получателя файла: ')
+            elif command == 'download':
+                attachment_id = await read_input(lines, 'Введите имя вложения: ')
+            elif command in (ADD_CONTACT, DEL_CONTACT):
+                contact = await read_input(lines, 'Введите имя контакта: ')
+        except EOFError:
+            break
+        if command == 'message':
+            try:
+                client.send(to, text)
+                await client.drain()
+            except ConnectionError:
+                logger.critical('Потеряно соединение с сервером.')
+                break
+            logger.info('Отправлено сообщение для пользователя %s', to)
+        elif command in (JOIN, LEAVE):
+            try:
+                if command == JOIN:
+                    client.join(room)
+                else:
+                    client.leave(room)
+                await client.drain()
+            except ConnectionError:
+                logger.critical('Потеряно соединение с сервером.')
+                break
+        elif command == 'search':
+            try:
+                results = await client.search(query, before=int(before or 0))
+            except ValueError:
+                print('Номер сообщения должен быть числом.')
+            except ServerError as error:
+                print(f'Сервер вернул ошибку: {error.text}')
+            except ConnectionError:
+                logger.critical('Потеряно соединение с сервером.')
+                break
+            else:
+                print_search_results({RESULTS: results})
+        elif command == 'contacts':
+            try:
+                contacts = await client.get_contacts()
+            except ConnectionError:
+                logger.critical('Потеряно соединение с сервером.')
+                break
+            print(f'Контактов: {len(contacts)}')
+            print_contacts(contacts)
+        elif command in (ADD_CONTACT, DEL_CONTACT):
+            try:
+                if command == ADD_CONTACT:
+                    client.add_contact(contact)
+                else:
+                    client.del_contact(contact)
+                await client.drain()
+            except ConnectionError:
+                logger.critical('Потеряно соединение с сервером.')
+                break
+        # загрузка и скачивание идут в фоне, пользователь может продолжать переписку
+        elif command == 'upload':
+            start_transfer(transfers, client.upload(path, to), 'Файл загружен на сервер, вложение')
+        elif command == 'download':
+            start_transfer(transfers, client.download(attachment_id), 'Файл сохранён:')
+        elif command == 'help':
+            print_help()
+        elif command == 'exit':
+            print('Завершение соединения.')
+            logger.info('Завершение работы по команде пользователя.')
+            break
+        else:
+            print('Команда не распознана, попробойте снова. help - вывести поддерживаемые команды.')
+
+
+# Асинхронный консольный клиент. Завершается сразу, как только пользователь ввёл exit или потеряно соединение.
+async def main_async(server_address, server_port, client_name, compressions=None):
+    client = AsyncClient(client_name, server_address, server_port, print_incoming, compressions=compressions)
+    client.on_status = print_status
+    try:
+        answer = await client.connect()
+        logger.info('Установлено соединение с сервером. Ответ сервера: %s', answer)
+        print(f'Установлено соединение с сервером.')
+    except (json.JSONDecodeError, IncorrectDataRecivedError):
+        logger.error('Не удалось декодировать полученную Json строку.')
+        return 1
+    except ServerError as error:
+        logger.error('При установке соединения сервер вернул ошибку: %s', error.text)
+        return 1
+    except ReqFieldMissingError as missing_error:
+        logger.error('В ответе сервера отсутствует необходимое поле %s', missing_error.missing_field)
+        return 1
+    except (ConnectionRefusedError, ConnectionError):
+        logger.critical(
+            'Не удалось подключиться к серверу %s:%s, конечный компьютер отверг запрос на подключение.',
+            server_address, server_port)
+        return 1
+
+    lines = asyncio.Queue()
+    threading.Thread(target=read_stdin, args=(asyncio.get_running_loop(), lines), daemon=True).start()
+    user_interface = asyncio.create_task(user_interactive_async(client, lines))
+    await asyncio.wait([user_interface, client.receiver], return_when=asyncio.FIRST_COMPLETED)
+    user_interface.cancel()
+    await client.close()
+    return 0
+
+
+# Клиент без интерфейса (для ботов и массовой отправки). Команды - строки JSONL:
+# {"to": получатель, "text": текст} - сообщение пользователю или в канал,
+# {"join": канал} и {"leave": канал} - вход в канал и выход из него.
+# Возвращает сообщение для сервера, при некорректной строке - исключение ValueError.
+def headless_command(account_name, line):
+    command = json.loads(line)
+    if not isinstance(command, dict):
+        raise ValueError(line)
+    if HEADLESS_TO in command:
+        return create_text_message(account_name, str(command[HEADLESS_TO]), str(command.get(HEADLESS_TEXT, '')))
+    for action in (JOIN, LEAVE):
+        if action in command:
+            return create_channel_message(action, account_name, str(command[action]))
+    raise ValueError(line)
+
+
+# Вывод принятых сообщений строками JSONL {"from": ..., "to": ..., "time": ..., "text": ...}. Вывод
+# сбрасывается один раз за проход цикла событий, а не после каждого сообщения.
+class JsonlWriter:
+    def __init__(self, output=None):
+        self.output = sys.stdout if output is None else output
+        self.scheduled = False
+
+    def __call__(self, client, message):
+        self.output.write(json.dumps({HEADLESS_FROM: message[SENDER], HEADLESS_TO: message[DESTINATION],
+                                      TIME: message.get(TIME), HEADLESS_TEXT: message[MESSAGE_TEXT]},
+                                     ensure_ascii=False) + '\n')
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        try:
+            self.output.flush()
+        except (BrokenPipeError, ValueError):
+            pass
+
+
+# Чтение файла команд в фоновом потоке порциями по HEADLESS_READ_SIZE байт: порция - столько, сколько
+# было доступно (из канала строки приходят без ожидания заполнения буфера). Очередь chunks ограничена,
+# поэтому чтение ждёт, пока отправка не догонит его. b'' означает конец ввода.
+def read_chunks(loop, fd, chunks):
+    while True:
+        try:
+            data = os.read(fd, HEADLESS_READ_SIZE)
+        except OSError as err:
+            logger.error('Ошибка чтения команд: %s', err)
+            data = b''
+        try:
+            asyncio.run_coroutine_threadsafe(chunks.put(data), loop).result()
+        except RuntimeError:
+            return
+        if not data:
+            return
+
+
+# Отправка команд из файла fd без ожидания ответа на каждую: команды одной порции ставятся в очередь
+# отправки клиента, затем ожидается только освобождение буфера транспорта. Возвращает число отправленных
+# сообщений и число некорректных строк.
+async def send_commands(client, fd):
+    chunks = asyncio.Queue(HEADLESS_READ_AHEAD)
+    threading.Thread(target=read_chunks, args=(asyncio.get_running_loop(), fd, chunks), daemon=True).start()
+    sent = errors = 0
+    tail = b''
+    while True:
+        data = await chunks.get()
+        lines = (tail + data).split(b'\n')
+        tail = lines.pop() if data else b''
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                client.write(headless_command(client.account_name, line))
+            except (ValueError, TypeError, KeyError):
+                logger.error('Некорректная команда: %s', line[:200])
+                errors += 1
+            else:
+                sent += 1
+        await client.drain()
+        if not data:
+            return sent, errors
+
+
+# Клиент без интерфейса: регистрация, отправка команд из файла source ('-' - стандартный ввод), вывод принятых
+# сообщений в on_message (по умолчанию - JSONL в стандартный вывод). После конца ввода сообщения принимаются
+# ещё linger секунд, при отрицательном linger - до отключения сервером. Код возврата: 0 - все команды
+# отправлены, 1 - ошибка подключения или соединение потеряно, 2 - во вводе были некорректные строки.
+async def main_headless(server_address, server_port, client_name, source='-', linger=HEADLESS_LINGER,
+                        on_message=None, compressions=None):
+    # файл команд открывается до подключения: без него подключаться незачем
+    try:
+        file = None if source == '-' else open(source, 'rb')
+    except OSError as error:
+        logger.error('Не удалось открыть файл команд %s: %s', source, error)
+        return 1
+    client = AsyncClient(client_name, server_address, server_port, on_message or JsonlWriter(),
+                         compressions=compressions)
+    try:
+        answer = await client.connect()
+        logger.info('Установлено соединение с сервером. Ответ сервера: %s', answer)
+    except (json.JSONDecodeError, IncorrectDataRecivedError, ServerError, ReqFieldMissingError, OSError) as error:
+        logger.error('Не удалось подключиться к серверу %s:%s: %s', server_address, server_port, error)
+        if file is not None:
+            file.close()
+        return 1
+
+    sender = asyncio.create_task(send_commands(client, sys.stdin.fileno() if file is None else file.fileno()))
+    try:
+        await asyncio.wait([sender, client.receiver], return_when=asyncio.FIRST_COMPLETED)
+        if not sender.done():
+            logger.critical('Потеряно соединение с сервером.')
+            sender.cancel()
+            return 1
+        try:
+            sent, errors = sender.result()
+        except ConnectionError:
+            logger.critical('Потеряно соединение с сервером.')
+            return 1
+        logger.info('Отправлено сообщений: %s, некорректных строк: %s', sent, errors)
+        if linger:
+            await asyncio.wait([client.receiver], timeout=linger if linger > 0 else None)
+        return 2 if errors else 0
+    finally:
+        await client.close()
+        if file is not None:
+            file.close()
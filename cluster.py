@@ -0,0 +1,241 @@
+import os
+import json
+import signal
+import shutil
+import socket
+import logging
+import tempfile
+import time
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import wait
+from common.variables import *
+
+# Инициализация логирования сервера.
+logger = logging.getLogger('server')
+
+# Типы сообщений шины между рабочими процессами
+BUS_HELLO = 'hello'
+BUS_SYNC = 'sync'
+BUS_ONLINE = 'online'
+BUS_OFFLINE = 'offline'
+BUS_DELIVER = 'deliver'
+# Первый байт части длинного сообщения: за ней будут ещё части или она последняя. Целое сообщение - JSON объект,
+# он начинается с '{'.
+BUS_FRAGMENT_MORE = 0
+BUS_FRAGMENT_LAST = 1
+
+
+# Шина между рабочими процессами сервера. У каждого процесса свой датаграммный Unix сокет в общем каталоге.
+# Через шину рассылаются изменения присутствия (каждый процесс держит копию реестра: имя - номер процесса)
+# и пересылаются сообщения получателю, подключённому к другому процессу.
+# Запущенный (или перезапущенный) процесс рассылает hello, остальные отвечают ему списком своих пользователей
+# (sync), из этих ответов он восстанавливает реестр.
+# Датаграммы одному процессу доставляются по порядку: если процесс ещё не открыл сокет или его буфер заполнен,
+# датаграммы ждут в очереди этого процесса, остальные процессы получают свои без задержки. Сообщение длиннее
+# BUS_FRAGMENT_SIZE передаётся несколькими датаграммами, получатель собирает их по адресу отправителя.
+class WorkerBus:
+    def __init__(self, worker_id, workers, socket_dir):
+        self.worker_id = worker_id
+        self.paths = [os.path.join(socket_dir, f'worker-{i}.sock') for i in range(workers)]
+        # Реестр присутствия пользователей других процессов: имя пользователя - номер процесса
+        self.remote_names = dict()
+        # Пользователи этого процесса, о них сообщается перезапущенным процессам
+        self.local_names = set()
+        # Изменения реестра с последнего чтения: (имя пользователя, в сети ли он), забирает сервер
+        self.changes = []
+        # Отложенные датаграммы: очередь для каждого процесса, их общее число и время следующей попытки
+        # отправки процессу, который ещё не запущен
+        self.queues = [deque() for _ in range(workers)]
+        self.pending = 0
+        self.retry_at = [0] * workers
+        # Принятые части длинных сообщений по адресу отправителя
+        self.fragments = dict()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            os.unlink(self.paths[worker_id])
+        except FileNotFoundError:
+            pass
+        self.sock.bind(self.paths[worker_id])
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BUS_BUFFER_SIZE)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUS_BUFFER_SIZE)
+        self.sock.setblocking(False)
+        self._recv_buffer = bytearray(BUS_FRAGMENT_SIZE + 1)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def _send(self, worker_id, data):
+        if len(data) <= BUS_FRAGMENT_SIZE:
+            datagrams = [data]
+        else:
+            datagrams = [bytes((BUS_FRAGMENT_MORE,)) + data[offset:offset + BUS_FRAGMENT_SIZE]
+                         for offset in range(0, len(data), BUS_FRAGMENT_SIZE)]
+            datagrams[-1] = bytes((BUS_FRAGMENT_LAST,)) + datagrams[-1][1:]
+        queue = self.queues[worker_id]
+        if len(queue) + len(datagrams) > BUS_MAX_PENDING:
+            logger.error('Очередь шины переполнена, сообщение для процесса %s отброшено.', worker_id)
+            return
+        queue.extend(datagrams)
+        self.pending += len(datagrams)
+        if len(queue) == len(datagrams):
+            self._flush_queue(worker_id, queue)
+
+    # Отправка очереди одного процесса, пока буфер получателя принимает датаграммы.
+    def _flush_queue(self, worker_id, queue):
+        while queue:
+            try:
+                self.sock.sendto(queue[0], self.paths[worker_id])
+            except (BlockingIOError, InterruptedError):
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                # процесс ещё не запущен или перезапускается, датаграммы ждут его в очереди
+                if not self.retry_at[worker_id]:
+                    logger.warning('Рабочий процесс %s недоступен, сообщения шины отложены.', worker_id)
+                self.retry_at[worker_id] = time.monotonic() + BUS_RETRY_INTERVAL
+                return
+            except OSError as err:
+                logger.error('Не удалось отправить сообщение рабочему процессу %s: %s', worker_id, err)
+            queue.popleft()
+            self.pending -= 1
+            self.retry_at[worker_id] = 0
+
+    def _broadcast(self, message):
+        data = json.dumps(message).encode(ENCODING)
+        for worker_id in range(len(self.paths)):
+            if worker_id != self.worker_id:
+                self._send(worker_id, data)
+
+    # Досылка отложенных датаграмм, вызывается на каждой итерации цикла сервера.
+    def flush(self):
+        if not self.pending:
+            return
+        now = time.monotonic()
+        for worker_id, queue in enumerate(self.queues):
+            if queue and self.retry_at[worker_id] <= now:
+                self._flush_queue(worker_id, queue)
+
+    # Таймаут select() для цикла сервера, пока есть отложенные датаграммы: недоступному процессу они досылаются
+    # раз в BUS_RETRY_INTERVAL секунд, заполненный буфер проверяется чаще.
+    def timeout(self):
+        if not self.pending:
+            return None
+        now = time.monotonic()
+        return min(0.01 if not self.retry_at[worker_id] else max(0.01, self.retry_at[worker_id] - now)
+                   for worker_id, queue in enumerate(self.queues) if queue)
+
+    # Сообщение о (пере)запуске процесса: остальные забывают пользователей, числившихся за ним, и отвечают
+    # списками своих пользователей.
+    def publish_hello(self):
+        self._broadcast({'type': BUS_HELLO, 'worker': self.worker_id})
+
+    def publish_online(self, account_name):
+        self.local_names.add(account_name)
+        self._broadcast({'type': BUS_ONLINE, 'worker': self.worker_id, ACCOUNT_NAME: account_name})
+
+    def publish_offline(self, account_name):
+        self.local_names.discard(account_name)
+        self._broadcast({'type': BUS_OFFLINE, 'worker': self.worker_id, ACCOUNT_NAME: account_name})
+
+    # Пересылка сообщения в процесс, к которому подключён получатель. Возвращает False, если получатель
+    # не подключён ни к одному процессу.
+    def forward(self, message):
+        worker_id = self.remote_names.get(message[DESTINATION])
+        if worker_id is None:
+            return False
+        self._send(worker_id, json.dumps({'type': BUS_DELIVER, MESSAGE: message}).encode(ENCODING))
+        return True
+
+    # Рассылка сообщения канала всем процессам: каждый доставляет его своим участникам канала.
+    def publish_channel(self, message):
+        self._broadcast({'type': BUS_DELIVER, MESSAGE: message})
+
+    # Приём всех датаграмм шины. Изменения реестра применяются сразу, возвращается список сообщений
+    # для доставки локальным клиентам.
+    def read(self):
+        messages = []
+        while True:
+            try:
+                size, address = self.sock.recvfrom_into(self._recv_buffer)
+            except (BlockingIOError, InterruptedError):
+                return messages
+            data = self._recv_buffer[:size]
+            if data and data[0] in (BUS_FRAGMENT_MORE, BUS_FRAGMENT_LAST):
+                self.fragments.setdefault(address, []).append(bytes(data[1:]))
+                if data[0] == BUS_FRAGMENT_MORE:
+                    continue
+                data = b''.join(self.fragments.pop(address))
+            elif self.fragments.pop(address, None) is not None:
+                # отправитель перезапустился, не дослав длинное сообщение
+                logger.error('Сообщение шины от %s принято не полностью и отброшено.', address)
+            try:
+                event = json.loads(data)
+                kind = event['type']
+                if kind == BUS_DELIVER:
+                    messages.append(event[MESSAGE])
+                elif kind == BUS_ONLINE:
+                    self.remote_names[event[ACCOUNT_NAME]] = event['worker']
+                    self.changes.append((event[ACCOUNT_NAME], True))
+                elif kind == BUS_OFFLINE:
+                    if self.remote_names.get(event[ACCOUNT_NAME]) == event['worker']:
+                        del self.remote_names[event[ACCOUNT_NAME]]
+                        self.changes.append((event[ACCOUNT_NAME], False))
+                elif kind == BUS_SYNC:
+                    for name in event['names']:
+                        self.remote_names[name] = event['worker']
+                        self.changes.append((name, True))
+                elif kind == BUS_HELLO:
+                    for name in [name for name, worker_id in self.remote_names.items()
+                                 if worker_id == event['worker']]:
+                        del self.remote_names[name]
+                        self.changes.append((name, False))
+                    self._send(event['worker'], json.dumps({'type': BUS_SYNC, 'worker': self.worker_id,
+                                                            'names': list(self.local_names)}).encode(ENCODING))
+            except (ValueError, KeyError, TypeError, IndexError):
+                logger.error('Получено некорректное сообщение шины: %s', bytes(data[:100]))
+
+    def close(self):
+        self.sock.close()
+
+
+# Запуск и контроль рабочих процессов. target(worker_id, workers, socket_dir, *args) запускается в каждом
+# процессе; упавший процесс перезапускается. Если процесс не проработал и секунды (например, порт занят),
+# останавливаются все. По SIGINT/SIGTERM все процессы останавливаются.
+def supervise_workers(workers, target, args=()):
+    socket_dir = tempfile.mkdtemp(prefix='messenger-')
+    processes = {}
+
+    def start(worker_id):
+        process = multiprocessing.Process(target=target, args=(worker_id, workers, socket_dir) + tuple(args),
+                                          name=f'worker-{worker_id}', daemon=True)
+        process.start()
+        processes[process.sentinel] = (worker_id, process, time.monotonic())
+        logger.info('Запущен рабочий процесс %s, pid %s', worker_id, process.pid)
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for worker_id in range(workers):
+            start(worker_id)
+        while not stopping:
+            for sentinel in wait(list(processes), timeout=1):
+                worker_id, process, started = processes.pop(sentinel)
+                process.join()
+                if time.monotonic() - started < 1:
+                    logger.critical('Рабочий процесс %s завершился сразу после запуска, сервер остановлен.', worker_id)
+                    stopping.append(None)
+                    break
+                logger.error('Рабочий процесс %s завершился с кодом %s, перезапуск.', worker_id, process.exitcode)
+                start(worker_id)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker_id, process, started in processes.values():
+            process.terminate()
+        for worker_id, process, started in processes.values():
+            process.join(5)
+        shutil.rmtree(socket_dir, ignore_errors=True)
@@ -1,15 +1,530 @@
 from common.variables import *
 from errors import IncorrectDataRecivedError, NonDictInputError
+import asyncio
 import json
+import secrets
+import struct
 import sys
+import zlib
 sys.path.append('../')
 from decos import log
 
+# uvloop - необязательная зависимость, при наличии используется как цикл событий asyncio
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Необязательные быстрые кодеки сообщений
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+# Необязательное сжатие zstd
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Заголовок кадра - длинна сообщения в байтах, 4 байта big-endian
+FRAME_HEADER = struct.Struct('!I')
+# Пропуск пробельных символов между JSON документами
+_WHITESPACE = b' \t\n\r'
+# Поиск границы JSON документа, общий для всех потоков (raw_decode не хранит состояния)
+_DECODER = json.JSONDecoder()
+
+
+# Кодеки содержимого кадра. Кодек принимает словарь и возвращает байты и наоборот, без отдельного шага
+# encode/decode строки. wire - формат данных на линии: кадры кодеков с одинаковым форматом взаимозаменяемы.
+class JsonCodec:
+    name = CODEC_JSON
+    wire = CODEC_JSON
+
+    def dumps(self, message):
+        return json.dumps(message).encode(ENCODING)
+
+    def loads(self, payload):
+        return json.loads(payload)
+
+
+class OrjsonCodec:
+    name = CODEC_ORJSON
+    wire = CODEC_JSON
+
+    def dumps(self, message):
+        return orjson.dumps(message)
+
+    def loads(self, payload):
+        return orjson.loads(payload)
+
+
+class MsgpackCodec:
+    name = CODEC_MSGPACK
+    wire = CODEC_MSGPACK
+
+    def dumps(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def loads(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+# Доступные в этой установке кодеки в порядке предпочтения (быстрые первыми).
+CODECS = {codec.name: codec for codec in
+          (MsgpackCodec() if msgpack else None, OrjsonCodec() if orjson else None, JsonCodec()) if codec}
+DEFAULT_CODEC = CODECS[CODEC_JSON]
+
+
+# Образцы типичных кадров для словаря сжатия. Словарь - это сами образцы в формате данных потока (словарь
+# без обучения, raw content), поэтому он одинаков на клиенте и сервере и не передаётся по сети. Короткое
+# сообщение сжимается ссылками на словарь: ключи, действие, начало времени. Самые частые кадры - в конце,
+# ближе к сжимаемым данным. Изменение образцов несовместимо со старыми клиентами и требует новых имён схем.
+_DICTIONARY_SAMPLES = (
+    {ACTION: PRESENCE, TIME: 1700000000.0, USER: {ACCOUNT_NAME: 'user'}, FRAMING: FRAMING_LENGTH,
+     CODECS_OFFER: [CODEC_MSGPACK, CODEC_ORJSON, CODEC_JSON], COMPRESSIONS_OFFER: [COMPRESSION_ZSTD, COMPRESSION_ZLIB]},
+    {RESPONSE: 200, FRAMING: FRAMING_LENGTH, CODEC: CODEC_JSON, COMPRESSION: COMPRESSION_ZLIB},
+    {RESPONSE: 400, ERROR: 'error'},
+    {RESPONSE: 429, ERROR: 'error'},
+    {ACTION: SEARCH, TIME: 1700000000.0, ACCOUNT_NAME: 'user', QUERY: 'text', BEFORE: 1, LIMIT: 20},
+    {ACTION: JOIN, TIME: 1700000000.0, ACCOUNT_NAME: 'user', ROOM: '#room'},
+    {ACTION: LEAVE, TIME: 1700000000.0, ACCOUNT_NAME: 'user', ROOM: '#room'},
+    {ACTION: EXIT, TIME: 1700000000.0, ACCOUNT_NAME: 'user'},
+    {ACTION: PING, TIME: 1700000000.0},
+    {ACTION: PONG, TIME: 1700000000.0},
+    {ACTION: MESSAGE, SENDER: 'user', DESTINATION: '#room', TIME: 1700000000.0, MESSAGE_TEXT: 'text'},
+    {ACTION: MESSAGE, SENDER: 'user', DESTINATION: 'user', TIME: 1700000000.0, MESSAGE_TEXT: 'text'},
+)
+
+
+# Словари сжатия для каждого формата данных. Для JSON - в записи json.dumps и компактной записи (orjson).
+def compression_dictionaries():
+    dictionaries = {CODEC_JSON: b''.join(
+        json.dumps(sample).encode(ENCODING) + json.dumps(sample, separators=(',', ':')).encode(ENCODING)
+        for sample in _DICTIONARY_SAMPLES)}
+    if msgpack is not None:
+        dictionaries[CODEC_MSGPACK] = b''.join(msgpack.packb(sample, use_bin_type=True)
+                                               for sample in _DICTIONARY_SAMPLES)
+    return dictionaries
+
+
+# Сжатие zlib (deflate без заголовка) со словарём. Состояние с загруженным словарём готовится один раз,
+# для каждого кадра копируется. Окно 8 КБ и уменьшенная таблица хешей: кадры чата короткие, а копия
+# состояния остаётся дешёвой.
+class ZlibCompression:
+    name = COMPRESSION_ZLIB
+    window_bits = 13
+
+    def __init__(self):
+        self._compressors = {}
+        self._decompressors = {}
+        for wire, dictionary in compression_dictionaries().items():
+            self._compressors[wire] = zlib.compressobj(6, zlib.DEFLATED, -self.window_bits, 6,
+                                                       zlib.Z_DEFAULT_STRATEGY, dictionary)
+            self._decompressors[wire] = zlib.decompressobj(-self.window_bits, dictionary)
+
+    def compress(self, data, wire):
+        compressor = self._compressors[wire].copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data, wire):
+        decompressor = self._decompressors[wire].copy()
+        try:
+            result = decompressor.decompress(data, COMPRESSION_MAX_SIZE)
+        except zlib.error:
+            raise IncorrectDataRecivedError
+        if not decompressor.eof or decompressor.unconsumed_tail:
+            raise IncorrectDataRecivedError
+        return result
+
+
+# Сжатие zstd со словарём (пакет zstandard). Кадры zstd без сигнатуры и номера словаря - на коротких
+# сообщениях это заметная доля. В кадре записан размер исходных данных, по нему отбрасываются кадры,
+# распаковка которых превысила бы COMPRESSION_MAX_SIZE.
+class ZstdCompression:
+    name = COMPRESSION_ZSTD
+
+    def __init__(self):
+        self._compressors = {}
+        self._decompressors = {}
+        params = zstandard.ZstdCompressionParameters.from_level(3, format=zstandard.FORMAT_ZSTD1_MAGICLESS,
+                                                                write_dict_id=False)
+        for wire, dictionary in compression_dictionaries().items():
+            dictionary = zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+            self._compressors[wire] = zstandard.ZstdCompressor(dict_data=dictionary, compression_params=params)
+            self._decompressors[wire] = zstandard.ZstdDecompressor(dict_data=dictionary,
+                                                                   format=zstandard.FORMAT_ZSTD1_MAGICLESS)
+
+    def compress(self, data, wire):
+        return self._compressors[wire].compress(data)
+
+    def decompress(self, data, wire):
+        try:
+            size = zstandard.get_frame_parameters(data, format=zstandard.FORMAT_ZSTD1_MAGICLESS).content_size
+            if not 0 <= size <= COMPRESSION_MAX_SIZE:
+                raise IncorrectDataRecivedError
+            return self._decompressors[wire].decompress(data)
+        except zstandard.ZstdError:
+            raise IncorrectDataRecivedError
+
+
+# Схемы сжатия этой установки в порядке предпочтения. Объекты схем не потокобезопасны: потоки соединений
+# используют эти экземпляры из цикла событий, фоновые потоки создают свои (type(compression)()).
+COMPRESSIONS = {compression.name: compression for compression in
+                (ZstdCompression() if zstandard else None, ZlibCompression()) if compression}
+
+
+# Маршрут сообщения пользователю для заголовка кадра: (from, to) или None.
+def message_route(message):
+    if message is None or message.get(ACTION) != MESSAGE:
+        return None
+    sender, destination = message.get(SENDER), message.get(DESTINATION)
+    if isinstance(sender, str) and isinstance(destination, str):
+        return sender, destination
+    return None
+
+
+# Содержимое кадра при согласованном сжатии: байт флагов, заголовок маршрута (если известен маршрут и имена
+# не длиннее 255 байт) и данные, сжатые, если это их укорачивает.
+def pack_payload(data, compression, wire, route=None):
+    flags = 0
+    parts = [b'']
+    if route is not None:
+        sender, destination = route[0].encode(ENCODING), route[1].encode(ENCODING)
+        if len(sender) < 256 and len(destination) < 256:
+            flags |= FRAME_ROUTE
+            parts += (bytes((len(sender),)), sender, bytes((len(destination),)), destination)
+    if len(data) >= COMPRESSION_MIN_SIZE:
+        packed = compression.compress(data, wire)
+        if len(packed) < len(data):
+            flags |= FRAME_COMPRESSED
+            data = packed
+    parts[0] = bytes((flags,))
+    parts.append(data)
+    return b''.join(parts)
+
+
+# Заголовок маршрута кадра: ((from, to), смещение данных), (None, 1) если заголовка нет.
+def read_route(payload):
+    if not payload:
+        raise IncorrectDataRecivedError
+    if not payload[0] & FRAME_ROUTE:
+        return None, 1
+    try:
+        middle = 2 + payload[1]
+        end = middle + 1 + payload[middle]
+        if end > len(payload):
+            raise IncorrectDataRecivedError
+        return (payload[2:middle].decode(ENCODING), payload[middle + 1:end].decode(ENCODING)), end
+    except (IndexError, UnicodeDecodeError):
+        raise IncorrectDataRecivedError
+
+
+# Разбор содержимого кадра при согласованном сжатии: данные в формате потока и маршрут из заголовка (или None).
+def unpack_payload(payload, compression, wire):
+    route, offset = read_route(payload)
+    data = payload[offset:]
+    if payload[0] & FRAME_COMPRESSED:
+        data = compression.decompress(data, wire)
+    return data, route
+
+
+# Сообщение, принятое из сети, вместе с исходным содержимым кадра. Пока сообщение не изменяли, его можно
+# отправить получателю с кодеком того же формата без повторного кодирования. Любое изменение сбрасывает кадр.
+class RawMessage(dict):
+    __slots__ = ('payload', 'wire')
+
+    def __init__(self, message, payload, wire):
+        super().__init__(message)
+        self.payload = payload
+        self.wire = wire
+
+    def _changed(self):
+        self.payload = None
+
+    def __setitem__(self, key, value):
+        self._changed()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._changed()
+        super().__delitem__(key)
+
+    def pop(self, *args):
+        self._changed()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._changed()
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self._changed()
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._changed()
+        super().update(*args, **kwargs)
+
+    def clear(self):
+        self._changed()
+        super().clear()
+
+
+# Является ли получатель каналом (групповым чатом), а не пользователем.
+def is_channel(name):
+    return isinstance(name, str) and name.startswith(CHANNEL_PREFIX) and len(name) > 1
+
+
+# Имя нового вложения - 128 случайных бит, его выбирает загружающий клиент и знают только отправитель и получатели.
+def new_attachment_id():
+    return secrets.token_hex(16)
+
+
+# Закрытие отображения файла в память (mmap). Буфер транспорта asyncio может ещё ссылаться на срез
+# отображения - тогда оно закроется сборщиком мусора, когда данные будут отправлены.
+def close_mapping(mapped):
+    if mapped is None:
+        return
+    try:
+        mapped.close()
+    except BufferError:
+        pass
+
+
+# Согласование параметров потока по сообщению PRESENCE: кадры с префиксом длины, первый из предложенных
+# клиентом кодеков и первая из предложенных схем сжатия, которые есть на сервере. Возвращает поля для ответа
+# 200, старым клиентам - пустой словарь.
+def negotiate_stream(presence):
+    options = {}
+    if presence.get(FRAMING) == FRAMING_LENGTH:
+        options[FRAMING] = FRAMING_LENGTH
+        for key, offer, available in ((CODEC, CODECS_OFFER, CODECS), (COMPRESSION, COMPRESSIONS_OFFER, COMPRESSIONS)):
+            offered = presence.get(offer)
+            if isinstance(offered, list):
+                for name in offered:
+                    if isinstance(name, str) and name in available:
+                        options[key] = name
+                        break
+        if presence.get(MULTIPLEX) is True:
+            options[MULTIPLEX] = True
+    return options
+
+
+# Кадр-метка пользователя мультиплексированного подключения: следующие кадры относятся к пользователю account.
+def multiplex_tag(account):
+    name = account.encode(ENCODING)
+    return FRAME_HEADER.pack(MULTIPLEX_TAG | len(name)) + name
+
+
+# Маршрут JSON сообщения для пересылки кадра без повторного кодирования: (from, to) или None, если кадр нужно
+# разобрать полностью. Кадр пересылается получателю как есть, поэтому он должен быть одним корректным JSON объектом
+# с полями сообщения верхнего уровня, иначе ошибку при полном разборе получает отправитель, а не получатель.
+# Разбор один, без повторного кодирования - основная экономия пересылки.
+def peek_json_route(payload):
+    try:
+        message = json.loads(payload)
+    except (ValueError, RecursionError):
+        return None
+    if not isinstance(message, dict) or message.get(ACTION) != MESSAGE or TIME not in message \
+            or MESSAGE_TEXT not in message:
+        return None
+    sender, destination = message.get(SENDER), message.get(DESTINATION)
+    if not isinstance(sender, str) or not isinstance(destination, str):
+        return None
+    return sender, destination
+
+
+# Состояние потока сообщений одного соединения: согласованный формат кадров и буфер сборки принятых данных.
+# За один recv может прийти несколько сообщений или только часть сообщения, поэтому данные накапливаются
+# в буфере и из него извлекаются все полностью принятые кадры.
+# При согласованном сжатии (compression) содержимое кадра - байт флагов, заголовок маршрута и данные
+# (pack_payload), а RawMessage хранит уже распакованные данные.
+# В мультиплексированном подключении (multiplex) кадры-метки не возвращаются, tag - имя пользователя из последней
+# принятой метки (None до первой метки).
+class MessageStream:
+    __slots__ = ('framing', 'codec', 'compression', 'multiplex', 'tag', '_buffer', '_offset')
+
+    def __init__(self, framing=FRAMING_RAW, codec=DEFAULT_CODEC, compression=None):
+        self.framing = framing
+        self.codec = codec
+        self.compression = compression
+        self.multiplex = False
+        self.tag = None
+        self._buffer = bytearray()
+        self._offset = 0
+
+    # Переключение на согласованные параметры (поля framing, codec, compression и multiplex ответа на PRESENCE).
+    def configure(self, options):
+        self.framing = options.get(FRAMING, FRAMING_RAW)
+        self.codec = CODECS.get(options.get(CODEC), DEFAULT_CODEC)
+        self.compression = COMPRESSIONS.get(options.get(COMPRESSION))
+        self.multiplex = options.get(MULTIPLEX) is True
+
+    # Кодирование словаря в кадр для отправки. Принятое сообщение в том же формате не кодируется повторно.
+    def encode(self, message):
+        if isinstance(message, RawMessage) and message.payload is not None and message.wire == self.codec.wire:
+            data = message.payload
+        else:
+            data = self.codec.dumps(message)
+        if self.compression is not None:
+            data = pack_payload(data, self.compression, self.codec.wire, message_route(message))
+        return self.frame(data)
+
+    # Содержимое кадра из готовых данных в формате потока: при согласованном сжатии - флаги и данные.
+    def pack(self, data):
+        if self.compression is None:
+            return data
+        return pack_payload(data, self.compression, self.codec.wire)
+
+    # Разметка готового содержимого кадра для отправки в этот поток.
+    def frame(self, payload):
+        if self.framing == FRAMING_LENGTH:
+            return FRAME_HEADER.pack(len(payload)) + payload
+        return payload
+
+    # Частичный разбор кадра сообщения пользователю: только отправитель и получатель, текст не разбирается.
+    # Возвращает (from, to) или None, если кадр не похож на сообщение или его нужно разобрать полностью.
+    # Сжатый кадр с заголовком маршрута не распаковывается, маршрут берётся из заголовка.
+    def peek_route(self, payload):
+        if self.compression is not None:
+            try:
+                route, offset = read_route(payload)
+            except IncorrectDataRecivedError:
+                return None
+            if route is not None or payload[0] & FRAME_COMPRESSED:
+                return route
+            payload = payload[offset:]
+        if self.codec.wire != CODEC_JSON:
+            return None
+        return peek_json_route(payload)
+
+    # Декодирование содержимого кадра в словарь. Заголовок маршрута - то, по чему сервер переслал кадр,
+    # поэтому при расхождении с данными отправитель и получатель берутся из заголовка.
+    def decode(self, payload):
+        route = None
+        if self.compression is not None:
+            payload, route = unpack_payload(payload, self.compression, self.codec.wire)
+        try:
+            response = self.codec.loads(payload)
+        except ValueError:
+            raise IncorrectDataRecivedError
+        if not isinstance(response, dict):
+            raise IncorrectDataRecivedError
+        message = RawMessage(response, payload, self.codec.wire)
+        if route is not None and (message.get(SENDER), message.get(DESTINATION)) != route:
+            message[SENDER], message[DESTINATION] = route
+        return message
+
+    # Добавление принятых данных в буфер. Обработанная часть буфера отбрасывается один раз на вызов recv,
+    # а не после каждого кадра.
+    def feed(self, data):
+        if self._offset:
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer += data
+
+    # Извлечение следующего полностью принятого кадра, None если кадр ещё не принят целиком.
+    # Формат проверяется на каждом кадре, поэтому после согласования в PRESENCE остаток буфера
+    # разбирается уже в новом формате.
+    def next_frame(self):
+        if self.framing == FRAMING_LENGTH:
+            return self._next_length_frame()
+        return self._next_raw_frame()
+
+    def _next_length_frame(self):
+        buffer = self._buffer
+        while True:
+            start = self._offset + FRAME_HEADER.size
+            if len(buffer) < start:
+                return None
+            length, = FRAME_HEADER.unpack_from(buffer, self._offset)
+            if length <= MAX_FRAME_LENGTH:
+                break
+            if not self.multiplex or not length & MULTIPLEX_TAG:
+                raise IncorrectDataRecivedError
+            if not self._read_tag(start, length & ~MULTIPLEX_TAG):
+                return None
+        end = start + length
+        if len(buffer) < end:
+            return None
+        self._offset = end
+        return bytes(buffer[start:end])
+
+    # Разбор метки пользователя, False - метка ещё не принята целиком.
+    def _read_tag(self, start, length):
+        if not 0 < length <= MULTIPLEX_MAX_TAG:
+            raise IncorrectDataRecivedError
+        end = start + length
+        if len(self._buffer) < end:
+            return False
+        try:
+            self.tag = self._buffer[start:end].decode(ENCODING)
+        except UnicodeDecodeError:
+            raise IncorrectDataRecivedError
+        self._offset = end
+        return True
+
+    # Старые клиенты отправляют JSON без разметки. Границу документа находит raw_decode, неполный документ
+    # остаётся в буфере до следующего recv.
+    def _next_raw_frame(self):
+        buffer = self._buffer
+        start = self._offset
+        while start < len(buffer) and buffer[start] in _WHITESPACE:
+            start += 1
+        self._offset = start
+        if start == len(buffer):
+            return None
+        if buffer[start] != ord('{'):
+            self._discard()
+        # за документом в том же буфере могут идти двоичные кадры в согласованном формате (ответ на PRESENCE
+        # и следующие кадры отправляются одним вызовом), поэтому некорректный UTF-8 - ошибка, только если
+        # документ до него не завершён
+        invalid = False
+        try:
+            text = buffer[start:].decode(ENCODING)
+        except UnicodeDecodeError as err:
+            invalid = err.reason != 'unexpected end of data'
+            text = buffer[start:start + err.start].decode(ENCODING)
+        try:
+            _, end = _DECODER.raw_decode(text)
+        except json.JSONDecodeError:
+            if invalid or len(buffer) - start > MAX_PACKAGE_LENGTH:
+                self._discard()
+            return None
+        payload = text[:end].encode(ENCODING)
+        self._offset = start + len(payload)
+        return payload
+
+    # Некорректные данные без разметки: границу следующего сообщения найти нельзя, буфер отбрасывается.
+    def _discard(self):
+        self._offset = len(self._buffer)
+        raise IncorrectDataRecivedError
+
+
+# Чтение сокета до получения полного кадра потока, возвращает содержимое кадра без декодирования
+# (например, данные куска вложения).
+def get_frame(client, stream):
+    while True:
+        payload = stream.next_frame()
+        if payload is not None:
+            return payload
+        data = client.recv(RECV_BUFFER_SIZE)
+        if not data:
+            raise ConnectionResetError
+        stream.feed(data)
+
 
 # Утилита приёма и декодирования сообщения
 # принимает байты выдаёт словарь, если приняточто-то другое отдаёт ошибку значения
+# Если передан поток сообщений соединения, читает сокет до получения полного кадра.
 @log
-def get_message(client):
+def get_message(client, stream=None):
+    if stream is not None:
+        return stream.decode(get_frame(client, stream))
     encoded_response = client.recv(MAX_PACKAGE_LENGTH)
     if isinstance(encoded_response, bytes):
         json_response = encoded_response.decode(ENCODING)
@@ -24,10 +539,21 @@ def get_message(client):
 
 # Утилита кодирования и отправки сообщения
 # принимает словарь и отправляет его
+# Кадр в потоке сообщений соединения должен уйти целиком, поэтому в этом случае используется sendall.
 @log
-def send_message(sock, message):
+def send_message(sock, message, stream=None):
     if not isinstance(message, dict):
         raise NonDictInputError
+    if stream is not None:
+        sock.sendall(stream.encode(message))
+        return
     js_message = json.dumps(message)
     encoded_message = js_message.encode(ENCODING)
     sock.send(encoded_message)
+
+
+# Запуск сопрограммы в цикле событий asyncio, с uvloop если он установлен.
+def run_event_loop(coro):
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(coro)
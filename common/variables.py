@@ -1,3 +1,4 @@
+import os
 import logging
 
 # Порт поумолчанию для сетевого ваимодействия
@@ -5,13 +6,104 @@ DEFAULT_PORT = 7777
 # IP адрес по умолчанию для подключения клиента
 DEFAULT_IP_ADDRESS = '127.0.0.1'
 # Максимальная очередь подключений
-MAX_CONNECTIONS = 5
+MAX_CONNECTIONS = 4096
 # Максимальная длинна сообщения в байтах
 MAX_PACKAGE_LENGTH = 1024
+# Максимальная длинна кадра при передаче с префиксом длины
+MAX_FRAME_LENGTH = 1024 * 1024
+# Размер буфера для одного вызова recv, за один вызов может быть принято сразу несколько кадров
+RECV_BUFFER_SIZE = 256 * 1024
+# Границы очереди отправки одного клиента в байтах: при превышении верхней клиент считается медленным,
+# нормальная работа возобновляется после опустошения очереди до нижней
+OUT_HIGH_WATERMARK = 4 * 1024 * 1024
+OUT_LOW_WATERMARK = 1024 * 1024
+# Что делать с медленным получателем: отбрасывать новые сообщения или отключать
+SLOW_POLICY_DROP = 'drop'
+SLOW_POLICY_DISCONNECT = 'disconnect'
+# Отправка очереди подключения: не больше FLUSH_MAX_BATCH кадров за один вызов sendmsg (предел ядра - 1024
+# буфера), накопление кадров не дольше FLUSH_MAX_DELAY секунд (0 - отправка на каждой итерации цикла)
+FLUSH_MAX_BATCH = 512
+FLUSH_MAX_DELAY = 0
+# Варианты сервера: реактор на selectors или asyncio
+SERVER_MODE_REACTOR = 'reactor'
+SERVER_MODE_ASYNCIO = 'asyncio'
+# Запрашиваемый размер буферов сокета шины между рабочими процессами, предел отложенных датаграмм шины для
+# одного процесса, период повторной отправки процессу, который ещё не запущен, и наибольший размер датаграммы
+# шины (длинные сообщения делятся на части)
+BUS_BUFFER_SIZE = 4 * 1024 * 1024
+BUS_MAX_PENDING = 10000
+BUS_RETRY_INTERVAL = 0.5
+BUS_FRAGMENT_SIZE = 64 * 1024
+# Файл хранилища сообщений для пользователей не в сети, период и размер пакета записи на диск,
+# число сообщений в одной странице при отправке пользователю после регистрации
+OFFLINE_DB_FILE = 'server_offline.sqlite3'
+OFFLINE_COMMIT_INTERVAL = 0.05
+OFFLINE_COMMIT_BATCH = 1000
+OFFLINE_PAGE_SIZE = 256
+# Проверка активности подключений: после IDLE_TIMEOUT секунд без входящих данных клиенту отправляется PING,
+# если за PONG_TIMEOUT секунд от него ничего не пришло, подключение закрывается (0 - проверка выключена).
+# Клиенты без кадров длины (старые клиенты) на PING не отвечают, их подключение закрывается без PING
+# после RAW_IDLE_TIMEOUT секунд без входящих данных (0 - не закрывается).
+# Сроки отслеживает колесо таймеров из TIMER_WHEEL_SIZE ячеек по TIMER_TICK секунд.
+IDLE_TIMEOUT = 60
+PONG_TIMEOUT = 20
+RAW_IDLE_TIMEOUT = 3600
+TIMER_TICK = 1.0
+TIMER_WHEEL_SIZE = 512
+# Ограничения нагрузки (сообщений или подключений в секунду, запас): сообщения одного подключения и всех
+# подключений с одного IP адреса, новые подключения с одного IP адреса, одновременные подключения с одного
+# IP адреса. Клиент, превысивший предел, получает ответ 429, чтение его данных приостанавливается.
+RATE_LIMIT = (100, 200)
+IP_RATE_LIMIT = (1000, 2000)
+IP_ACCEPT_RATE = (20, 100)
+IP_MAX_CONNECTIONS = 256
+# Ответ 429 отправляется клиенту не чаще раза в RATE_NOTICE_INTERVAL секунд
+RATE_NOTICE_INTERVAL = 1.0
+# История сообщений: файл, период и размер пакета записи индекса, число номеров в блоке индекса,
+# число результатов поиска на странице по умолчанию и наибольшее, число слов запроса, длина слова
+HISTORY_DB_FILE = 'server_history.sqlite3'
+HISTORY_FLUSH_INTERVAL = 1.0
+HISTORY_FLUSH_BATCH = 10000
+HISTORY_BLOCK_SIZE = 1024
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE = 100
+HISTORY_MAX_TERMS = 8
+HISTORY_MAX_WORD = 64
+# Клиент без интерфейса (--headless): команды читаются порциями до HEADLESS_READ_SIZE байт, не больше
+# HEADLESS_READ_AHEAD порций ждут отправки; после конца ввода принятые сообщения выводятся ещё
+# HEADLESS_LINGER секунд. Ключи строк JSONL ввода и вывода: получатель, отправитель, текст.
+HEADLESS_READ_SIZE = 64 * 1024
+HEADLESS_READ_AHEAD = 4
+HEADLESS_LINGER = 1.0
+HEADLESS_TO = 'to'
+HEADLESS_FROM = 'from'
+HEADLESS_TEXT = 'text'
+# Вложения: каталог файлов на сервере, наибольший размер файла, размер куска при передаче, число одновременных
+# загрузок одного подключения, предел неотправленных данных в сокете при скачивании (TCP_NOTSENT_LOWAT, чтобы
+# сообщения чата не стояли в буфере ядра за файлом), срок хранения недокачанных файлов в секундах.
+# Клиент сохраняет скачанные файлы в каталог DOWNLOAD_DIR.
+ATTACHMENT_DIR = 'server_attachments'
+ATTACHMENT_MAX_SIZE = 256 * 1024 * 1024
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_MAX_UPLOADS = 4
+ATTACHMENT_NOTSENT_LOWAT = 128 * 1024
+ATTACHMENT_PART_TTL = 24 * 60 * 60
+DOWNLOAD_DIR = 'downloads'
+# Наибольшее число пользователей одного мультиплексированного подключения и длина метки пользователя в байтах
+MULTIPLEX_MAX_ACCOUNTS = 65536
+MULTIPLEX_MAX_TAG = 255
+# Списки контактов: файл базы на сервере, наибольшее число контактов пользователя. Изменения присутствия контактов
+# копятся PRESENCE_INTERVAL секунд и рассылаются пачкой, не больше PRESENCE_MAX_FANOUT доставок за раз.
+CONTACTS_DB_FILE = 'server_contacts.sqlite3'
+CONTACTS_MAX = 1000
+PRESENCE_INTERVAL = 0.2
+PRESENCE_MAX_FANOUT = 5000
 # Кодировка проекта
 ENCODING = 'utf-8'
-# Текущий уровень логирования
-LOGGING_LEVEL = logging.DEBUG
+# Текущий уровень логирования, можно переопределить переменной окружения MESSENGER_LOG_LEVEL
+# или параметром --log-level при запуске
+LOGGING_LEVEL = logging.getLevelName(os.environ.get('MESSENGER_LOG_LEVEL', 'DEBUG').upper())
+LOGGING_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
 
 # Прококол JIM основные ключи:
 ACTION = 'action'
@@ -28,13 +120,95 @@ ERROR = 'error'
 MESSAGE = 'message'
 MESSAGE_TEXT = 'mess_text'
 EXIT = 'exit'
+FRAMING = 'framing'
+CODEC = 'codec'
+CODECS_OFFER = 'codecs'
+COMPRESSION = 'compression'
+COMPRESSIONS_OFFER = 'compressions'
+MULTIPLEX = 'multiplex'
+JOIN = 'join'
+LEAVE = 'leave'
+ROOM = 'room'
+PING = 'ping'
+PONG = 'pong'
+# Поиск по истории: слова запроса, интервал времени, номер сообщения, с которого начинается страница
+# (результаты старше него), размер страницы. Ответ - список найденных сообщений с их номерами.
+SEARCH = 'search'
+QUERY = 'query'
+SINCE = 'since'
+UNTIL = 'until'
+BEFORE = 'before'
+LIMIT = 'limit'
+RESULTS = 'results'
+MESSAGE_ID = 'id'
+# Вложения: загрузка файла на сервер (upload), скачивание (download), заголовок куска данных (chunk) - следующий
+# за ним кадр содержит сами данные без кодирования и сжатия. Файл обозначается случайным именем attachment
+# (32 шестнадцатеричных символа, выбирает загружающий клиент), получатель узнаёт о файле из сообщения
+# с полями attachment, file_name и size.
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+CHUNK = 'chunk'
+ATTACHMENT = 'attachment'
+FILE_NAME = 'file_name'
+SIZE = 'size'
+OFFSET = 'offset'
+# Список контактов: добавление контакта, удаление и запрос всего списка (ответ 202). contacts - словарь имя
+# контакта - в сети ли он. Об изменениях присутствия контактов, а также о присутствии только что добавленного
+# контакта сервер сообщает сообщением status с таким же словарём, в нём только изменившиеся контакты.
+ADD_CONTACT = 'add_contact'
+DEL_CONTACT = 'del_contact'
+GET_CONTACTS = 'get_contacts'
+CONTACT = 'contact'
+CONTACTS = 'contacts'
+STATUS = 'status'
+# Имена каналов (групповых чатов) начинаются с этого символа, сообщение в канал - сообщение с to = имя канала
+CHANNEL_PREFIX = '#'
+
+# Форматы кадров, согласуемые в сообщении PRESENCE:
+# JSON документы без разметки, один за другим (старые клиенты)
+FRAMING_RAW = 'raw'
+# Каждое сообщение предваряется 4-байтовой длинной (big-endian)
+FRAMING_LENGTH = 'length'
+
+# Кодеки содержимого кадров, согласуемые в сообщении PRESENCE (только для кадров с префиксом длины):
+CODEC_JSON = 'json'
+CODEC_ORJSON = 'orjson'
+CODEC_MSGPACK = 'msgpack'
+
+# Сжатие кадров, согласуемое в сообщении PRESENCE (только для кадров с префиксом длины): zlib есть всегда,
+# zstd - при установленном пакете zstandard. Первый байт содержимого кадра - флаги: FRAME_COMPRESSED - данные
+# сжаты, FRAME_ROUTE - перед данными идёт заголовок маршрута сообщения (отправитель и получатель), по которому
+# сервер пересылает кадр, не распаковывая его. Данные короче COMPRESSION_MIN_SIZE байт не сжимаются,
+# распакованный кадр не может быть длиннее COMPRESSION_MAX_SIZE байт.
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSION_MIN_SIZE = 48
+COMPRESSION_MAX_SIZE = 4 * MAX_FRAME_LENGTH
+FRAME_COMPRESSED = 1
+FRAME_ROUTE = 2
+
+# Мультиплексированное подключение (multiplex: true в PRESENCE, только для кадров с префиксом длины): через одно
+# подключение шлюз регистрирует много пользователей, каждый - своим PRESENCE. Кадр с установленным старшим битом
+# длины - метка: остаток длины - длина имени пользователя, за ним имя в UTF-8. Метка относится ко всем следующим
+# кадрам в этом направлении до следующей метки; до первой метки кадры относятся к первому пользователю подключения.
+MULTIPLEX_TAG = 0x80000000
 
 # Словари - ответы:
 # 200
 RESPONSE_200 = {RESPONSE: 200}
+# 202
+RESPONSE_202 = {
+            RESPONSE: 202,
+            CONTACTS: None
+        }
 # 400
 RESPONSE_400 = {
             RESPONSE: 400,
             ERROR: None
         }
+# 429
+RESPONSE_429 = {
+            RESPONSE: 429,
+            ERROR: None
+        }
 
@@ -0,0 +1,142 @@
+import time
+import sqlite3
+import logging
+from common.variables import *
+
+# Инициализация логирования сервера.
+logger = logging.getLogger('server')
+
+
+# Списки контактов и подписки на присутствие. Список контактов пользователя хранится в SQLite (файл может быть общим
+# для нескольких рабочих процессов), при регистрации пользователя он загружается в подключение (client.contacts),
+# и подключение становится подписчиком присутствия своих контактов.
+# watchers - обратный индекс: имя пользователя - множество подключений, у которых он в контактах, поэтому изменение
+# присутствия рассылается без перебора подключений. online - пользователи в сети, в том числе подключённые к другим
+# рабочим процессам (по событиям шины).
+# Изменения присутствия не рассылаются сразу: они копятся interval секунд, вход и выход пользователя за это время
+# взаимно сокращаются, и каждый подписчик получает одно сообщение status со всеми изменениями своих контактов.
+# За один тик выполняется не больше max_fanout доставок (подписчик - контакт), остальное переходит на следующий тик,
+# поэтому одновременный вход тысяч пользователей после перезапуска сервера не задерживает пересылку сообщений.
+class Contacts:
+    def __init__(self, path=':memory:', interval=PRESENCE_INTERVAL, max_fanout=PRESENCE_MAX_FANOUT):
+        self.interval = interval
+        self.max_fanout = max_fanout
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS contacts '
+                        '(owner TEXT NOT NULL, contact TEXT NOT NULL, PRIMARY KEY (owner, contact)) WITHOUT ROWID')
+        self.watchers = dict()
+        self.online = set()
+        # пользователи, присутствие которых изменилось с последней рассылки (упорядоченное множество), рассылка
+        # изменения, прерванная на середине подписчиков (имя, в сети ли, оставшиеся подписчики), и время
+        # следующей рассылки
+        self.changes = dict()
+        self.cursor = None
+        self.due = 0
+
+    # Регистрация пользователя: загрузка его списка контактов, подписка и изменение его присутствия.
+    def login(self, client):
+        rows = self.db.execute('SELECT contact FROM contacts WHERE owner = ?', (client.account,)).fetchall()
+        if rows:
+            client.contacts = {contact for contact, in rows}
+            for contact in client.contacts:
+                self.watchers.setdefault(contact, set()).add(client)
+        self.changed(client.account, True)
+
+    # Отключение пользователя: подписки снимаются, список контактов остаётся в базе.
+    def logout(self, client):
+        for contact in client.contacts or ():
+            self.unwatch(client, contact)
+        client.contacts = None
+        self.changed(client.account, False)
+
+    def unwatch(self, client, contact):
+        watchers = self.watchers.get(contact)
+        if watchers is not None:
+            watchers.discard(client)
+            if not watchers:
+                del self.watchers[contact]
+
+    # Добавление контакта, False - список контактов пользователя заполнен.
+    def add(self, client, contact):
+        if client.contacts is None:
+            client.contacts = set()
+        if contact in client.contacts:
+            return True
+        if len(client.contacts) >= CONTACTS_MAX:
+            return False
+        client.contacts.add(contact)
+        self.watchers.setdefault(contact, set()).add(client)
+        try:
+            self.db.execute('INSERT OR IGNORE INTO contacts (owner, contact) VALUES (?, ?)', (client.account, contact))
+        except sqlite3.Error as err:
+            logger.error('Не удалось сохранить контакт пользователя %s: %s', client.account, err)
+        return True
+
+    def remove(self, client, contact):
+        if client.contacts:
+            client.contacts.discard(contact)
+        self.unwatch(client, contact)
+        try:
+            self.db.execute('DELETE FROM contacts WHERE owner = ? AND contact = ?', (client.account, contact))
+        except sqlite3.Error as err:
+            logger.error('Не удалось удалить контакт пользователя %s: %s', client.account, err)
+
+    # Присутствие всех контактов пользователя: имя - в сети ли он.
+    def status(self, client):
+        return {contact: contact in self.online for contact in client.contacts or ()}
+
+    # Изменение присутствия пользователя (локального или другого рабочего процесса). Повторное событие
+    # без изменения не учитывается, а возврат к разосланному состоянию до рассылки отменяет изменение.
+    def changed(self, name, online):
+        if online == (name in self.online):
+            return
+        if online:
+            self.online.add(name)
+        else:
+            self.online.discard(name)
+        if name in self.changes:
+            del self.changes[name]
+            return
+        if not self.changes and self.cursor is None:
+            self.due = time.monotonic() + self.interval
+        self.changes[name] = None
+
+    # Таймаут select() для цикла сервера: пока есть неразосланные изменения, цикл просыпается к рассылке.
+    def timeout(self):
+        if not self.changes and self.cursor is None:
+            return None
+        return max(0, self.due - time.monotonic())
+
+    # Рассылка накопленных изменений, вызывается на каждой итерации цикла сервера. Возвращает список
+    # (подключение, сообщение status) - отправляет их сервер.
+    def flush(self):
+        if not self.changes and self.cursor is None or time.monotonic() < self.due:
+            return []
+        budget = self.max_fanout
+        diffs = dict()
+        while budget > 0:
+            if self.cursor is None:
+                if not self.changes:
+                    break
+                name = next(iter(self.changes))
+                del self.changes[name]
+                if name not in self.watchers:
+                    continue
+                self.cursor = (name, name in self.online, list(self.watchers[name]))
+            name, online, watchers = self.cursor
+            batch = watchers[-budget:]
+            del watchers[-budget:]
+            budget -= len(batch)
+            for client in batch:
+                if not client.closed:
+                    diffs.setdefault(client, dict())[name] = online
+            if not watchers:
+                self.cursor = None
+        self.due = time.monotonic() + self.interval
+        now = time.time()
+        return [(client, {ACTION: STATUS, TIME: now, CONTACTS: diff}) for client, diff in diffs.items()]
+
+    def close(self):
+        self.db.close()
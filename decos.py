@@ -1,7 +1,12 @@
 import sys
+import atexit
+import signal
+import logging
+import functools
+import logging.handlers
+from queue import SimpleQueue
 import logs.config_server_log
 import logs.config_client_log
-import logging
 
 # метод определения модуля, источника запуска.
 if sys.argv[0].find('client') == -1:
@@ -12,9 +17,45 @@ else:
     logger = logging.getLogger('client')
 
 
+# Декоратор логирования вызовов. Пока уровень DEBUG выключен, обёртка только проверяет уровень (результат
+# проверки кешируется модулем logging), аргументы не форматируются. Строка собирается лениво самим logging.
 def log(func_to_log):
-    def log_saver(*args , **kwargs):
-        logger.debug(f'Была вызвана функция {func_to_log.__name__} c параметрами {args} , {kwargs}. Вызов из модуля {func_to_log.__module__}')
-        ret = func_to_log(*args , **kwargs)
-        return ret
-    return log_saver
\ No newline at end of file
+    @functools.wraps(func_to_log)
+    def log_saver(*args, **kwargs):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Была вызвана функция %s c параметрами %s , %s. Вызов из модуля %s',
+                         func_to_log.__name__, args, kwargs, func_to_log.__module__)
+        return func_to_log(*args, **kwargs)
+    return log_saver
+
+
+# Установка уровня логирования во время работы.
+def set_logging_level(level):
+    logger.setLevel(level)
+    logger.info('Уровень логирования: %s', logging.getLevelName(logger.getEffectiveLevel()))
+
+
+# Переключение DEBUG по сигналу (SIGUSR1): из DEBUG в level и обратно, без перезапуска процесса.
+def install_level_signal(level):
+    def toggle(signum, frame):
+        set_logging_level(level if logger.getEffectiveLevel() == logging.DEBUG else logging.DEBUG)
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, toggle)
+
+
+# Вынос записи логов в отдельный поток: обработчики логгера переносятся в QueueListener, а в логгере остаётся
+# QueueHandler, который только кладёт запись в очередь. Запись в файл больше не задерживает цикл событий.
+def start_queue_logging():
+    handlers = [handler for handler in logger.handlers
+                if not isinstance(handler, logging.handlers.QueueHandler)]
+    if not handlers:
+        return None
+    queue = SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(queue))
+    listener = logging.handlers.QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -26,3 +26,22 @@ class ReqFieldMissingError(Exception):
 
     def __str__(self):
         return f'В принятом словаре отсутствует обязательное поле {self.missing_field}.'
+
+
+# Исключение - клиент не забирает данные и его очередь отправки переполнена.
+class SlowConsumerError(Exception):
+    def __init__(self, address):
+        self.address = address
+
+    def __str__(self):
+        return f'Очередь отправки клиента {self.address} переполнена.'
+
+
+# Исключение - некорректная загрузка или скачивание вложения, text - причина для ответа клиенту.
+class AttachmentError(Exception):
+    def __init__(self, attachment, text):
+        self.attachment = attachment
+        self.text = text
+
+    def __str__(self):
+        return f'Вложение {self.attachment}: {self.text}'
@@ -0,0 +1,359 @@
+import re
+import time
+import queue
+import heapq
+import socket
+import sqlite3
+import logging
+import threading
+from array import array
+from bisect import bisect_right
+from collections import deque
+from itertools import accumulate, chain, islice
+from operator import sub
+from common.variables import *
+from errors import IncorrectDataRecivedError
+from common.utils import RawMessage, CODECS, unpack_payload
+
+# Инициализация логирования сервера.
+logger = logging.getLogger('server')
+
+# Слова текста сообщения для индекса, в нижнем регистре.
+_WORD = re.compile(r'\w+')
+# Служебные слова индекса - участники переписки (отправитель и получатель или канал). Символ @ не входит в \w,
+# поэтому они не пересекаются со словами текста.
+PARTICIPANT_PREFIX = '@'
+
+
+def tokenize(text):
+    return {word for word in _WORD.findall(text.lower()) if len(word) <= HISTORY_MAX_WORD}
+
+
+# Разность соседних номеров сообщений, первая - от номера previous.
+def deltas(ids, previous):
+    return array('I', map(sub, ids, chain((previous,), ids)))
+
+
+# Курсор по списку сообщений одного слова от одного процесса сервера: номера в порядке убывания, не меньше lo.
+# Список хранится блоками до HISTORY_BLOCK_SIZE номеров в разностном виде (array('I')), блок читается из базы,
+# только когда до него дошёл поиск. Ещё не записанные номера (memory) - самый новый блок.
+class PostingCursor:
+    def __init__(self, db, token, writer, lo, memory=None):
+        self.db = db
+        self.token = token
+        self.writer = writer
+        self.lo = lo
+        self.ids = memory if memory else None
+        self.first = memory[0] if memory else None
+        self.done = False
+
+    # Наибольший номер, не превышающий target, None если таких нет.
+    def seek(self, target):
+        while not self.done:
+            if self.ids is not None and self.ids[0] <= target:
+                value = self.ids[bisect_right(self.ids, target) - 1]
+                if value >= self.lo:
+                    return value
+                break
+            upper = target if self.first is None else min(target, self.first - 1)
+            row = self.db.execute('SELECT first_id, last_id, data FROM postings WHERE token = ? AND writer = ? '
+                                  'AND first_id <= ? ORDER BY first_id DESC LIMIT 1',
+                                  (self.token, self.writer, upper)).fetchone()
+            if row is None or row[1] < self.lo:
+                break
+            self.first, _, data = row
+            self.ids = [self.first + delta for delta in accumulate(array('I', data))]
+        self.done = True
+        return None
+
+
+# Объединение курсоров: наибольший номер, найденный хотя бы одним из них.
+class UnionCursor:
+    def __init__(self, cursors):
+        self.cursors = cursors
+
+    def seek(self, target):
+        found = [value for value in (cursor.seek(target) for cursor in self.cursors) if value is not None]
+        return max(found, default=None)
+
+
+# Пересечение курсоров в порядке убывания номеров, начиная с hi: курсоры перескакивают к номеру, до которого
+# дошёл самый отстающий, поэтому длинные списки частых слов читаются не целиком.
+def intersect(cursors, hi):
+    target = hi
+    while True:
+        for cursor in cursors:
+            value = cursor.seek(target)
+            if value is None:
+                return
+            if value < target:
+                target = value
+                break
+        else:
+            yield target
+            target -= 1
+
+
+# История сообщений с полнотекстовым поиском. Сообщения хранятся в SQLite таблице history, индекс - таблица
+# postings: слово - списки номеров сообщений блоками. Запись и индексация выполняются в фоновом потоке:
+# цикл сервера только кладёт сообщение (или исходные байты кадра при пересылке без разбора) в очередь.
+# Поиск выполняется тем же потоком, результат возвращается циклу сервера через read(), о готовности поток
+# сообщает байтом в socketpair (fileno() регистрируется в селекторе).
+# Номера индекса дописываются в память и записываются в базу не реже раза в flush_interval секунд; после
+# перезапуска сообщения, не попавшие в индекс, индексируются заново. Каждый рабочий процесс ведёт свои списки
+# (writer - номер процесса) в общем файле, поиск объединяет списки всех процессов.
+class History:
+    def __init__(self, path, writer=0, flush_interval=HISTORY_FLUSH_INTERVAL, flush_batch=HISTORY_FLUSH_BATCH):
+        self.path = path
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        db = self.connect()
+        db.execute('CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, writer INTEGER NOT NULL, '
+                   'sender TEXT NOT NULL, destination TEXT NOT NULL, time REAL NOT NULL, text TEXT NOT NULL)')
+        db.execute('CREATE INDEX IF NOT EXISTS history_time ON history (time)')
+        db.execute('CREATE TABLE IF NOT EXISTS postings (token TEXT NOT NULL, writer INTEGER NOT NULL, '
+                   'first_id INTEGER NOT NULL, last_id INTEGER NOT NULL, data BLOB NOT NULL, '
+                   'PRIMARY KEY (token, writer, first_id)) WITHOUT ROWID')
+        db.execute('CREATE TABLE IF NOT EXISTS indexed (writer INTEGER PRIMARY KEY, last_id INTEGER NOT NULL)')
+        db.execute('INSERT OR IGNORE INTO indexed (writer, last_id) VALUES (?, 0)', (writer,))
+        db.close()
+        self.db = None
+        # номера сообщений, ещё не записанные в postings: слово - номера по возрастанию
+        self.pending = dict()
+        self.pending_count = 0
+        self.compressions = dict()
+        self.flushed_at = time.monotonic()
+        self.queue = queue.SimpleQueue()
+        # готовые ответы на поиск (сессия, ответ) и сигнал циклу сервера
+        self.completed = deque()
+        self._wakeup, self._notify = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._notify.setblocking(False)
+        self.thread = threading.Thread(target=self.run, name='history', daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def fileno(self):
+        return self._wakeup.fileno()
+
+    # Сохранение пересланного сообщения: словарь или исходные байты кадра в формате wire, при согласованном
+    # сжатии - содержимое кадра со сжатием compression (распаковывается в фоновом потоке).
+    def record(self, message, wire=CODEC_JSON, compression=None):
+        if isinstance(message, RawMessage) and message.payload is not None:
+            message, wire = message.payload, message.wire
+        self.queue.put((message, wire, compression))
+
+    # Запрос поиска от пользователя сессии client, ответ будет получен через read().
+    def search(self, client, request):
+        self.queue.put((client, request, client.account, list(client.channels or ())))
+
+    # Готовые ответы на поиск: список (сессия, ответ). Вызывается циклом сервера по готовности fileno().
+    def read(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        results = []
+        while self.completed:
+            results.append(self.completed.popleft())
+        return results
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    # Фоновый поток: запись сообщений пачками, ответы на поиск, периодическая запись индекса.
+    def run(self):
+        self.db = self.connect()
+        self.recover()
+        closing = False
+        while not closing:
+            timeout = max(0.0, self.flushed_at + self.flush_interval - time.monotonic()) if self.pending else None
+            try:
+                items = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                items = []
+            while len(items) < self.flush_batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = []
+            for item in items:
+                if item is None:
+                    closing = True
+                elif len(item) == 3:
+                    records.append(item)
+                else:
+                    # поиск видит все сообщения, принятые до запроса
+                    self.store(records)
+                    records = []
+                    self.answer(*item)
+            self.store(records)
+            if closing or self.pending_count >= self.flush_batch or \
+                    self.pending and time.monotonic() - self.flushed_at >= self.flush_interval:
+                self.flush()
+        self.db.close()
+
+    # Запись пачки сообщений одной транзакцией и добавление их номеров в индекс в памяти. Транзакция
+    # держит блокировку записи файла, поэтому номера назначаются подряд от наибольшего, в том числе
+    # при общем файле нескольких процессов.
+    def store(self, records):
+        rows = []
+        now = time.time()
+        for message, wire, compression in records:
+            route = None
+            if isinstance(message, bytes):
+                try:
+                    if compression is not None:
+                        message, route = unpack_payload(message, self.decompressor(compression), wire)
+                    message = CODECS[wire].loads(message)
+                except (ValueError, KeyError, IncorrectDataRecivedError):
+                    continue
+            if route is not None and isinstance(message, dict):
+                message[SENDER], message[DESTINATION] = route
+            try:
+                rows.append((str(message[SENDER]), str(message[DESTINATION]), str(message[MESSAGE_TEXT])))
+            except (KeyError, TypeError):
+                continue
+        if not rows:
+            return
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            first_id = self.db.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM history').fetchone()[0]
+            self.db.executemany('INSERT INTO history (id, writer, sender, destination, time, text) '
+                                'VALUES (?, ?, ?, ?, ?, ?)',
+                                [(row_id, self.writer, sender, destination, now, text)
+                                 for row_id, (sender, destination, text) in enumerate(rows, first_id)])
+            self.db.execute('COMMIT')
+        except sqlite3.Error as err:
+            logger.error('Не удалось сохранить историю сообщений: %s', err)
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            return
+        for row_id, row in enumerate(rows, first_id):
+            self.index(row_id, *row)
+
+    # Свой экземпляр схемы сжатия для фонового потока: экземпляры потоков соединений не потокобезопасны.
+    def decompressor(self, compression):
+        instance = self.compressions.get(compression.name)
+        if instance is None:
+            instance = self.compressions[compression.name] = type(compression)()
+        return instance
+
+    def index(self, row_id, sender, destination, text):
+        tokens = tokenize(text)
+        tokens.add(PARTICIPANT_PREFIX + sender)
+        tokens.add(PARTICIPANT_PREFIX + destination)
+        for token in tokens:
+            ids = self.pending.get(token)
+            if ids is None:
+                ids = self.pending[token] = array('I')
+            ids.append(row_id)
+        self.pending_count += 1
+
+    # Запись номеров из памяти в postings: номера дописываются в последний блок слова, пока он не заполнен,
+    # остальные - новыми блоками.
+    def flush(self):
+        self.flushed_at = time.monotonic()
+        if not self.pending:
+            return
+        last_id = max(ids[-1] for ids in self.pending.values())
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for token, ids in self.pending.items():
+                start = 0
+                row = db.execute('SELECT first_id, last_id, data FROM postings WHERE token = ? AND writer = ? '
+                                 'ORDER BY first_id DESC LIMIT 1', (token, self.writer)).fetchone()
+                if row is not None and len(row[2]) < HISTORY_BLOCK_SIZE * 4:
+                    first_id, previous, data = row
+                    start = HISTORY_BLOCK_SIZE - len(data) // 4
+                    data = data + deltas(ids[:start], previous).tobytes()
+                    db.execute('UPDATE postings SET last_id = ?, data = ? WHERE token = ? AND writer = ? '
+                               'AND first_id = ?', (ids[:start][-1], data, token, self.writer, first_id))
+                for offset in range(start, len(ids), HISTORY_BLOCK_SIZE):
+                    block = ids[offset:offset + HISTORY_BLOCK_SIZE]
+                    db.execute('INSERT INTO postings (token, writer, first_id, last_id, data) VALUES (?, ?, ?, ?, ?)',
+                               (token, self.writer, block[0], block[-1], deltas(block, block[0]).tobytes()))
+            db.execute('UPDATE indexed SET last_id = ? WHERE writer = ?', (last_id, self.writer))
+            db.execute('COMMIT')
+        except sqlite3.Error as err:
+            logger.error('Не удалось записать индекс истории сообщений: %s', err)
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            return
+        logger.debug('Записан индекс истории: %s сообщений, %s слов.', self.pending_count, len(self.pending))
+        self.pending.clear()
+        self.pending_count = 0
+
+    # Индексация сообщений этого процесса, сохранённых, но не попавших в индекс до перезапуска.
+    def recover(self):
+        last_id, = self.db.execute('SELECT last_id FROM indexed WHERE writer = ?', (self.writer,)).fetchone()
+        for row in self.db.execute('SELECT id, sender, destination, text FROM history WHERE writer = ? AND id > ? '
+                                   'ORDER BY id', (self.writer, last_id)):
+            self.index(*row)
+        if self.pending:
+            logger.info('Проиндексировано сообщений истории после перезапуска: %s', self.pending_count)
+            self.flush()
+
+    # Ответ на запрос поиска: сообщения, где пользователь - отправитель или получатель или которые отправлены
+    # в его каналы, содержащие все слова запроса, в интервале времени since - until, от новых к старым,
+    # не больше limit, старше сообщения с номером before (для следующей страницы).
+    def answer(self, client, request, account, rooms):
+        try:
+            terms = sorted(tokenize(str(request.get(QUERY, ''))))[:HISTORY_MAX_TERMS]
+            since = float(request.get(SINCE) or 0)
+            until = float(request.get(UNTIL) or 0)
+            before = int(request.get(BEFORE) or 0)
+            limit = min(int(request.get(LIMIT) or HISTORY_PAGE_SIZE), HISTORY_MAX_PAGE)
+            if limit < 1:
+                raise ValueError
+        except (TypeError, ValueError):
+            response = {**RESPONSE_400, ERROR: 'Некорректные параметры поиска.'}
+        else:
+            try:
+                response = {**RESPONSE_200, RESULTS: self.find(account, rooms, terms, since, until, before, limit)}
+            except sqlite3.Error as err:
+                logger.error('Ошибка поиска в истории сообщений: %s', err)
+                response = {**RESPONSE_400, ERROR: 'Поиск недоступен.'}
+        self.completed.append((client, response))
+        try:
+            self._notify.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def find(self, account, rooms, terms, since, until, before, limit):
+        db = self.db
+        # интервал времени переводится в интервал номеров по индексу history_time
+        lo = db.execute('SELECT MIN(id) FROM history WHERE time >= ?', (since,)).fetchone()[0] if since else 1
+        hi = db.execute('SELECT MAX(id) FROM history WHERE time <= ?', (until,)).fetchone()[0] if until else \
+            db.execute('SELECT MAX(id) FROM history').fetchone()[0]
+        if before:
+            hi = min(hi or 0, before - 1)
+        if lo is None or not hi:
+            return []
+        participants = [PARTICIPANT_PREFIX + name for name in [account] + rooms]
+        streams = []
+        for writer, in db.execute('SELECT writer FROM indexed').fetchall():
+            own = writer == self.writer
+            cursors = [PostingCursor(db, token, writer, lo, self.pending.get(token) if own else None)
+                       for token in terms]
+            cursors.append(UnionCursor([PostingCursor(db, token, writer, lo, self.pending.get(token) if own
+                                                      else None) for token in participants]))
+            streams.append(intersect(cursors, hi))
+        ids = list(islice(heapq.merge(*streams, reverse=True), limit))
+        if not ids:
+            return []
+        rows = db.execute(f'SELECT id, sender, destination, time, text FROM history WHERE id IN '
+                          f'({",".join("?" * len(ids))}) ORDER BY id DESC', ids).fetchall()
+        return [{MESSAGE_ID: row_id, SENDER: sender, DESTINATION: destination, TIME: when, MESSAGE_TEXT: text}
+                for row_id, sender, destination, when, text in rows
+                if (not since or when >= since) and (not until or when <= until)]
@@ -1,18 +1,413 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import argparse
 import subprocess
+from string import Template
+from common.variables import *
+from common.utils import run_event_loop
+from benchmark import process_tree, PAGE_SIZE
+from client_async import AsyncClient
 
-process = []
-
-while True:
-    action = input('Выберите действие: q - выход , s - запустить сервер и клиенты, x - закрыть все окна:')
-
-    if action == 'q':
-        break
-    elif action == 's':
-        process.append(subprocess.Popen('python server.py', creationflags=subprocess.CREATE_NEW_CONSOLE))
-        process.append(subprocess.Popen('python client.py -n test1', creationflags=subprocess.CREATE_NEW_CONSOLE))
-        process.append(subprocess.Popen('python client.py -n test2', creationflags=subprocess.CREATE_NEW_CONSOLE))
-        process.append(subprocess.Popen('python client.py -n test3', creationflags=subprocess.CREATE_NEW_CONSOLE))
-    elif action == 'x':
-        while process:
-            victim = process.pop()
-            victim.kill()
\ No newline at end of file
+# Запуск сервера и клиентов для проверки на одной машине.
+#
+# Без параметров в Windows - прежнее меню: сервер и три интерактивных клиента в отдельных окнах.
+#
+# Режим кластера (Linux): сервер (или --workers рабочих процессов) и --clients клиентов без интерфейса
+# (client.py --headless). Готовность сервера проверяется подключением к порту, готовность клиентов - через
+# присутствие: служебные пользователи добавляют всех клиентов в контакты и ждут, пока все будут в сети. Только после
+# этого клиентам передаются команды (JSONL) через стандартный ввод. Вывод каждого процесса пишется в свой файл
+# в --log-dir, коды завершения собираются в summary.json. Процессы останавливаются в обратном порядке: сначала
+# клиенты, затем сервер.
+#
+# Команды клиента - шаблон --script (строки JSONL, как у client.py --headless), в нём подставляются $name - имя
+# клиента, $next и $prev - имена соседних клиентов, $i - номер клиента. Без шаблона каждый клиент отправляет
+# --messages сообщений следующему.
+#
+# Режим длительной проверки (--soak секунд): клиентам раз в секунду передаётся по --rate команд шаблона по кругу,
+# каждые --sample-interval секунд память (RSS) и число открытых дескрипторов сервера и клиентов записываются
+# в soak.jsonl - по ним видно, растёт ли память или число дескрипторов со временем.
+#
+# Пример: python launcher.py --clients 300 --workers 4 --soak 7200 --rate 2 -- --offline-db ''
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+CLIENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client.py')
+# Имена служебных пользователей проверки готовности клиентов
+PROBE_NAME = 'launcher-probe-'
+
+
+# Прежний режим для Windows: сервер и клиенты в отдельных окнах консоли.
+def windows_menu():
+    process = []
+
+    while True:
+        action = input('Выберите действие: q - выход , s - запустить сервер и клиенты, x - закрыть все окна:')
+
+        if action == 'q':
+            break
+        elif action == 's':
+            process.append(subprocess.Popen('python server.py', creationflags=subprocess.CREATE_NEW_CONSOLE))
+            process.append(subprocess.Popen('python client.py -n test1', creationflags=subprocess.CREATE_NEW_CONSOLE))
+            process.append(subprocess.Popen('python client.py -n test2', creationflags=subprocess.CREATE_NEW_CONSOLE))
+            process.append(subprocess.Popen('python client.py -n test3', creationflags=subprocess.CREATE_NEW_CONSOLE))
+        elif action == 'x':
+            while process:
+                victim = process.pop()
+                victim.kill()
+
+
+# Память (байт) и число открытых дескрипторов процессов pids по данным /proc. Завершившиеся процессы пропускаются.
+def process_resources(pids):
+    rss = fds = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/statm') as file:
+                rss += int(file.read().split()[1]) * PAGE_SIZE
+            fds += len(os.listdir(f'/proc/{pid}/fd'))
+        except (OSError, IndexError, ValueError):
+            pass
+    return rss, fds
+
+
+# Команды клиента number из шаблона: строки с подставленными именами.
+def client_script(template, names, number):
+    values = {'name': names[number], 'next': names[(number + 1) % len(names)], 'prev': names[number - 1],
+              'i': number}
+    return [Template(line).safe_substitute(values) for line in template]
+
+
+# Шаблон по умолчанию: messages сообщений следующему клиенту.
+def default_template(messages):
+    return [json.dumps({HEADLESS_TO: '$next', HEADLESS_TEXT: f'Сообщение {i} от $name'}, ensure_ascii=False)
+            for i in range(messages)]
+
+
+# Проверка готовности клиентов: служебные пользователи (не больше CONTACTS_MAX контактов у каждого) добавляют
+# клиентов в контакты, сервер сообщает о присутствии каждого. Возвращает множество имён, не появившихся в сети
+# за timeout секунд.
+async def wait_online(address, port, names, timeout):
+    missing = set(names)
+    probes = []
+
+    def on_status(client, changes):
+        missing.difference_update(name for name, online in changes.items() if online)
+
+    try:
+        for start in range(0, len(names), CONTACTS_MAX):
+            probe = AsyncClient(f'{PROBE_NAME}{len(probes)}', address, port, compressions=[])
+            probe.on_status = on_status
+            await probe.connect()
+            probes.append(probe)
+            for name in names[start:start + CONTACTS_MAX]:
+                probe.add_contact(name)
+            await probe.drain()
+        deadline = time.monotonic() + timeout
+        while missing and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+    finally:
+        for probe in probes:
+            await probe.close()
+    return missing
+
+
+# Процесс кластера: имя, процесс, файлы вывода.
+class Child:
+    __slots__ = ('name', 'process', 'files', 'script', 'position', 'backlog')
+
+    def __init__(self, name, process, files, script=None):
+        self.name = name
+        self.process = process
+        self.files = files
+        # команды клиента, номер следующей команды и данные, ещё не принятые каналом ввода клиента
+        self.script = script
+        self.position = 0
+        self.backlog = b''
+
+    def close_files(self):
+        for file in self.files:
+            file.close()
+
+
+# Сервер и клиенты, запущенные лаунчером. Все процессы запускаются в своих группах, поэтому Ctrl+C в терминале
+# получает только лаунчер, а он останавливает процессы по порядку.
+class Cluster:
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.log_dir = namespace.log_dir
+        self.server = None
+        self.clients = []
+        self.names = [namespace.name_format.format(i=i) for i in range(namespace.clients)]
+        self.summary = {'clients': len(self.names)}
+
+    def open_log(self, name):
+        return open(os.path.join(self.log_dir, name), 'wb')
+
+    # Запуск сервера и ожидание готовности порта. Ограничения по IP адресу выключены: все клиенты подключаются
+    # с одного адреса; параметры после -- их переопределяют.
+    def start_server(self):
+        namespace = self.namespace
+        log = self.open_log('server.log')
+        process = subprocess.Popen([sys.executable, SERVER_SCRIPT, '-p', str(namespace.port), '--mode', namespace.mode,
+                                    '--workers', str(namespace.workers), '--log-level', namespace.log_level,
+                                    '--ip-rate-limit', '0', '--ip-accept-rate', '0', '--ip-max-connections', '0']
+                                   + namespace.server_args,
+                                   stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                   start_new_session=True)
+        self.server = Child('server', process, [log])
+        started = time.monotonic()
+        deadline = started + namespace.ready_timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f'Сервер завершился с кодом {process.returncode}, см. server.log')
+            try:
+                socket.create_connection((namespace.address, namespace.port), timeout=1).close()
+                self.summary['server_ready_time'] = round(time.monotonic() - started, 3)
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError('Сервер не начал принимать подключения')
+
+    # Запуск клиентов без интерфейса. Стандартный ввод клиента остаётся открытым, команды передаются после
+    # проверки готовности.
+    def start_clients(self, template):
+        namespace = self.namespace
+        os.makedirs(os.path.join(self.log_dir, 'clients'), exist_ok=True)
+        started = time.monotonic()
+        for number, name in enumerate(self.names):
+            out = self.open_log(os.path.join('clients', f'{name}.jsonl'))
+            err = self.open_log(os.path.join('clients', f'{name}.log'))
+            process = subprocess.Popen([sys.executable, CLIENT_SCRIPT, namespace.address, str(namespace.port),
+                                        '-n', name, '--headless', '-', '--linger', str(namespace.linger),
+                                        '--log-level', namespace.log_level],
+                                       stdin=subprocess.PIPE, stdout=out, stderr=err, bufsize=0,
+                                       start_new_session=True)
+            self.clients.append(Child(name, process, [out, err], client_script(template, self.names, number)))
+        self.summary['clients_start_time'] = round(time.monotonic() - started, 3)
+
+    def wait_clients_online(self):
+        started = time.monotonic()
+        missing = run_event_loop(wait_online(self.namespace.address, self.namespace.port, self.names,
+                                             self.namespace.ready_timeout))
+        self.summary['clients_ready_time'] = round(time.monotonic() - started, 3)
+        self.summary['not_ready'] = sorted(missing)
+        if missing:
+            print(f'Не подключились за {self.namespace.ready_timeout} с: {len(missing)} клиентов', file=sys.stderr)
+
+    # Передача всех команд клиентам.
+    def run_scripts(self):
+        for child in self.clients:
+            data = memoryview(''.join(line + '\n' for line in child.script).encode(ENCODING))
+            try:
+                while data:
+                    data = data[os.write(child.process.stdin.fileno(), data):]
+            except OSError:
+                pass
+
+    # Закрытие ввода клиентов и ожидание их завершения: клиент отправит оставшиеся команды и завершится
+    # через --linger секунд.
+    def wait_clients(self):
+        for child in self.clients:
+            try:
+                child.process.stdin.close()
+            except OSError:
+                pass
+        started = time.monotonic()
+        deadline = started + self.namespace.timeout
+        for child in self.clients:
+            try:
+                child.process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                pass
+        self.summary['clients_exit_time'] = round(time.monotonic() - started, 3)
+
+    # Длительная проверка: команды по кругу с заданной частотой, замеры ресурсов в soak.jsonl.
+    def soak(self):
+        namespace = self.namespace
+        for child in self.clients:
+            os.set_blocking(child.process.stdin.fileno(), False)
+        started = time.monotonic()
+        samples = []
+        next_sample = started
+        with open(os.path.join(self.log_dir, 'soak.jsonl'), 'w') as output:
+            def record():
+                sample = self.sample(started)
+                samples.append(sample)
+                output.write(json.dumps(sample) + '\n')
+                output.flush()
+                print(f'{sample["elapsed"]:.0f} с: сервер {sample["server_rss"] // 1024} КБ, '
+                      f'{sample["server_fds"]} дескрипторов; клиентов {sample["clients_alive"]}', file=sys.stderr)
+
+            while time.monotonic() - started < namespace.soak:
+                if self.server.process.poll() is not None:
+                    print(f'Сервер завершился с кодом {self.server.process.returncode}', file=sys.stderr)
+                    break
+                self.feed()
+                if time.monotonic() >= next_sample:
+                    record()
+                    next_sample += namespace.sample_interval
+                time.sleep(max(0, 1 - (time.monotonic() - started) % 1))
+            else:
+                # замер в конце прогона, чтобы рост памяти считался за всё время
+                record()
+        if samples:
+            first, last = samples[0], samples[-1]
+            self.summary['soak'] = {
+                'duration': last['elapsed'],
+                'samples': len(samples),
+                'server_rss_first': first['server_rss'],
+                'server_rss_last': last['server_rss'],
+                'server_rss_max': max(sample['server_rss'] for sample in samples),
+                'server_fds_first': first['server_fds'],
+                'server_fds_last': last['server_fds'],
+                'clients_rss_last': last['clients_rss'],
+                'clients_alive_last': last['clients_alive'],
+            }
+
+    # Очередные --rate команд каждому клиенту. Ввод клиентов неблокирующий: пока клиент не дочитал прошлые
+    # команды, новые ему не передаются, и медленный клиент не задерживает остальных.
+    def feed(self):
+        for child in self.clients:
+            if not child.script or child.process.poll() is not None:
+                continue
+            if not child.backlog:
+                lines = [child.script[(child.position + i) % len(child.script)] for i in range(self.namespace.rate)]
+                child.position += len(lines)
+                child.backlog = ''.join(line + '\n' for line in lines).encode(ENCODING)
+            try:
+                child.backlog = child.backlog[os.write(child.process.stdin.fileno(), child.backlog):]
+            except BlockingIOError:
+                pass
+            except OSError:
+                child.backlog = b''
+
+    def sample(self, started):
+        server = process_tree(self.server.process.pid)
+        server_rss, server_fds = process_resources(server)
+        alive = [child.process.pid for child in self.clients if child.process.poll() is None]
+        clients_rss, clients_fds = process_resources(alive)
+        return {
+            'time': time.time(),
+            'elapsed': round(time.monotonic() - started, 1),
+            'server_processes': len(server),
+            'server_rss': server_rss,
+            'server_fds': server_fds,
+            'clients_alive': len(alive),
+            'clients_rss': clients_rss,
+            'clients_fds': clients_fds,
+        }
+
+    # Остановка процессов: клиенты, затем сервер. Сначала SIGTERM, через 5 секунд - SIGKILL. Коды завершения
+    # клиентов, завершившихся сами, сохраняются до остановки остальных.
+    def teardown(self):
+        exit_codes = {child.name: child.process.poll() for child in self.clients}
+        stop_processes([child.process for child in self.clients])
+        if self.server is not None:
+            # сервер, завершившийся до остановки кластера, - ошибка проверки
+            self.summary['server_exited'] = self.server.process.poll() is not None
+            stop_processes([self.server.process])
+            self.summary['server_exit_code'] = self.server.process.returncode
+        for child in self.clients + ([self.server] if self.server is not None else []):
+            child.close_files()
+        counts = {}
+        for code in exit_codes.values():
+            counts[str(code)] = counts.get(str(code), 0) + 1
+        self.summary['exit_codes'] = counts
+        self.summary['failed'] = sorted(name for name, code in exit_codes.items() if code != 0)
+        return exit_codes
+
+
+# Остановка процессов: SIGTERM всем, ожидание, затем SIGKILL оставшимся.
+def stop_processes(processes, timeout=5):
+    running = [process for process in processes if process.poll() is None]
+    for process in running:
+        try:
+            process.terminate()
+        except OSError:
+            pass
+    deadline = time.monotonic() + timeout
+    for process in running:
+        try:
+            process.wait(max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Запуск сервера и клиентов мессенджера для проверки на одной машине.')
+    parser.add_argument('--clients', default=3, type=int, help='число клиентов без интерфейса')
+    parser.add_argument('--name-format', default='user{i}', help='имена клиентов, {i} - номер клиента')
+    parser.add_argument('--address', default=DEFAULT_IP_ADDRESS)
+    parser.add_argument('--port', default=DEFAULT_PORT, type=int)
+    parser.add_argument('--workers', default=1, type=int, help='рабочих процессов сервера')
+    parser.add_argument('--mode', default=SERVER_MODE_REACTOR, choices=(SERVER_MODE_REACTOR, SERVER_MODE_ASYNCIO))
+    parser.add_argument('--script', default=None, help='шаблон команд клиента (JSONL), $name, $next, $prev, $i')
+    parser.add_argument('--messages', default=10, type=int, help='сообщений от клиента без шаблона')
+    parser.add_argument('--log-dir', default='launcher_logs', help='каталог для вывода процессов и итогов')
+    parser.add_argument('--log-level', default='WARNING', choices=LOGGING_LEVELS)
+    parser.add_argument('--ready-timeout', default=60, type=float, help='ожидание готовности, секунд')
+    parser.add_argument('--timeout', default=60, type=float, help='ожидание завершения клиентов, секунд')
+    parser.add_argument('--linger', default=HEADLESS_LINGER, type=float, help='приём после отправки команд, секунд')
+    parser.add_argument('--soak', default=0, type=float, help='длительная проверка, секунд')
+    parser.add_argument('--rate', default=1, type=int, help='команд в секунду на клиента при --soak')
+    parser.add_argument('--sample-interval', default=10, type=float, help='период замеров при --soak, секунд')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER, help='параметры сервера после --')
+    namespace = parser.parse_args(sys.argv[1:])
+    if namespace.server_args[:1] == ['--']:
+        namespace.server_args = namespace.server_args[1:]
+    if namespace.clients < 1 or namespace.rate < 1 or namespace.sample_interval <= 0:
+        parser.error('--clients и --rate должны быть не меньше 1, --sample-interval больше 0')
+    return namespace
+
+
+def main():
+    if os.name == 'nt' and len(sys.argv) == 1:
+        windows_menu()
+        return
+    namespace = arg_parser()
+    cluster = Cluster(namespace)
+    if len(set(cluster.names)) != namespace.clients:
+        print('Имена клиентов повторяются: в --name-format нужен {i}.', file=sys.stderr)
+        exit(2)
+    if namespace.script:
+        with open(namespace.script, encoding=ENCODING) as file:
+            template = [line.rstrip('\n') for line in file if line.strip()]
+    else:
+        template = default_template(namespace.messages)
+    os.makedirs(namespace.log_dir, exist_ok=True)
+
+    # SIGTERM лаунчеру останавливает кластер так же, как Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    started = time.monotonic()
+    error = None
+    try:
+        cluster.start_server()
+        cluster.start_clients(template)
+        cluster.wait_clients_online()
+        if namespace.soak:
+            cluster.soak()
+        else:
+            cluster.run_scripts()
+        cluster.wait_clients()
+    except KeyboardInterrupt:
+        error = 'Прервано'
+    except (RuntimeError, OSError) as err:
+        error = str(err)
+    finally:
+        cluster.teardown()
+    cluster.summary['elapsed'] = round(time.monotonic() - started, 3)
+    if error:
+        cluster.summary['error'] = error
+    with open(os.path.join(namespace.log_dir, 'summary.json'), 'w') as file:
+        json.dump(cluster.summary, file, indent=2, ensure_ascii=False)
+    print(json.dumps(cluster.summary, ensure_ascii=False))
+    exit(0 if not error and not cluster.summary['failed'] and not cluster.summary.get('not_ready')
+         and not cluster.summary.get('server_exited') else 1)
+
+
+if __name__ == '__main__':
+    main()
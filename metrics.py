@@ -0,0 +1,209 @@
+import os
+import sys
+import time
+import signal
+import logging
+import cProfile
+import pstats
+import io
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Инициализация логирования сервера.
+logger = logging.getLogger('server')
+
+# Этапы обработки, время которых измеряется: приём данных, разбор кадра, обработка сообщения клиента,
+# маршрутизация очереди сообщений, отправка. loop - длительность итерации цикла событий (реактор)
+# или запаздывание цикла событий (asyncio).
+STAGE_RECV = 'recv'
+STAGE_PARSE = 'parse'
+STAGE_PROCESS = 'process'
+STAGE_ROUTE = 'route'
+STAGE_SEND = 'send'
+STAGE_LOOP = 'loop'
+STAGES = (STAGE_RECV, STAGE_PARSE, STAGE_PROCESS, STAGE_ROUTE, STAGE_SEND, STAGE_LOOP)
+
+# Счётчики сервера и их описания для Prometheus.
+COUNTERS = {
+    'connections_total': 'Принято подключений',
+    'disconnects_total': 'Отключено клиентов',
+    'messages_in_total': 'Принято кадров',
+    'messages_out_total': 'Отправлено кадров',
+    'relayed_total': 'Сообщений переслано без разбора',
+    'bytes_in_total': 'Принято байт',
+    'bytes_out_total': 'Отправлено байт',
+    'decode_errors_total': 'Ошибок разбора кадров',
+    'dropped_total': 'Кадров отброшено из-за медленных получателей',
+    'idle_evicted_total': 'Отключено клиентов, не ответивших на проверку связи',
+    'rate_limited_total': 'Приостановок чтения из-за превышения частоты сообщений',
+    'rejected_total': 'Отклонено подключений из-за ограничений по IP адресу',
+}
+
+
+# Накопленное время одного этапа: число замеров, сумма и максимум в наносекундах.
+class Stage:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+
+# Метрики сервера. Счётчики - обычные атрибуты, изменяются только потоком цикла событий (простое += под GIL),
+# поток экспорта их только читает. Замеры времени этапов включаются флагом timing, без него на горячем пути
+# остаются только увеличения счётчиков. gauges - функция сервера, возвращающая текущие значения (число
+# подключений, объём очередей отправки и т.п.), вызывается при экспорте.
+class ServerMetrics:
+    def __init__(self):
+        for name in COUNTERS:
+            setattr(self, name, 0)
+        self.timing = False
+        self.stages = {name: Stage() for name in STAGES}
+        self.gauges = None
+        self.started = time.time()
+        self.profiler = None
+
+    # Замер этапа от момента started до текущего, возвращает текущий момент - начало следующего этапа.
+    def observe(self, stage, started):
+        now = time.perf_counter_ns()
+        self.stages[stage].add(now - started)
+        return now
+
+    def snapshot(self):
+        counters = {name: getattr(self, name) for name in COUNTERS}
+        gauges = self.gauges() if self.gauges is not None else {}
+        return counters, gauges
+
+    # Текст метрик в формате Prometheus.
+    def render(self):
+        counters, gauges = self.snapshot()
+        lines = []
+        for name, value in counters.items():
+            lines.append(f'# HELP messenger_{name} {COUNTERS[name]}')
+            lines.append(f'# TYPE messenger_{name} counter')
+            lines.append(f'messenger_{name} {value}')
+        for name, value in gauges.items():
+            lines.append(f'# TYPE messenger_{name} gauge')
+            lines.append(f'messenger_{name} {value}')
+        if self.timing:
+            lines.append('# TYPE messenger_stage_seconds summary')
+            for name, stage in self.stages.items():
+                lines.append(f'messenger_stage_seconds_count{{stage="{name}"}} {stage.count}')
+                lines.append(f'messenger_stage_seconds_sum{{stage="{name}"}} {stage.total / 1e9}')
+            lines.append('# TYPE messenger_stage_seconds_max gauge')
+            for name, stage in self.stages.items():
+                lines.append(f'messenger_stage_seconds_max{{stage="{name}"}} {stage.max / 1e9}')
+        lines.append('# TYPE messenger_start_time_seconds gauge')
+        lines.append(f'messenger_start_time_seconds {self.started}')
+        return '\n'.join(lines) + '\n'
+
+    # Включение и выключение профилирования cProfile (по сигналу SIGUSR2). При выключении результат
+    # сохраняется в файл, 20 самых затратных функций выводятся в журнал.
+    def toggle_profile(self, signum=None, frame=None):
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            logger.warning('Профилирование включено, повторный сигнал сохранит результат.')
+            return
+        self.profiler.disable()
+        path = f'server-{os.getpid()}-{int(time.time())}.prof'
+        self.profiler.dump_stats(path)
+        output = io.StringIO()
+        pstats.Stats(self.profiler, stream=output).sort_stats('cumulative').print_stats(20)
+        self.profiler = None
+        logger.warning('Профилирование выключено, результат сохранён в %s\n%s', path, output.getvalue())
+
+
+# Метрики этого процесса сервера.
+server_metrics = ServerMetrics()
+
+
+# Снимок стеков потока thread_id выборками раз в interval секунд в течение seconds секунд. Результат - стеки
+# в свёрнутом формате (функции через ';' и число попаданий), по нему строится flame graph.
+def sample_stacks(thread_id, seconds, interval=0.001):
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+            frame = frame.f_back
+        if stack:
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
+
+
+# HTTP обработчик: /metrics - метрики Prometheus, /profile?seconds=N - снимок стеков основного потока.
+class MetricsHandler(BaseHTTPRequestHandler):
+    main_thread_id = threading.main_thread().ident
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            body = server_metrics.render()
+        elif url.path == '/profile':
+            try:
+                seconds = min(60.0, float(parse_qs(url.query).get('seconds', ['5'])[0]))
+            except ValueError:
+                self.send_error(400)
+                return
+            body = sample_stacks(self.main_thread_id, seconds)
+        else:
+            self.send_error(404)
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug('Запрос метрик %s: ' + format, self.address_string(), *args)
+
+
+# Периодическая строка статистики в журнале: скорость приёма и отправки за интервал и текущие значения.
+def report_stats(interval):
+    previous, _ = server_metrics.snapshot()
+    while True:
+        time.sleep(interval)
+        counters, gauges = server_metrics.snapshot()
+        logger.info(
+            'Статистика: принято %.0f сообщ./с, отправлено %.0f сообщ./с, %.0f/%.0f байт/с, ошибок разбора %s, '
+            'отброшено %s, %s',
+            (counters['messages_in_total'] - previous['messages_in_total']) / interval,
+            (counters['messages_out_total'] - previous['messages_out_total']) / interval,
+            (counters['bytes_in_total'] - previous['bytes_in_total']) / interval,
+            (counters['bytes_out_total'] - previous['bytes_out_total']) / interval,
+            counters['decode_errors_total'], counters['dropped_total'],
+            ', '.join(f'{name} {value}' for name, value in gauges.items()))
+        previous = counters
+
+
+# Запуск экспорта метрик: HTTP на 127.0.0.1:port и/или строка статистики раз в stats_interval секунд,
+# оба в фоновых потоках. Замеры времени этапов включаются, если включён хотя бы один способ экспорта.
+# Профилирование по SIGUSR2 доступно всегда.
+def start_metrics(gauges, port=None, stats_interval=0):
+    server_metrics.gauges = gauges
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, server_metrics.toggle_profile)
+    if port:
+        httpd = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+        logger.info('Метрики доступны по адресу http://127.0.0.1:%s/metrics', port)
+    if stats_interval:
+        threading.Thread(target=report_stats, args=(stats_interval,), name='stats', daemon=True).start()
+    server_metrics.timing = bool(port or stats_interval)
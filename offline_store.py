@@ -0,0 +1,107 @@
+import time
+import sqlite3
+import logging
+from common.variables import *
+from common.utils import RawMessage, DEFAULT_CODEC
+
+# Инициализация логирования сервера.
+logger = logging.getLogger('server')
+
+
+# Хранилище сообщений для пользователей, не подключённых к серверу. Сообщения лежат в SQLite таблице
+# с индексом по получателю, хранится исходный JSON кадра. Запись пакетная: сообщения копятся в памяти
+# и записываются одной транзакцией (один fsync) не реже раза в OFFLINE_COMMIT_INTERVAL секунд или
+# по набору OFFLINE_COMMIT_BATCH сообщений. Транзакция короткая, поэтому файл может быть общим для
+# нескольких рабочих процессов сервера.
+class OfflineStore:
+    def __init__(self, path, commit_interval=OFFLINE_COMMIT_INTERVAL, commit_batch=OFFLINE_COMMIT_BATCH):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS messages '
+                        '(id INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT NOT NULL, data BLOB NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, id)')
+        # сообщения, ещё не записанные на диск, и время первого из них
+        self.buffer = []
+        self.buffered_at = None
+        # подключения, которым сейчас отправляются сохранённые сообщения
+        self.replaying = set()
+
+    # Сохранение сообщения для получателя. Принятое JSON сообщение хранится исходными байтами кадра.
+    def append(self, recipient, message):
+        if isinstance(message, RawMessage) and message.payload is not None and message.wire == CODEC_JSON:
+            data = message.payload
+        else:
+            data = DEFAULT_CODEC.dumps(message)
+        if not self.buffer:
+            self.buffered_at = time.monotonic()
+        self.buffer.append((recipient, data))
+        if len(self.buffer) >= self.commit_batch:
+            self.commit()
+
+    # Таймаут select() для цикла сервера: пока есть незаписанные сообщения, цикл не засыпает надолго.
+    def timeout(self):
+        if not self.buffer:
+            return None
+        return max(0, self.buffered_at + self.commit_interval - time.monotonic())
+
+    # Запись накопленных сообщений, вызывается на каждой итерации цикла сервера.
+    def flush(self):
+        if self.buffer and time.monotonic() - self.buffered_at >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        if not self.buffer:
+            return
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.executemany('INSERT INTO messages (recipient, data) VALUES (?, ?)', self.buffer)
+            self.db.execute('COMMIT')
+        except sqlite3.Error as err:
+            logger.error('Не удалось сохранить сообщения для отложенной доставки: %s', err)
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            return
+        logger.debug('Сохранено сообщений для отложенной доставки: %s', len(self.buffer))
+        self.buffer.clear()
+
+    # Есть ли сообщения для пользователя (проверяется при регистрации).
+    def has_messages(self, recipient):
+        self.commit()
+        return self.db.execute('SELECT 1 FROM messages WHERE recipient = ? LIMIT 1', (recipient,)).fetchone() \
+            is not None
+
+    # Очередная страница сообщений пользователя после сообщения с номером after_id: список (номер, данные).
+    def fetch(self, recipient, after_id, limit=OFFLINE_PAGE_SIZE):
+        self.commit()
+        return self.db.execute('SELECT id, data FROM messages WHERE recipient = ? AND id > ? ORDER BY id LIMIT ?',
+                               (recipient, after_id, limit)).fetchall()
+
+    # Удаление доставленных сообщений пользователя с номерами до upto_id включительно.
+    def delete(self, recipient, upto_id):
+        if upto_id:
+            self.db.execute('DELETE FROM messages WHERE recipient = ? AND id <= ?', (recipient, upto_id))
+
+    # Начало отправки сохранённых сообщений подключению (после регистрации пользователя).
+    def start_replay(self, client):
+        client.replay_after = 0
+        self.replaying.add(client)
+
+    def finish_replay(self, client):
+        client.replay_after = None
+        self.replaying.discard(client)
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+# Кадр сохранённого сообщения для потока получателя. Получателю с JSON форматом хранимые байты уходят как есть
+# (при согласованном сжатии - сжатыми).
+def stored_frame(stream, data):
+    if stream.codec.wire == CODEC_JSON:
+        return stream.frame(stream.pack(data))
+    return stream.encode(DEFAULT_CODEC.loads(data))
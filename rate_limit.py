@@ -0,0 +1,113 @@
+from collections import OrderedDict
+
+
+# Ведро токенов: rate токенов в секунду, не больше burst накопленных. Токены пересчитываются при обращении,
+# без таймеров.
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    # Взять один токен. Возвращает 0, если токен взят, иначе время в секундах до появления токена.
+    def take(self, now):
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return 0
+        self.tokens = tokens
+        return (1 - tokens) / self.rate
+
+
+# Состояние одного IP адреса: число подключений, ведро сообщений и ведро новых подключений.
+class IpState:
+    __slots__ = ('connections', 'messages', 'accepts')
+
+    def __init__(self):
+        self.connections = 0
+        self.messages = None
+        self.accepts = None
+
+
+# Ограничения нагрузки: сообщений в секунду на подключение и на IP адрес, новых подключений в секунду
+# и одновременных подключений с одного IP адреса. Пределы задаются парами (rate, burst), rate = 0 выключает
+# ограничение. Состояние IP адреса без подключений хранится, пока не наполнятся его вёдра (иначе частые
+# переподключения обходили бы предел), затем удаляется - память ограничена активными адресами.
+class RateLimits:
+    def __init__(self, message_rate=(0, 0), ip_message_rate=(0, 0), ip_accept_rate=(0, 0), ip_max_connections=0):
+        self.message_rate = message_rate
+        self.ip_message_rate = ip_message_rate
+        self.ip_accept_rate = ip_accept_rate
+        self.ip_max_connections = ip_max_connections
+        self.ips = dict()
+        # адреса без подключений в порядке освобождения: адрес - время, после которого его можно забыть
+        # (время наполнения самого медленного ведра)
+        self.released = OrderedDict()
+        self.retain = max([burst / rate for rate, burst in (ip_message_rate, ip_accept_rate) if rate], default=0)
+
+    # Регистрация нового подключения с адреса ip. Возвращает текст ошибки, если подключение нужно отклонить.
+    def accept(self, ip, now):
+        state = self.ips.get(ip)
+        if state is None:
+            state = self.ips[ip] = IpState()
+        self.released.pop(ip, None)
+        if self.ip_max_connections and state.connections >= self.ip_max_connections:
+            self.release_state(ip, state, now)
+            return 'Превышено число подключений с адреса.'
+        if self.ip_accept_rate[0]:
+            if state.accepts is None:
+                state.accepts = TokenBucket(*self.ip_accept_rate, now)
+            if state.accepts.take(now):
+                self.release_state(ip, state, now)
+                return 'Превышена частота подключений с адреса.'
+        state.connections += 1
+        return None
+
+    # Ведро сообщений для нового подключения, None если ограничения нет.
+    def session_bucket(self, now):
+        if not self.message_rate[0]:
+            return None
+        return TokenBucket(*self.message_rate, now)
+
+    # Проверка очередного сообщения подключения с ведром bucket с адреса ip. Возвращает 0, если сообщение можно
+    # обработать, иначе время в секундах, на которое нужно приостановить чтение.
+    def take(self, bucket, ip, now):
+        wait = bucket.take(now) if bucket is not None else 0
+        if wait or not self.ip_message_rate[0]:
+            return wait
+        state = self.ips.get(ip)
+        if state is None:
+            return 0
+        if state.messages is None:
+            state.messages = TokenBucket(*self.ip_message_rate, now)
+        wait = state.messages.take(now)
+        # токен подключения возвращается, сообщение будет проверено снова после паузы
+        if wait and bucket is not None:
+            bucket.tokens += 1
+        return wait
+
+    # Закрытие подключения с адреса ip.
+    def release(self, ip, now):
+        state = self.ips.get(ip)
+        if state is None:
+            return
+        state.connections -= 1
+        self.release_state(ip, state, now)
+
+    def release_state(self, ip, state, now):
+        if not state.connections:
+            self.released[ip] = now + self.retain
+
+    # Удаление состояния адресов, освободившихся достаточно давно, вызывается на каждой итерации цикла сервера.
+    def prune(self, now):
+        released = self.released
+        while released:
+            ip, expires = next(iter(released.items()))
+            if expires > now:
+                return
+            del released[ip]
+            del self.ips[ip]
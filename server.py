@@ -1,15 +1,28 @@
 import socket
 import sys
 import argparse
-import json
 import logging
-import select
+import selectors
+import signal
+import os
 import time
+import heapq
+from collections import deque
+from itertools import islice, takewhile
 import logs.config_server_log
-from errors import IncorrectDataRecivedError
+from errors import IncorrectDataRecivedError, SlowConsumerError, AttachmentError
 from common.variables import *
 from common.utils import *
-from decos import log
+from decos import log, set_logging_level, install_level_signal, start_queue_logging
+from cluster import WorkerBus, supervise_workers
+from offline_store import OfflineStore, stored_frame
+from timer_wheel import TimerWheel
+from rate_limit import RateLimits
+from history import History
+from attachments import AttachmentSpool, attachment_message, limit_unsent
+from contacts import Contacts
+from metrics import server_metrics, start_metrics, STAGE_RECV, STAGE_PARSE, STAGE_PROCESS, STAGE_ROUTE, \
+    STAGE_SEND, STAGE_LOOP
 
 # Инициализация логирования сервера.
 logger = logging.getLogger('server')
@@ -17,53 +30,321 @@ logger = logging.getLogger('server')
 
 # Обработчик сообщений от клиентов, принимает словарь - сообщение от клиента, проверяет корректность, отправляет
 #     словарь-ответ в случае необходимости.
+#     При работе в несколько процессов bus - шина между ними: имя проверяется и в реестре других процессов.
+#     store - хранилище сообщений для пользователей не в сети, после регистрации начинается отправка сохранённых.
+#     channels - индекс участников каналов: имя канала - множество подключений.
+#     spool - хранилище вложений: загрузка и скачивание файлов.
+#     contacts - списки контактов и подписки на присутствие.
+#     client - подключение или пользователь мультиплексированного подключения (SubSession).
+#     Отключаемый клиент (занятое имя, выход) только закрывается, индексы сервера освобождает его цикл.
 @log
-def process_client_message(message, messages_list, client, clients, names):
-    logger.debug(f'Разбор сообщения от клиента : {message}')
+def process_client_message(message, messages_list, client, names, bus=None, store=None, channels=None,
+                           history=None, spool=None, contacts=None):
+    logger.debug('Разбор сообщения от клиента : %s', message)
     # Если это сообщение о присутствии, принимаем и отвечаем
-    if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
+    if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message \
+            and client.account is None:
+        # Имя пользователя - непустая строка, имена каналов пользователям не выдаются: по имени проверяется
+        # доступ к сообщениям и вложениям канала. Пользователь мультиплексированного подключения регистрируется
+        # под именем из своей метки.
+        account = message[USER].get(ACCOUNT_NAME) if isinstance(message[USER], dict) else None
+        if not isinstance(account, str) or not account or is_channel(account) \
+                or type(client) is SubSession and account != client.name:
+            send_message(client, {**RESPONSE_400, ERROR: 'Некорректное имя пользователя.'}, client.stream)
+            client.close()
+            return
         # Если такой пользователь ещё не зарегистрирован, регистрируем, иначе отправляем ответ и завершаем соединение.
-        if message[USER][ACCOUNT_NAME] not in names.keys():
+        if message[USER][ACCOUNT_NAME] not in names.keys() and \
+                (bus is None or message[USER][ACCOUNT_NAME] not in bus.remote_names):
             names[message[USER][ACCOUNT_NAME]] = client
-            send_message(client, RESPONSE_200)
+            client.account = message[USER][ACCOUNT_NAME]
+            if bus is not None:
+                bus.publish_online(client.account)
+            # Клиент может запросить кадры с префиксом длины и кодек. Ответ уходит ещё в старом формате,
+            # после него поток соединения переключается. Старые клиенты продолжают работать без разметки.
+            # Формат согласуется один раз: следующие пользователи мультиплексированного подключения
+            # регистрируются в уже согласованном потоке.
+            options = negotiate_stream(message) if client.stream.framing == FRAMING_RAW else {}
+            send_message(client, {**RESPONSE_200, **options}, client.stream)
+            if options:
+                client.stream.configure(options)
+            if store is not None and store.has_messages(client.account):
+                store.start_replay(client)
+            if contacts is not None:
+                contacts.login(client)
         else:
             response = RESPONSE_400
             response[ERROR] = 'Имя пользователя уже занято.'
-            send_message(client, response)
-            clients.remove(client)
+            send_message(client, response, client.stream)
             client.close()
         return
     # Если это сообщение, то добавляем его в очередь сообщений. Ответ не требуется.
     elif ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message and TIME in message \
             and SENDER in message and MESSAGE_TEXT in message:
+        # отправитель - пользователь этого подключения, как и при быстрой пересылке (relay_frame)
+        if message[SENDER] != client.account:
+            send_message(client, {**RESPONSE_400, ERROR: 'Отправитель не совпадает с пользователем подключения.'},
+                         client.stream)
+            return
+        # писать в канал могут только его участники
+        if is_channel(message[DESTINATION]) and message[DESTINATION] not in (client.channels or ()):
+            send_message(client, {**RESPONSE_400, ERROR: 'Пользователь не состоит в канале.'}, client.stream)
+            return
         messages_list.append(message)
+        if history is not None:
+            history.record(message)
+        return
+    # Вход в канал и выход из канала. Ответ не требуется.
+    elif ACTION in message and message[ACTION] in (JOIN, LEAVE) and ROOM in message and is_channel(message[ROOM]) \
+            and client.account is not None and channels is not None:
+        if message[ACTION] == JOIN:
+            join_channel(channels, client, message[ROOM])
+        else:
+            leave_channel(channels, client, message[ROOM])
+        logger.info('Пользователь %s: %s %s', client.account, message[ACTION], message[ROOM])
+        return
+    # Поиск по истории сообщений пользователя выполняется в фоновом потоке истории, ответ сервер отправит,
+    # когда он будет готов.
+    elif ACTION in message and message[ACTION] == SEARCH and client.account is not None and history is not None:
+        history.search(client, message)
+        return
+    # Вложения: начало загрузки файла, заголовок куска (следующий кадр - данные куска, их принимает
+    # receive_chunk) и запрос скачивания. Файлы передаются только в кадрах с префиксом длины.
+    elif ACTION in message and message[ACTION] in (UPLOAD, CHUNK, DOWNLOAD) and client.account is not None \
+            and spool is not None and client.stream.framing == FRAMING_LENGTH:
+        try:
+            if message[ACTION] == UPLOAD:
+                spool.upload(client, message)
+            elif message[ACTION] == CHUNK:
+                spool.chunk(client, message)
+            else:
+                meta = spool.download(client, message)
+                send_message(client, {**RESPONSE_200, ATTACHMENT: meta[ATTACHMENT], FILE_NAME: meta[FILE_NAME],
+                                      SIZE: meta[SIZE]}, client.stream)
+                client.start_download()
+        except AttachmentError as err:
+            logger.info('Пользователь %s: %s', client.account, err)
+            send_message(client, {**RESPONSE_400, ERROR: err.text, ATTACHMENT: err.attachment}, client.stream)
+        return
+    # Список контактов: добавление контакта (в ответ - status с его присутствием), удаление (ответ не требуется)
+    # и запрос всего списка (ответ 202). Об изменениях присутствия контактов сервер сообщает сам (Contacts.flush).
+    elif ACTION in message and message[ACTION] in (ADD_CONTACT, DEL_CONTACT, GET_CONTACTS) \
+            and client.account is not None and contacts is not None:
+        if message[ACTION] == GET_CONTACTS:
+            send_message(client, {**RESPONSE_202, CONTACTS: contacts.status(client)}, client.stream)
+            return
+        contact = message.get(CONTACT)
+        if not isinstance(contact, str) or not contact or is_channel(contact) or contact == client.account:
+            send_message(client, {**RESPONSE_400, ERROR: 'Некорректное имя контакта.'}, client.stream)
+        elif message[ACTION] == DEL_CONTACT:
+            contacts.remove(client, contact)
+        elif contacts.add(client, contact):
+            send_message(client, {ACTION: STATUS, TIME: time.time(), CONTACTS: {contact: contact in contacts.online}},
+                         client.stream)
+        else:
+            send_message(client, {**RESPONSE_400, ERROR: f'Больше {CONTACTS_MAX} контактов добавить нельзя.'},
+                         client.stream)
+        return
+    # Проверка связи: на PING отвечаем PONG. PONG ответа не требует, время последней активности клиента
+    # обновляется при чтении любых данных.
+    elif ACTION in message and message[ACTION] in (PING, PONG):
+        if message[ACTION] == PING:
+            send_message(client, {ACTION: PONG, TIME: time.time()}, client.stream)
         return
     # Если клиент выходит
     elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message:
-        clients.remove(names[ACCOUNT_NAME])
-        names[ACCOUNT_NAME].close()
-        del names[ACCOUNT_NAME]
+        logger.info('Пользователь %s вышел.', client.account)
+        client.close()
         return
     # Иначе отдаём Bad request
     else:
         response = RESPONSE_400
         response[ERROR] = 'Запрос некорректен.'
-        send_message(client, response)
+        send_message(client, response, client.stream)
+        return
+
+
+# Приём данных куска вложения (кадр после заголовка chunk). Когда файл принят целиком, загрузившему отправляется
+# ответ 200, а получателю - сообщение о вложении, оно доставляется и записывается в историю как обычное.
+def receive_chunk(client, data, spool, messages_list, history=None):
+    try:
+        meta = spool.write(client, data)
+    except AttachmentError as err:
+        logger.info('Пользователь %s: %s', client.account, err)
+        send_message(client, {**RESPONSE_400, ERROR: err.text, ATTACHMENT: err.attachment}, client.stream)
         return
+    if meta is None:
+        return
+    send_message(client, {**RESPONSE_200, ATTACHMENT: meta[ATTACHMENT]}, client.stream)
+    message = attachment_message(meta)
+    messages_list.append(message)
+    if history is not None:
+        history.record(message)
 
 
 @log
-# Функция адресной отправки сообщения определённому клиенту. Принимает словарь сообщение, список зарегистрированых
-# пользователей и слушающие сокеты. Ничего не возвращает.
-def process_message(message, names, listen_socks):
-    if message[DESTINATION] in names and names[message[DESTINATION]] in listen_socks:
-        send_message(names[message[DESTINATION]], message)
-        logger.info(f'Отправлено сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]}.')
-    elif message[DESTINATION] in names and names[message[DESTINATION]] not in listen_socks:
+# Функция адресной отправки сообщения определённому клиенту. Принимает словарь сообщение и словарь
+# зарегистрированых пользователей. Получателю из другого рабочего процесса сообщение
+# пересылается через шину bus. Сообщение пользователю не в сети сохраняется в store для отложенной доставки.
+# Сообщение в канал рассылается участникам из channels и другим процессам через шину, возвращается список
+# участников, которым не удалось поставить сообщение в очередь.
+def process_message(message, names, bus=None, store=None, channels=None):
+    if is_channel(message[DESTINATION]):
+        members = channels.get(message[DESTINATION], ()) if channels is not None else ()
+        failed = broadcast(message, members, message[SENDER])
+        if bus is not None:
+            bus.publish_channel(message)
+        logger.info('Сообщение в канал %s от пользователя %s разослано участникам: %s.',
+                    message[DESTINATION], message[SENDER], len(members))
+        return failed
+    if message[DESTINATION] in names and not names[message[DESTINATION]].closed:
+        # пока пользователю отправляются сохранённые сообщения, новые встают в конец той же очереди
+        if names[message[DESTINATION]].replay_after is not None and store is not None:
+            store.append(message[DESTINATION], message)
+            return
+        send_message(names[message[DESTINATION]], message, names[message[DESTINATION]].stream)
+        logger.info('Отправлено сообщение пользователю %s от пользователя %s.', message[DESTINATION], message[SENDER])
+    elif message[DESTINATION] in names:
         raise ConnectionError
+    elif bus is not None and bus.forward(message):
+        logger.info(
+            'Сообщение пользователю %s от пользователя %s передано рабочему процессу %s.',
+            message[DESTINATION], message[SENDER], bus.remote_names[message[DESTINATION]])
+    elif store is not None:
+        store.append(message[DESTINATION], message)
+        logger.info('Пользователь %s не в сети, сообщение сохранено для отложенной доставки.', message[DESTINATION])
     else:
         logger.error(
-            f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере, отправка сообщения невозможна.')
+            'Пользователь %s не зарегистрирован на сервере, отправка сообщения невозможна.', message[DESTINATION])
+
+
+# Вступление подключения в канал и выход из него. Подключение помнит свои каналы, чтобы при отключении
+# его можно было убрать из индекса без перебора всех каналов.
+# Множество каналов подключения создаётся при первом входе, у большинства подключений его нет.
+def join_channel(channels, client, room):
+    channels.setdefault(room, set()).add(client)
+    if client.channels is None:
+        client.channels = set()
+    client.channels.add(room)
+
+
+def leave_channel(channels, client, room):
+    members = channels.get(room)
+    if members is not None:
+        members.discard(client)
+        if not members:
+            del channels[room]
+    if client.channels:
+        client.channels.discard(room)
+
+
+# Рассылка сообщения участникам канала, кроме отправителя. Сообщение кодируется один раз для каждого формата
+# потока (разметка, формат данных и сжатие), всем участникам с этим форматом в очередь ставится один и тот же
+# объект bytes.
+# Возвращает участников, которым не удалось поставить кадр в очередь.
+def broadcast(message, members, sender=None):
+    frames = {}
+    failed = []
+    for member in members:
+        if member.closed or member.account == sender:
+            continue
+        key = (member.stream.framing, member.stream.codec.wire, member.stream.compression)
+        frame = frames.get(key)
+        if frame is None:
+            frame = frames[key] = member.stream.encode(message)
+        try:
+            member.sendall(frame)
+        except (SlowConsumerError, OSError):
+            failed.append(member)
+    return failed
+
+
+# Быстрая пересылка сообщения пользователю: кадр с маршрутом из peek_route уходит получателю исходными байтами,
+# без создания сообщения и повторного кодирования (сжатый кадр - без распаковки). Возвращает
+# False, если сообщение нужно обработать полностью: отправитель не совпадает с пользователем соединения,
+# получатель не подключён к этому процессу или принимает данные в другом формате или с другим сжатием.
+def relay_frame(payload, route, client, names):
+    sender, destination = route
+    target = names.get(destination)
+    if sender != client.account or target is None or target.closed or target.replay_after is not None \
+            or target.stream.codec.wire != client.stream.codec.wire \
+            or target.stream.compression is not client.stream.compression:
+        return False
+    # старому клиенту без разметки можно переслать только кадр, проверенный при сборке (raw_decode)
+    if target.stream.framing == FRAMING_RAW and client.stream.framing != FRAMING_RAW:
+        return False
+    target.sendall(target.stream.frame(payload))
+    logger.debug('Сообщение пользователю %s от пользователя %s переслано без разбора.', destination, sender)
+    return True
+
+
+# Проверка клиентов с истёкшими таймерами активности. Чтение данных только обновляет last_activity клиента,
+# таймер переносится при срабатывании: клиенту, от которого приходили данные, таймер ставится на остаток срока,
+# молчащему idle_timeout секунд отправляется PING. Возвращает клиентов, не ответивших на PING за pong_timeout
+# секунд или недоступных для отправки, - их нужно отключить. Клиенты без кадров длины не знают PING,
+# их отключают без проверки после raw_timeout секунд молчания.
+def expire_idle(timers, now, idle_timeout, pong_timeout, raw_timeout=RAW_IDLE_TIMEOUT):
+    evicted = []
+    for client in timers.advance(now):
+        if client.closed:
+            continue
+        if client.stream.framing == FRAMING_RAW:
+            if not raw_timeout:
+                continue
+            idle = now - client.last_activity
+            if idle < raw_timeout:
+                timers.schedule(client, raw_timeout - idle, now)
+            else:
+                evicted.append(client)
+            continue
+        if client.pinged_at is not None:
+            if client.last_activity < client.pinged_at:
+                evicted.append(client)
+                continue
+            client.pinged_at = None
+        idle = now - client.last_activity
+        if idle < idle_timeout:
+            timers.schedule(client, idle_timeout - idle, now)
+            continue
+        client.pinged_at = now
+        timers.schedule(client, pong_timeout, now)
+        try:
+            send_message(client, {ACTION: PING, TIME: time.time()}, client.stream)
+        except (SlowConsumerError, OSError):
+            evicted.append(client)
+    return evicted
+
+
+# Предел частоты из командной строки: "частота" или "частота/запас", запас по умолчанию - вдвое больше частоты.
+def rate_spec(value):
+    rate, _, burst = value.partition('/')
+    rate = float(rate)
+    burst = float(burst) if burst else 2 * rate
+    if rate < 0 or rate and burst < 1:
+        raise argparse.ArgumentTypeError(f'некорректный предел частоты: {value}')
+    return rate, burst
+
+
+# Ограничения нагрузки по параметрам командной строки, None если все пределы выключены.
+def create_limits(namespace):
+    if not (namespace.rate_limit[0] or namespace.ip_rate_limit[0] or namespace.ip_accept_rate[0]
+            or namespace.ip_max_connections):
+        return None
+    return RateLimits(namespace.rate_limit, namespace.ip_rate_limit, namespace.ip_accept_rate,
+                      namespace.ip_max_connections)
+
+
+# Хранилище вложений по параметрам командной строки, None если вложения выключены (--attachment-dir '').
+def create_spool(namespace):
+    if not namespace.attachment_dir:
+        return None
+    return AttachmentSpool(namespace.attachment_dir, namespace.attachment_max_size)
+
+
+# Списки контактов по параметрам командной строки. Без файла базы (--contacts-db '') списки хранятся в памяти
+# и теряются при перезапуске сервера, подписки на присутствие работают так же.
+def create_contacts(namespace):
+    return Contacts(namespace.contacts_db or ':memory:', namespace.presence_interval, namespace.presence_fanout)
 
 
 # Парсер аргументов коммандной строки.
@@ -72,79 +353,917 @@ def arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', default=DEFAULT_PORT, type=int, nargs='?')
     parser.add_argument('-a', default='', nargs='?')
+    parser.add_argument('--out-high', default=OUT_HIGH_WATERMARK, type=int)
+    parser.add_argument('--out-low', default=OUT_LOW_WATERMARK, type=int)
+    parser.add_argument('--workers', default=1, type=int)
+    parser.add_argument('--log-level', default=None, choices=LOGGING_LEVELS)
+    parser.add_argument('--log-queue', action='store_true')
+    parser.add_argument('--mode', default=SERVER_MODE_REACTOR, choices=(SERVER_MODE_REACTOR, SERVER_MODE_ASYNCIO))
+    parser.add_argument('--slow-policy', default=SLOW_POLICY_DROP, choices=(SLOW_POLICY_DROP, SLOW_POLICY_DISCONNECT))
+    parser.add_argument('--no-passthrough', dest='passthrough', action='store_false')
+    parser.add_argument('--offline-db', default=OFFLINE_DB_FILE)
+    parser.add_argument('--history-db', default=HISTORY_DB_FILE)
+    parser.add_argument('--attachment-dir', default=ATTACHMENT_DIR)
+    parser.add_argument('--attachment-max-size', default=ATTACHMENT_MAX_SIZE, type=int)
+    parser.add_argument('--contacts-db', default=CONTACTS_DB_FILE)
+    parser.add_argument('--presence-interval', default=PRESENCE_INTERVAL, type=float)
+    parser.add_argument('--presence-fanout', default=PRESENCE_MAX_FANOUT, type=int)
+    parser.add_argument('--metrics-port', default=None, type=int)
+    parser.add_argument('--stats-interval', default=0, type=float)
+    parser.add_argument('--max-batch', default=FLUSH_MAX_BATCH, type=int)
+    parser.add_argument('--max-delay', default=FLUSH_MAX_DELAY, type=float)
+    parser.add_argument('--idle-timeout', default=IDLE_TIMEOUT, type=float)
+    parser.add_argument('--pong-timeout', default=PONG_TIMEOUT, type=float)
+    parser.add_argument('--raw-idle-timeout', default=RAW_IDLE_TIMEOUT, type=float)
+    parser.add_argument('--rate-limit', default=RATE_LIMIT, type=rate_spec)
+    parser.add_argument('--ip-rate-limit', default=IP_RATE_LIMIT, type=rate_spec)
+    parser.add_argument('--ip-accept-rate', default=IP_ACCEPT_RATE, type=rate_spec)
+    parser.add_argument('--ip-max-connections', default=IP_MAX_CONNECTIONS, type=int)
     namespace = parser.parse_args(sys.argv[1:])
-    listen_address = namespace.a
     listen_port = namespace.p
 
     # проверка получения корретного номера порта для работы сервера.
     if not 1023 < listen_port < 65536:
         logger.critical(
-            f'Попытка запуска сервера с указанием неподходящего порта {listen_port}. Допустимы адреса с 1024 до 65535.')
+            'Попытка запуска сервера с указанием неподходящего порта %s. Допустимы адреса с 1024 до 65535.',
+            listen_port)
         exit(1)
 
-    return listen_address, listen_port
+    if namespace.workers < 1 or namespace.workers > 1 and namespace.mode != SERVER_MODE_REACTOR:
+        logger.critical('Несколько рабочих процессов поддерживаются только в режиме %s.', SERVER_MODE_REACTOR)
+        exit(1)
 
+    if not 1 <= namespace.max_batch <= 1024 or namespace.max_delay < 0:
+        logger.critical('Некорректные параметры отправки: --max-batch от 1 до 1024, --max-delay не меньше 0.')
+        exit(1)
 
-def main():
-    # Загрузка параметров командной строки, если нет параметров, то задаём значения по умоланию.
-    listen_address, listen_port = arg_parser()
-
-    logger.info(
-        f'Запущен сервер, порт для подключений: {listen_port} , адрес с которого принимаются подключения: {listen_address}. Если адрес не указан, принимаются соединения с любых адресов.')
-    # Готовим сокет
-    transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    transport.bind((listen_address, listen_port))
-    transport.settimeout(0.5)
-
-    # список клиентов , очередь сообщений
-    clients = []
-    messages = []
-
-    # Словарь, содержащий имена пользователей и соответствующие им сокеты.
-    names = dict()
-
-    # Слушаем порт
-    transport.listen(MAX_CONNECTIONS)
-    # Основной цикл программы сервера
-    while True:
-        # Ждём подключения, если таймаут вышел, ловим исключение.
+    if namespace.idle_timeout < 0 or namespace.idle_timeout and namespace.pong_timeout <= 0 \
+            or namespace.raw_idle_timeout < 0:
+        logger.critical('Некорректные параметры проверки активности: --idle-timeout и --raw-idle-timeout '
+                        'не меньше 0, --pong-timeout больше 0.')
+        exit(1)
+
+    if namespace.attachment_max_size < 1:
+        logger.critical('Некорректный наибольший размер вложения: %s.', namespace.attachment_max_size)
+        exit(1)
+
+    if namespace.presence_interval <= 0 or namespace.presence_fanout < 1:
+        logger.critical('Некорректные параметры рассылки присутствия: --presence-interval больше 0, '
+                        '--presence-fanout не меньше 1.')
+        exit(1)
+
+    if namespace.ip_max_connections < 0:
+        logger.critical('Некорректное число подключений с адреса: %s.', namespace.ip_max_connections)
+        exit(1)
+
+    # нижняя граница очереди отправки должна быть меньше верхней.
+    if not 0 <= namespace.out_low < namespace.out_high:
+        logger.critical('Некорректные границы очереди отправки: %s - %s.', namespace.out_low, namespace.out_high)
+        exit(1)
+
+    return namespace
+
+
+# Кусок файла в очереди отправки: отправляется из файла в сокет вызовом sendfile.
+class FileSegment:
+    __slots__ = ('fd', 'offset', 'count')
+
+    def __init__(self, fd, offset, count):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+
+# Кадры очереди отправки до первого куска файла - их можно отправить одним вызовом sendmsg.
+def leading_frames(frames):
+    return takewhile(lambda frame: type(frame) is not FileSegment, frames)
+
+
+# Сессия подключения клиента: сокет, поток сообщений с буфером сборки принятых кадров и ограниченная очередь
+# отправки. Сокет неблокирующий: кадры ставятся в очередь, сессия отмечается в общем множестве dirty, и сервер
+# отправляет очереди всех отмеченных сессий один раз за итерацию цикла - все накопленные кадры одним вызовом
+# sendmsg. Если ядро приняло не всё, сессия ждёт готовности сокета к записи от селектора. Медленный получатель
+# копит данные только в своей очереди и не задерживает остальных.
+# Атрибуты объявлены в __slots__, а очередь отправки и множество каналов создаются только при необходимости,
+# поэтому простаивающее подключение занимает немного памяти и при сотнях тысяч подключений.
+class Session:
+    __slots__ = ('sock', 'fd', 'address', 'stream', 'account', 'closed', 'selector', 'dirty', 'high_watermark',
+                 'low_watermark', 'slow_policy', 'out_queue', 'out_offset', 'out_bytes', 'queued_at', 'writing',
+                 'congested', 'dropped', 'replay_after', 'channels', 'last_activity', 'pinged_at', 'events',
+                 'paused', 'bucket', 'held', 'limited_at', 'uploads', 'receiving', 'downloads', 'sending_file', 'tag',
+                 'subs', 'contacts')
+
+    def __init__(self, sock, address, selector, dirty, high_watermark=OUT_HIGH_WATERMARK,
+                 low_watermark=OUT_LOW_WATERMARK, slow_policy=SLOW_POLICY_DROP):
+        self.sock = sock
+        # номер дескриптора - ключ сессии в индексе сервера, сохраняется до закрытия сокета
+        self.fd = sock.fileno()
+        self.address = address
+        self.stream = MessageStream()
+        self.account = None
+        self.closed = False
+        self.selector = selector
+        self.dirty = dirty
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_policy = slow_policy
+        # очередь кадров на отправку (None, пока очередь пуста), смещение в первом кадре, общий объём
+        # неотправленных данных и время постановки первого кадра
+        self.out_queue = None
+        self.out_offset = 0
+        self.out_bytes = 0
+        self.queued_at = 0
+        # сокет зарегистрирован в селекторе на запись: ядро не приняло очередь целиком
+        self.writing = False
+        # получатель не успевает забирать данные, новые кадры отбрасываются до опустошения очереди
+        self.congested = False
+        self.dropped = 0
+        # номер последнего отправленного сохранённого сообщения, None - отправка сохранённых не идёт
+        self.replay_after = None
+        # каналы, в которых состоит пользователь, и его контакты (подписки на присутствие)
+        self.channels = None
+        self.contacts = None
+        # время последнего приёма данных и отправки PING без ответа (по time.monotonic)
+        self.last_activity = 0
+        self.pinged_at = None
+        # маска событий сокета в селекторе (сервер регистрирует сокет на чтение)
+        self.events = selectors.EVENT_READ
+        # ограничение частоты сообщений: чтение приостановлено, ведро токенов подключения и принятый кадр,
+        # ожидающий обработки после паузы
+        self.paused = False
+        self.bucket = None
+        self.held = None
+        self.limited_at = None
+        # вложения: загрузки подключения, загрузка, данные куска которой ожидаются следующим кадром,
+        # очередь скачиваний и число кусков файлов в очереди отправки
+        self.uploads = None
+        self.receiving = None
+        self.downloads = None
+        self.sending_file = 0
+        # мультиплексированное подключение: пользователь, метка которого последней поставлена в очередь отправки
+        # (None - первый пользователь подключения), и пользователи шлюза по имени
+        self.tag = None
+        self.subs = None
+
+    def fileno(self):
+        return self.fd
+
+    # Метка пользователя owner (SubSession, None - первый пользователь подключения) для очереди отправки.
+    def switch_tag(self, owner):
+        self.tag = owner
+        return owner.tag_frame if owner is not None else multiplex_tag(self.account)
+
+    # Постановка кадра в очередь отправки. Кадр принимается или отбрасывается только целиком.
+    # owner - пользователь мультиплексированного подключения, перед его кадрами ставится его метка.
+    def sendall(self, data, owner=None):
+        if self.closed:
+            return
+        if self.out_bytes + len(data) > self.high_watermark:
+            if self.slow_policy == SLOW_POLICY_DISCONNECT:
+                raise SlowConsumerError(self.address)
+            if not self.congested:
+                logger.warning('Клиент %s не успевает принимать данные, сообщения отбрасываются.', self.address)
+            self.congested = True
+        if self.congested:
+            self.dropped += 1
+            server_metrics.dropped_total += 1
+            return
+        if self.out_queue is None:
+            self.out_queue = deque()
+            self.queued_at = time.monotonic()
+            self.dirty.add(self)
+        if self.tag is not owner:
+            tag = self.switch_tag(owner)
+            self.out_queue.append(tag)
+            self.out_bytes += len(tag)
+        self.out_queue.append(data)
+        self.out_bytes += len(data)
+
+    # Постановка куска файла в очередь отправки: заголовок куска с префиксом длины данных и сам кусок.
+    # Сервер ставит кусок только при свободной очереди, поэтому он не отбрасывается, как сообщения
+    # медленному получателю, - иначе клиент не собрал бы файл.
+    def send_file(self, header, fd, offset, count, owner=None):
+        if self.closed:
+            return
+        if self.out_queue is None:
+            self.out_queue = deque()
+            self.queued_at = time.monotonic()
+            self.dirty.add(self)
+        if self.tag is not owner:
+            header = self.switch_tag(owner) + header
+        self.out_queue.append(header)
+        self.out_queue.append(FileSegment(fd, offset, count))
+        self.out_bytes += len(header) + count
+        self.sending_file += 1
+
+    # Начало скачивания файла: ограничение неотправленных данных в буфере сокета.
+    def start_download(self):
+        limit_unsent(self.sock)
+
+    # Отправка очереди: до max_batch кадров за один вызов sendmsg, недописанный кадр досылается срезом
+    # memoryview без копирования. Частичная отправка означает, что буфер сокета заполнен - дальше очередь
+    # отправляется по готовности сокета к записи. Кусок файла отправляется отдельно (send_segment).
+    def flush(self, max_batch=FLUSH_MAX_BATCH):
+        queue = self.out_queue
+        while queue:
+            if self.sending_file and type(queue[0]) is FileSegment:
+                if self.send_segment(queue):
+                    if not self.writing:
+                        self.writing = True
+                        self.update_events()
+                    return
+                continue
+            buffers = [memoryview(queue[0])[self.out_offset:]]
+            frames = islice(queue, 1, max_batch)
+            buffers.extend(leading_frames(frames) if self.sending_file else frames)
+            try:
+                sent = self.sock.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            self.out_bytes -= sent
+            server_metrics.bytes_out_total += sent
+            partial = sent < sum(map(len, buffers))
+            sent += self.out_offset
+            while queue and sent >= len(queue[0]):
+                sent -= len(queue.popleft())
+                server_metrics.messages_out_total += 1
+            self.out_offset = sent
+            if partial:
+                if not self.writing:
+                    self.writing = True
+                    self.update_events()
+                return
+        self.out_queue = None
+        if self.writing:
+            self.writing = False
+            self.update_events()
+        if self.congested and self.out_bytes <= self.low_watermark:
+            logger.info('Клиент %s освободил очередь, отброшено сообщений: %s.', self.address, self.dropped)
+            self.congested = False
+            self.dropped = 0
+
+    # Отправка куска файла из начала очереди вызовом sendfile: данные идут из кеша страниц в сокет без копирования
+    # в память процесса. Возвращает True, если ядро приняло кусок не целиком.
+    def send_segment(self, queue):
+        segment = queue[0]
         try:
-            client, client_address = transport.accept()
+            sent = os.sendfile(self.fd, segment.fd, segment.offset + self.out_offset, segment.count - self.out_offset)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        self.out_bytes -= sent
+        server_metrics.bytes_out_total += sent
+        self.out_offset += sent
+        if self.out_offset < segment.count:
+            return True
+        queue.popleft()
+        self.out_offset = 0
+        self.sending_file -= 1
+        return False
+
+    # Регистрация сокета в селекторе по состоянию сессии: чтение, если оно не приостановлено, запись, если ядро
+    # не приняло очередь целиком. Без событий сокет снимается с селектора.
+    def update_events(self):
+        events = (0 if self.paused else selectors.EVENT_READ) | (selectors.EVENT_WRITE if self.writing else 0)
+        if events == self.events:
+            return
+        if not self.events:
+            self.selector.register(self.sock, events, self)
+        elif not events:
+            self.selector.unregister(self.sock)
+        else:
+            self.selector.modify(self.sock, events, self)
+        self.events = events
+
+    # Закрытие подключения. Перед закрытием отправляем то, что примет сокет без ожидания, чтобы клиент
+    # получил последний ответ (например, об ошибке регистрации).
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.out_queue and type(self.out_queue[0]) is not FileSegment:
+                buffers = [memoryview(self.out_queue[0])[self.out_offset:]]
+                buffers.extend(leading_frames(islice(self.out_queue, 1, FLUSH_MAX_BATCH)))
+                self.sock.sendmsg(buffers)
         except OSError:
             pass
-        else:
-            logger.info(f'Установлено соедение с ПК {client_address}')
-            clients.append(client)
+        self.out_queue = None
+        self.dirty.discard(self)
+        self.sock.close()
+
+
+# Пользователь мультиплексированного подключения (шлюза). У него свои имя, каналы, отправка сохранённых сообщений,
+# вложения и ведро токенов, а сокет, поток сообщений и очередь отправки - общие с подключением: кадры пользователю
+# ставятся в очередь подключения после его метки, остальные атрибуты читаются у подключения. Обработчики
+# process_client_message и process_message работают с ним, как с обычным подключением.
+# name - имя из метки, account - имя после регистрации (PRESENCE).
+class SubSession:
+    __slots__ = ('connection', 'name', 'tag_frame', 'account', 'closed', 'replay_after', 'replay_task', 'channels',
+                 'bucket', 'limited_at', 'uploads', 'receiving', 'downloads', 'download_task', 'contacts')
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.tag_frame = multiplex_tag(name)
+        self.account = None
+        self.closed = False
+        self.replay_after = None
+        self.replay_task = None
+        self.channels = None
+        self.bucket = None
+        self.limited_at = None
+        self.uploads = None
+        self.receiving = None
+        self.downloads = None
+        self.download_task = None
+        self.contacts = None
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def sendall(self, data):
+        self.connection.sendall(data, self)
+
+    def send_file(self, header, fd, offset, count):
+        self.connection.send_file(header, fd, offset, count, self)
+
+    def write_direct(self, data):
+        self.connection.write_direct(data, self)
+
+    def start_download(self):
+        self.connection.start_download()
+
+    # Выход или отказ в регистрации касается только этого пользователя, подключение остаётся открытым.
+    def close(self):
+        self.closed = True
+
+
+# Получатель кадра мультиплексированного подключения по метке tag: само подключение для его первого
+# пользователя, иначе пользователь шлюза. Для новой метки создаётся пользователь, ожидающий регистрации.
+# None - у подключения уже MULTIPLEX_MAX_ACCOUNTS пользователей, кадр не обрабатывается.
+def account_session(client, tag, limits=None, now=0):
+    if tag == client.account:
+        return client
+    if client.subs is None:
+        client.subs = dict()
+    sub = client.subs.get(tag)
+    if sub is None:
+        if len(client.subs) >= MULTIPLEX_MAX_ACCOUNTS:
+            send_message(SubSession(client, tag), {**RESPONSE_400, ERROR: 'Слишком много пользователей в подключении.'},
+                         client.stream)
+            return None
+        sub = client.subs[tag] = SubSession(client, tag)
+        if limits is not None:
+            sub.bucket = limits.session_bucket(now)
+    return sub
 
-        recv_data_lst = []
-        send_data_lst = []
-        err_lst = []
-        # Проверяем на наличие ждущих клиентов
+
+# Сервер на основе реактора: слушающий сокет и все клиентские сокеты зарегистрированы в селекторе
+# (epoll в Linux), приём подключений и чтение выполняются только по событиям готовности.
+# В режиме нескольких процессов каждый процесс открывает свой слушающий сокет с SO_REUSEPORT (ядро распределяет
+# подключения между ними), а пользователи других процессов доступны через шину bus.
+class Server:
+    def __init__(self, listen_address, listen_port, high_watermark=OUT_HIGH_WATERMARK,
+                 low_watermark=OUT_LOW_WATERMARK, slow_policy=SLOW_POLICY_DROP, bus=None, passthrough=True,
+                 store=None, max_batch=FLUSH_MAX_BATCH, max_delay=FLUSH_MAX_DELAY, idle_timeout=IDLE_TIMEOUT,
+                 pong_timeout=PONG_TIMEOUT, limits=None, history=None, spool=None, contacts=None,
+                 raw_idle_timeout=RAW_IDLE_TIMEOUT):
+        self.addr = listen_address
+        self.port = listen_port
+        self.bus = bus
+        self.store = store
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_policy = slow_policy
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        # пересылка сообщений пользователям без повторного кодирования кадра
+        self.passthrough = passthrough
+
+        # сессии клиентов по номеру дескриптора, очередь сообщений
+        self.sessions = dict()
+        self.messages = []
+        # сессии с кадрами, ожидающими отправки в конце итерации цикла
+        self.dirty = set()
+        # таймеры проверки активности клиентов и время начала текущей итерации цикла
+        self.idle_timeout = idle_timeout
+        self.pong_timeout = pong_timeout
+        self.raw_idle_timeout = raw_idle_timeout
+        self.now = time.monotonic()
+        self.timers = TimerWheel(TIMER_TICK, TIMER_WHEEL_SIZE, self.now) if idle_timeout else None
+        # ограничения нагрузки и куча приостановленных клиентов (время возобновления, id, сессия)
+        self.limits = limits
+        self.paused = []
+        # история сообщений с поиском
+        self.history = history
+        # хранилище вложений
+        self.spool = spool
+        # списки контактов и рассылка изменений присутствия
+        self.contacts = contacts
+
+        # Словарь, содержащий имена пользователей и соответствующие им сессии.
+        self.names = dict()
+        # Участники каналов: имя канала - множество сессий.
+        self.channels = dict()
+
+        self.selector = selectors.DefaultSelector()
+        self.transport = None
+
+    # Подготовка слушающего сокета и регистрация его в селекторе.
+    def init_socket(self):
+        logger.info(
+            'Запущен сервер, порт для подключений: %s , адрес с которого принимаются подключения: %s. Если адрес не указан, принимаются соединения с любых адресов.',
+            self.port, self.addr)
+        transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.bus is not None:
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        transport.bind((self.addr, self.port))
+        transport.setblocking(False)
+        transport.listen(MAX_CONNECTIONS)
+        self.transport = transport
+        # data=None у ключа селектора означает слушающий сокет.
+        self.selector.register(transport, selectors.EVENT_READ, None)
+        if self.bus is not None:
+            self.selector.register(self.bus, selectors.EVENT_READ, self.bus)
+            self.bus.publish_hello()
+        if self.history is not None:
+            self.selector.register(self.history, selectors.EVENT_READ, self.history)
+
+    # Принимаем все ожидающие подключения, пока очередь listen не опустеет.
+    def accept_clients(self):
+        while True:
+            try:
+                client, client_address = self.transport.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                logger.error('Ошибка при приёме подключения: %s', err)
+                return
+            if self.limits is not None:
+                error = self.limits.accept(client_address[0], self.now)
+                if error is not None:
+                    self.reject(client, client_address, error)
+                    continue
+            logger.info('Установлено соедение с ПК %s', client_address)
+            server_metrics.connections_total += 1
+            client.setblocking(False)
+            # кадры и так собираются в пачки приложением, задержка Нейгла не нужна
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = Session(client, client_address, self.selector, self.dirty, self.high_watermark,
+                              self.low_watermark, self.slow_policy)
+            self.sessions[session.fd] = session
+            self.selector.register(client, selectors.EVENT_READ, session)
+            session.last_activity = self.now
+            if self.timers is not None:
+                self.timers.schedule(session, self.idle_timeout, self.now)
+            if self.limits is not None:
+                session.bucket = self.limits.session_bucket(self.now)
+
+    # Отказ в подключении из-за ограничений по IP адресу: ответ 429 без разметки (формат ещё не согласован)
+    # и закрытие сокета.
+    def reject(self, client, client_address, error):
+        logger.warning('Отклонено подключение с ПК %s: %s', client_address, error)
+        server_metrics.rejected_total += 1
         try:
-            if clients:
-                recv_data_lst, send_data_lst, err_lst = select.select(clients, clients, [], 0)
+            client.setblocking(False)
+            client.send(MessageStream().encode({**RESPONSE_429, ERROR: error}))
         except OSError:
             pass
+        client.close()
 
-        # принимаем сообщения и если ошибка, исключаем клиента.
-        if recv_data_lst:
-            for client_with_message in recv_data_lst:
+    # Отключение клиента: снимаем сокет с селектора, закрываем его и освобождаем имя пользователя, каналы
+    # и место в индексе сессий. Все операции - по ключу, без перебора подключений. Ошибка отправки пользователю
+    # шлюза - ошибка общего подключения, оно отключается со всеми пользователями.
+    def remove_client(self, client):
+        if type(client) is SubSession:
+            client = client.connection
+        if self.sessions.pop(client.fd, None) is None:
+            return
+        server_metrics.disconnects_total += 1
+        if self.timers is not None:
+            self.timers.cancel(client)
+        if self.limits is not None:
+            self.limits.release(client.address[0], self.now)
+        # сокет мог быть уже закрыт обработчиком, поэтому сессия снимается с селектора по номеру дескриптора
+        try:
+            self.selector.unregister(client.fd)
+        except (KeyError, ValueError):
+            pass
+        self.release_account(client)
+        for sub in list((client.subs or {}).values()):
+            sub.closed = True
+            self.release_account(sub)
+        client.close()
+
+    # Выход пользователя мультиплексированного подключения (или его неудачная регистрация).
+    def remove_account(self, client):
+        client.closed = True
+        if client.connection.subs.get(client.name) is client:
+            del client.connection.subs[client.name]
+        self.release_account(client)
+
+    # Освобождение имени пользователя, каналов, отправки сохранённых сообщений и вложений.
+    def release_account(self, client):
+        if client.account is not None and self.names.get(client.account) is client:
+            del self.names[client.account]
+            if self.bus is not None:
+                self.bus.publish_offline(client.account)
+            if self.contacts is not None:
+                self.contacts.logout(client)
+        if self.store is not None:
+            self.store.finish_replay(client)
+        if self.spool is not None:
+            self.spool.release(client)
+        for room in list(client.channels or ()):
+            leave_channel(self.channels, client, room)
+
+    # Приём данных от клиента, готового к чтению. Один recv может содержать несколько сообщений,
+    # обрабатываются все полностью принятые кадры. При включённых замерах время каждого этапа отсчитывается
+    # от конца предыдущего. После паузы (receive=False) обрабатываются отложенный кадр и остаток буфера.
+    def read_client(self, client, receive=True):
+        timing = server_metrics.timing
+        try:
+            started = time.perf_counter_ns() if timing else 0
+            if receive:
                 try:
-                    process_client_message(get_message(client_with_message), messages, client_with_message, clients,
-                                           names)
-                except:
-                    logger.info(f'Клиент {client_with_message.getpeername()} отключился от сервера.')
-                    clients.remove(client_with_message)
+                    data = client.sock.recv(RECV_BUFFER_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    return
+                if not data:
+                    raise ConnectionResetError
+                client.last_activity = self.now
+                server_metrics.bytes_in_total += len(data)
+                if timing:
+                    started = server_metrics.observe(STAGE_RECV, started)
+                client.stream.feed(data)
+            while not client.closed:
+                payload = client.held
+                if payload is None:
+                    payload = client.stream.next_frame()
+                    if payload is None:
+                        break
+                    server_metrics.messages_in_total += 1
+                else:
+                    client.held = None
+                # кадр мультиплексированного подключения обрабатывается от имени пользователя из метки
+                target = client
+                if client.stream.tag is not None:
+                    target = account_session(client, client.stream.tag, self.limits, self.now)
+                    if target is None:
+                        continue
+                # данные куска вложения - не сообщение, ограничение частоты на них не распространяется
+                if target.receiving is not None:
+                    receive_chunk(target, payload, self.spool, self.messages, self.history)
+                    continue
+                if self.limits is not None:
+                    wait = self.limits.take(target.bucket, client.address[0], self.now)
+                    if wait:
+                        self.pause(client, payload, wait)
+                        break
+                route = client.stream.peek_route(payload) if self.passthrough else None
+                if route is not None and self.relay(target, payload, route):
+                    server_metrics.relayed_total += 1
+                    if timing:
+                        started = server_metrics.observe(STAGE_ROUTE, started)
+                    continue
+                message = client.stream.decode(payload)
+                if timing:
+                    started = server_metrics.observe(STAGE_PARSE, started)
+                process_client_message(message, self.messages, target, self.names, self.bus, self.store,
+                                       self.channels, self.history, self.spool, self.contacts)
+                if target is not client and (target.closed or target.account != target.name):
+                    self.remove_account(target)
+                if timing:
+                    started = server_metrics.observe(STAGE_PROCESS, started)
+        except Exception as err:
+            if isinstance(err, IncorrectDataRecivedError):
+                server_metrics.decode_errors_total += 1
+            logger.info('Клиент %s отключился от сервера.', client.address)
+            self.remove_client(client)
+            return
+        # Клиент мог быть отключён обработчиком (занятое имя, выход) - освобождаем его сессию.
+        if client.closed:
+            self.remove_client(client)
+
+    # Приостановка чтения клиента, превысившего предел частоты сообщений: кадр откладывается до конца паузы,
+    # новые данные остаются в буфере сокета ядра, и отправителя замедляет управление потоком TCP, а не память
+    # сервера. Клиенту отправляется ответ 429 (не чаще раза в RATE_NOTICE_INTERVAL секунд).
+    def pause(self, client, payload, wait):
+        client.held = payload
+        client.paused = True
+        client.update_events()
+        heapq.heappush(self.paused, (self.now + wait, id(client), client))
+        server_metrics.rate_limited_total += 1
+        logger.debug('Клиент %s превысил предел частоты сообщений, чтение приостановлено на %.3f с.',
+                     client.address, wait)
+        if client.limited_at is None or self.now - client.limited_at >= RATE_NOTICE_INTERVAL:
+            client.limited_at = self.now
+            send_message(client, {**RESPONSE_429, ERROR: 'Превышена частота сообщений.'}, client.stream)
+
+    # Возобновление чтения клиентов, у которых закончилась пауза.
+    def resume_clients(self):
+        while self.paused and self.paused[0][0] <= self.now:
+            _, _, client = heapq.heappop(self.paused)
+            if client.closed:
+                continue
+            client.paused = False
+            client.update_events()
+            self.read_client(client, receive=False)
 
-        # Если есть сообщения, обрабатываем каждое.
+    # Быстрая пересылка кадра сообщения (relay_frame). Сообщения, уже стоящие в очереди, отправляются раньше,
+    # чтобы не нарушить порядок. Ошибка отправки отключает получателя, а не отправителя.
+    def relay(self, client, payload, route):
+        if self.messages:
+            self.process_messages(self.messages, self.bus)
+            self.messages.clear()
+        try:
+            relayed = relay_frame(payload, route, client, self.names)
+        except Exception:
+            logger.info('Связь с клиентом с именем %s была потеряна', route[1])
+            if route[1] in self.names:
+                self.remove_client(self.names[route[1]])
+            return True
+        if relayed and self.history is not None:
+            self.history.record(payload, client.stream.codec.wire, client.stream.compression)
+        return relayed
+
+    # Отправка готовых результатов поиска по истории.
+    def deliver_results(self):
+        for client, response in self.history.read():
+            if client.closed:
+                continue
+            try:
+                send_message(client, response, client.stream)
+            except (SlowConsumerError, OSError):
+                logger.info('Связь с клиентом с именем %s была потеряна', client.account)
+                self.remove_client(client)
+
+    # Рассылка накопленных изменений присутствия подписчикам.
+    def deliver_presence(self):
+        for client, message in self.contacts.flush():
+            if client.closed:
+                continue
+            try:
+                client.sendall(client.stream.encode(message))
+            except (SlowConsumerError, OSError):
+                logger.info('Связь с клиентом с именем %s была потеряна', client.account)
+                self.remove_client(client)
+
+    # Отправка очереди клиента, готового к записи.
+    def write_client(self, client):
+        started = time.perf_counter_ns() if server_metrics.timing else 0
+        try:
+            client.flush(self.max_batch)
+            if started:
+                server_metrics.observe(STAGE_SEND, started)
+        except OSError:
+            logger.info('Клиент %s отключился от сервера.', client.address)
+            self.remove_client(client)
+
+    # Если есть сообщения, обрабатываем каждое.
+    def process_messages(self, messages, bus):
         for i in messages:
             try:
-                process_message(i, names, send_data_lst)
+                failed = process_message(i, self.names, bus, self.store, self.channels)
             except:
-                logger.info(f'Связь с клиентом с именем {i[DESTINATION]} была потеряна')
-                clients.remove(names[i[DESTINATION]])
-                del names[i[DESTINATION]]
-        messages.clear()
+                logger.info('Связь с клиентом с именем %s была потеряна', i[DESTINATION])
+                if i[DESTINATION] in self.names:
+                    self.remove_client(self.names[i[DESTINATION]])
+                continue
+            for client in failed or ():
+                logger.info('Связь с клиентом с именем %s была потеряна', client.account)
+                self.remove_client(client)
+
+    # Отправка очередной страницы сохранённых сообщений пользователю. Следующая страница читается из хранилища,
+    # когда очередь отправки опустеет до нижней границы, поэтому пользователь с сотнями тысяч сохранённых
+    # сообщений не занимает память сервера и не задерживает остальных. Страница удаляется из хранилища при
+    # запросе следующей; при обрыве связи хвост последней страницы будет отправлен повторно при следующем входе.
+    def replay(self, client):
+        if client.out_bytes > client.low_watermark:
+            return
+        self.store.delete(client.account, client.replay_after)
+        rows = self.store.fetch(client.account, client.replay_after)
+        if not rows:
+            self.store.finish_replay(client)
+            logger.info('Пользователю %s отправлены все сохранённые сообщения.', client.account)
+            return
+        for row_id, data in rows:
+            frame = stored_frame(client.stream, data)
+            if client.out_bytes and client.out_bytes + len(frame) > client.high_watermark:
+                break
+            client.sendall(frame)
+            client.replay_after = row_id
+
+    # Отправка скачиваемых файлов: каждой сессии за итерацию цикла ставится в очередь один кусок, следующий - когда
+    # ядро приняло предыдущий. Так скачивания делят канал сервера поровну, а сообщение чата ждёт в очереди
+    # сессии не дольше одного куска. Медленному получателю куски не ставятся, пока его очередь не освободится.
+    def pump_downloads(self):
+        for client in list(self.spool.downloading):
+            if client.closed or client.sending_file or client.out_bytes > client.low_watermark:
+                continue
+            chunk = self.spool.next_chunk(client)
+            if chunk is None:
+                continue
+            download, offset, count, header = chunk
+            client.send_file(client.stream.encode(header) + FRAME_HEADER.pack(count), download.fd, offset, count)
+
+    # Отправка очередей сессий, получивших кадры на этой итерации: все кадры сессии уходят одним вызовом sendmsg.
+    # При max_delay кадры сессии копятся, пока их меньше max_batch и первый ждёт меньше max_delay, так несколько
+    # мелких сообщений уходят вместе (аналог алгоритма Нейгла на уровне приложения).
+    def flush_sessions(self):
+        now = time.monotonic() if self.max_delay else 0
+        started = time.perf_counter_ns() if server_metrics.timing else 0
+        for client in list(self.dirty):
+            if client.closed or client.writing:
+                self.dirty.discard(client)
+                continue
+            if self.max_delay and len(client.out_queue) < self.max_batch and now - client.queued_at < self.max_delay:
+                continue
+            self.dirty.discard(client)
+            try:
+                client.flush(self.max_batch)
+            except OSError:
+                logger.info('Клиент %s отключился от сервера.', client.address)
+                self.remove_client(client)
+        if started:
+            server_metrics.observe(STAGE_SEND, started)
+
+    # Отключение клиентов, не отвечающих на проверку активности. Так освобождаются имена и дескрипторы
+    # полуоткрытых соединений, о разрыве которых сервер иначе узнал бы только при ошибке отправки.
+    def check_idle(self):
+        for client in expire_idle(self.timers, self.now, self.idle_timeout, self.pong_timeout,
+                                  self.raw_idle_timeout):
+            logger.info('Клиент %s не отвечает на проверку связи, соединение закрывается.', client.address)
+            server_metrics.idle_evicted_total += 1
+            self.remove_client(client)
+
+    # Таймаут select(): без отложенной работы цикл блокируется до событий.
+    def select_timeout(self):
+        timeout = None if self.store is None else self.store.timeout()
+        if self.contacts is not None:
+            presence = self.contacts.timeout()
+            if presence is not None:
+                timeout = presence if timeout is None else min(timeout, presence)
+        if self.timers:
+            tick = self.timers.timeout(time.monotonic())
+            timeout = tick if timeout is None else min(timeout, tick)
+        if self.bus is not None and self.bus.pending:
+            retry = self.bus.timeout()
+            timeout = retry if timeout is None else min(timeout, retry)
+        if self.dirty:
+            timeout = self.max_delay if timeout is None else min(timeout, self.max_delay)
+        if self.paused:
+            resume = max(0, self.paused[0][0] - time.monotonic())
+            timeout = resume if timeout is None else min(timeout, resume)
+        # пользователю, получающему сохранённые сообщения, следующая страница отправляется без ожидания событий
+        if self.store is not None and any(client.out_bytes <= client.low_watermark
+                                          for client in self.store.replaying):
+            timeout = 0
+        # и следующий кусок скачиваемого файла - тоже
+        if self.spool is not None and any(not client.sending_file and client.out_bytes <= client.low_watermark
+                                          for client in self.spool.downloading):
+            timeout = 0
+        return timeout
+
+    # Основной цикл программы сервера. Без событий select() блокируется без таймаута - простаивающий сервер
+    # не расходует процессорное время.
+    def run(self):
+        self.init_socket()
+        while True:
+            events = self.selector.select(self.select_timeout())
+            self.now = time.monotonic()
+            started = time.perf_counter_ns() if server_metrics.timing else 0
+            for key, mask in events:
+                if key.data is None:
+                    self.accept_clients()
+                    continue
+                if key.data is self.bus:
+                    # сообщения для наших клиентов, пересланные другими процессами, дальше не пересылаются
+                    self.process_messages(self.bus.read(), None)
+                    if self.contacts is not None:
+                        for name, online in self.bus.changes:
+                            self.contacts.changed(name, online)
+                    self.bus.changes.clear()
+                    continue
+                if key.data is self.history:
+                    self.deliver_results()
+                    continue
+                if mask & selectors.EVENT_WRITE and not key.data.closed:
+                    self.write_client(key.data)
+                if mask & selectors.EVENT_READ and not key.data.closed:
+                    self.read_client(key.data)
+            if self.paused:
+                self.resume_clients()
+            if self.limits is not None:
+                self.limits.prune(self.now)
+
+            routed = time.perf_counter_ns() if started and self.messages else 0
+            self.process_messages(self.messages, self.bus)
+            self.messages.clear()
+            if routed:
+                server_metrics.observe(STAGE_ROUTE, routed)
+            # присутствие рассылается после пересылки сообщений итерации
+            if self.contacts is not None:
+                self.deliver_presence()
+            if self.store is not None:
+                for client in list(self.store.replaying):
+                    self.replay(client)
+                self.store.flush()
+            if self.spool is not None and self.spool.downloading:
+                self.pump_downloads()
+            if self.timers is not None:
+                self.check_idle()
+            self.flush_sessions()
+            if self.bus is not None:
+                self.bus.flush()
+            if started:
+                server_metrics.observe(STAGE_LOOP, started)
+
+    # Текущие значения для метрик. Вызывается из потока экспорта, поэтому списки копируются перед обходом.
+    def gauges(self):
+        queues = [client.out_bytes for client in list(self.sessions.values())]
+        return {
+            'connections': len(queues),
+            'users': len(self.names),
+            'channels': len(self.channels),
+            'out_queue_bytes': sum(queues),
+            'out_queue_max_bytes': max(queues, default=0),
+            'replaying': len(self.store.replaying) if self.store is not None else 0,
+            'downloading': len(self.spool.downloading) if self.spool is not None else 0,
+            'presence_pending': len(self.contacts.changes) if self.contacts is not None else 0,
+        }
+
+
+# Настройка логирования по параметрам командной строки: уровень и переключение DEBUG по SIGUSR1.
+def configure_logging(namespace):
+    if namespace.log_level:
+        set_logging_level(namespace.log_level)
+    install_level_signal(logger.getEffectiveLevel() if logger.getEffectiveLevel() != logging.DEBUG else logging.INFO)
+
+
+# Рабочий процесс сервера в режиме --workers.
+def run_worker(worker_id, workers, socket_dir, namespace):
+    # обработчик SIGTERM унаследован от управляющего процесса, возвращаем обработку по умолчанию
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # поток записи логов не переживает fork, в каждом процессе запускается свой
+    if namespace.log_queue:
+        start_queue_logging()
+    bus = WorkerBus(worker_id, workers, socket_dir)
+    # файл хранилища общий для всех процессов
+    store = OfflineStore(namespace.offline_db) if namespace.offline_db else None
+    # история тоже общая, у каждого процесса свои списки индекса
+    history = History(namespace.history_db, worker_id) if namespace.history_db else None
+    # каталог вложений общий, файл можно скачать через любой процесс
+    spool = create_spool(namespace)
+    # списки контактов общие, присутствие пользователей других процессов приходит по шине
+    server = Server(namespace.a, namespace.p, namespace.out_high, namespace.out_low, namespace.slow_policy, bus,
+                    namespace.passthrough, store, namespace.max_batch, namespace.max_delay, namespace.idle_timeout,
+                    namespace.pong_timeout, create_limits(namespace), history, spool, create_contacts(namespace),
+                    namespace.raw_idle_timeout)
+    # у каждого процесса свой порт метрик: metrics_port + номер процесса
+    start_metrics(server.gauges, namespace.metrics_port and namespace.metrics_port + worker_id,
+                  namespace.stats_interval)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    # Загрузка параметров командной строки, если нет параметров, то задаём значения по умоланию.
+    namespace = arg_parser()
+    configure_logging(namespace)
+
+    if namespace.workers > 1:
+        logger.info('Запуск сервера в %s рабочих процессах.', namespace.workers)
+        supervise_workers(namespace.workers, run_worker, (namespace,))
+        return
+
+    if namespace.log_queue:
+        start_queue_logging()
+
+    store = OfflineStore(namespace.offline_db) if namespace.offline_db else None
+    history = History(namespace.history_db) if namespace.history_db else None
+    spool = create_spool(namespace)
+    contacts = create_contacts(namespace)
+    if namespace.mode == SERVER_MODE_ASYNCIO:
+        from server_async import AsyncServer
+        server = AsyncServer(namespace.a, namespace.p, namespace.out_high, namespace.out_low, namespace.slow_policy,
+                             namespace.passthrough, store, namespace.max_delay, namespace.idle_timeout,
+                             namespace.pong_timeout, create_limits(namespace), history, spool, contacts,
+                             namespace.raw_idle_timeout)
+    else:
+        server = Server(namespace.a, namespace.p, namespace.out_high, namespace.out_low, namespace.slow_policy,
+                        passthrough=namespace.passthrough, store=store, max_batch=namespace.max_batch,
+                        max_delay=namespace.max_delay, idle_timeout=namespace.idle_timeout,
+                        pong_timeout=namespace.pong_timeout, limits=create_limits(namespace), history=history,
+                        spool=spool, contacts=contacts, raw_idle_timeout=namespace.raw_idle_timeout)
+    start_metrics(server.gauges, namespace.metrics_port, namespace.stats_interval)
+    server.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,454 @@
+import time
+import mmap
+import asyncio
+import logging
+import logs.config_server_log
+from common.variables import *
+from common.utils import *
+from errors import IncorrectDataRecivedError, SlowConsumerError
+from server import process_client_message, process_message, relay_frame, leave_channel, expire_idle, receive_chunk, \
+    account_session, SubSession
+from attachments import limit_unsent
+from offline_store import stored_frame
+from timer_wheel import TimerWheel
+from metrics import server_metrics, STAGE_PARSE, STAGE_PROCESS, STAGE_ROUTE, STAGE_LOOP
+
+# Инициализация логирования сервера.
+logger = logging.getLogger('server')
+
+
+# Сессия подключения в asyncio варианте сервера. Повторяет интерфейс Session из server.py
+# (stream, sendall, close), поэтому обработчики process_client_message и process_message работают без изменений.
+# Очередь отправки - буфер транспорта asyncio, границы очереди проверяются по его размеру. Кадры, отправленные
+# за один проход цикла событий (или за max_delay секунд), копятся в pending и передаются транспорту одним
+# вызовом writelines - один системный вызов на пачку вместо одного на кадр.
+class AsyncSession:
+    __slots__ = ('writer', 'fd', 'address', 'stream', 'account', 'closed', 'high_watermark', 'low_watermark',
+                 'slow_policy', 'congested', 'dropped', 'replay_after', 'replay_task', 'channels', 'pending',
+                 'pending_bytes', 'max_delay', 'last_activity', 'pinged_at', 'bucket',
+                 'limited_at', 'uploads', 'receiving', 'downloads', 'download_task', 'tag', 'subs', 'contacts')
+
+    def __init__(self, writer, address, high_watermark=OUT_HIGH_WATERMARK, low_watermark=OUT_LOW_WATERMARK,
+                 slow_policy=SLOW_POLICY_DROP, max_delay=FLUSH_MAX_DELAY):
+        self.writer = writer
+        self.fd = writer.get_extra_info('socket').fileno()
+        self.address = address
+        self.stream = MessageStream()
+        self.account = None
+        self.closed = False
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_policy = slow_policy
+        self.congested = False
+        self.dropped = 0
+        self.replay_after = None
+        self.replay_task = None
+        self.channels = None
+        self.pending = None
+        self.pending_bytes = 0
+        self.max_delay = max_delay
+        self.last_activity = time.monotonic()
+        self.pinged_at = None
+        self.bucket = None
+        self.limited_at = None
+        self.uploads = None
+        self.receiving = None
+        self.downloads = None
+        self.download_task = None
+        self.tag = None
+        self.subs = None
+        self.contacts = None
+
+    # Метка пользователя мультиплексированного подключения, как Session.switch_tag.
+    def switch_tag(self, owner):
+        self.tag = owner
+        return owner.tag_frame if owner is not None else multiplex_tag(self.account)
+
+    def sendall(self, data, owner=None):
+        if self.closed:
+            return
+        buffered = self.writer.transport.get_write_buffer_size() + self.pending_bytes
+        if self.congested and buffered <= self.low_watermark:
+            logger.info('Клиент %s освободил очередь, отброшено сообщений: %s.', self.address, self.dropped)
+            self.congested = False
+            self.dropped = 0
+        if buffered + len(data) > self.high_watermark:
+            if self.slow_policy == SLOW_POLICY_DISCONNECT:
+                raise SlowConsumerError(self.address)
+            if not self.congested:
+                logger.warning('Клиент %s не успевает принимать данные, сообщения отбрасываются.', self.address)
+            self.congested = True
+        if self.congested:
+            self.dropped += 1
+            server_metrics.dropped_total += 1
+            return
+        if self.pending is None:
+            self.pending = []
+            loop = asyncio.get_running_loop()
+            if self.max_delay:
+                loop.call_later(self.max_delay, self.flush)
+            else:
+                loop.call_soon(self.flush)
+        if self.tag is not owner:
+            tag = self.switch_tag(owner)
+            self.pending.append(tag)
+            self.pending_bytes += len(tag)
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+
+    # Передача кадра транспорту сразу, после накопленных и без проверки границ очереди (заголовок куска файла).
+    def write_direct(self, data, owner=None):
+        self.flush()
+        if self.tag is not owner:
+            data = self.switch_tag(owner) + data
+        self.writer.write(data)
+
+    # Передача накопленных кадров транспорту.
+    def flush(self):
+        pending = self.pending
+        if not pending:
+            return
+        self.pending = None
+        self.pending_bytes = 0
+        if self.writer.is_closing():
+            return
+        self.writer.writelines(pending)
+        server_metrics.messages_out_total += len(pending)
+        server_metrics.bytes_out_total += sum(map(len, pending))
+
+    # Начало скачивания файла, как Session.start_download. Куски отправляет задача AsyncServer.send_files.
+    def start_download(self):
+        limit_unsent(self.writer.get_extra_info('socket'))
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        self.writer.close()
+
+
+# Сервер на asyncio: каждое подключение обслуживает своя сопрограмма, чтение через StreamReader.
+class AsyncServer:
+    def __init__(self, listen_address, listen_port, high_watermark=OUT_HIGH_WATERMARK,
+                 low_watermark=OUT_LOW_WATERMARK, slow_policy=SLOW_POLICY_DROP, passthrough=True,
+                 store=None, max_delay=FLUSH_MAX_DELAY, idle_timeout=IDLE_TIMEOUT, pong_timeout=PONG_TIMEOUT,
+                 limits=None, history=None, spool=None, contacts=None, raw_idle_timeout=RAW_IDLE_TIMEOUT):
+        self.addr = listen_address
+        self.port = listen_port
+        self.store = store
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_policy = slow_policy
+        self.passthrough = passthrough
+        self.max_delay = max_delay
+        self.idle_timeout = idle_timeout
+        self.pong_timeout = pong_timeout
+        self.raw_idle_timeout = raw_idle_timeout
+        self.timers = TimerWheel(TIMER_TICK, TIMER_WHEEL_SIZE, time.monotonic()) if idle_timeout else None
+        self.limits = limits
+        self.history = history
+        self.spool = spool
+        self.contacts = contacts
+
+        # сессии клиентов по номеру дескриптора, очередь сообщений
+        self.sessions = dict()
+        self.messages = []
+
+        # Словарь, содержащий имена пользователей и соответствующие им сессии.
+        self.names = dict()
+        # Участники каналов: имя канала - множество сессий.
+        self.channels = dict()
+
+    def remove_client(self, client):
+        if type(client) is SubSession:
+            client = client.connection
+        if self.sessions.get(client.fd) is not client:
+            client.close()
+            return
+        del self.sessions[client.fd]
+        server_metrics.disconnects_total += 1
+        if self.timers is not None:
+            self.timers.cancel(client)
+        if self.limits is not None:
+            self.limits.release(client.address[0], time.monotonic())
+        self.release_account(client)
+        for sub in list((client.subs or {}).values()):
+            sub.closed = True
+            self.release_account(sub)
+        client.close()
+
+    # Выход пользователя мультиплексированного подключения, как Server.remove_account.
+    def remove_account(self, client):
+        client.closed = True
+        if client.connection.subs.get(client.name) is client:
+            del client.connection.subs[client.name]
+        self.release_account(client)
+
+    def release_account(self, client):
+        if client.account is not None and self.names.get(client.account) is client:
+            del self.names[client.account]
+            if self.contacts is not None:
+                self.contacts.logout(client)
+        if self.store is not None:
+            self.store.finish_replay(client)
+        if self.spool is not None:
+            self.spool.release(client)
+        for room in list(client.channels or ()):
+            leave_channel(self.channels, client, room)
+
+    # Обработка одного подключения: все кадры, принятые одним чтением, разбираются сразу.
+    async def handle_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        if self.limits is not None:
+            self.limits.prune(time.monotonic())
+            error = self.limits.accept(address[0], time.monotonic())
+            if error is not None:
+                logger.warning('Отклонено подключение с ПК %s: %s', address, error)
+                server_metrics.rejected_total += 1
+                writer.write(MessageStream().encode({**RESPONSE_429, ERROR: error}))
+                writer.close()
+                return
+        # TCP_NODELAY транспорт asyncio устанавливает сам, пачки кадров собирает AsyncSession
+        client = AsyncSession(writer, address, self.high_watermark, self.low_watermark, self.slow_policy,
+                              self.max_delay)
+        logger.info('Установлено соедение с ПК %s', client.address)
+        server_metrics.connections_total += 1
+        self.sessions[client.fd] = client
+        if self.timers is not None:
+            self.timers.schedule(client, self.idle_timeout, client.last_activity)
+        if self.limits is not None:
+            client.bucket = self.limits.session_bucket(client.last_activity)
+        try:
+            while not client.closed:
+                data = await reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                client.last_activity = time.monotonic()
+                server_metrics.bytes_in_total += len(data)
+                timing = server_metrics.timing
+                started = time.perf_counter_ns() if timing else 0
+                client.stream.feed(data)
+                while not client.closed:
+                    payload = client.stream.next_frame()
+                    if payload is None:
+                        break
+                    server_metrics.messages_in_total += 1
+                    target = client
+                    if client.stream.tag is not None:
+                        target = account_session(client, client.stream.tag, self.limits, time.monotonic())
+                        if target is None:
+                            continue
+                    if target.receiving is not None:
+                        receive_chunk(target, payload, self.spool, self.messages, self.history)
+                        continue
+                    if self.limits is not None:
+                        await self.throttle(target)
+                        if client.closed:
+                            break
+                    route = client.stream.peek_route(payload) if self.passthrough else None
+                    if route is not None and self.relay(target, payload, route):
+                        server_metrics.relayed_total += 1
+                        if timing:
+                            started = server_metrics.observe(STAGE_ROUTE, started)
+                        continue
+                    message = client.stream.decode(payload)
+                    if timing:
+                        started = server_metrics.observe(STAGE_PARSE, started)
+                    replaying = target.replay_after is not None
+                    process_client_message(message, self.messages, target, self.names, store=self.store,
+                                           channels=self.channels, history=self.history, spool=self.spool,
+                                           contacts=self.contacts)
+                    if target is not client and (target.closed or target.account != target.name):
+                        self.remove_account(target)
+                        continue
+                    if not replaying and target.replay_after is not None:
+                        target.replay_task = asyncio.create_task(self.replay(target))
+                    if target.downloads and target.download_task is None:
+                        target.download_task = asyncio.create_task(self.send_files(target))
+                    if timing:
+                        started = server_metrics.observe(STAGE_PROCESS, started)
+                if self.messages:
+                    self.process_messages()
+                    if timing:
+                        server_metrics.observe(STAGE_ROUTE, started)
+        except IncorrectDataRecivedError:
+            server_metrics.decode_errors_total += 1
+        except (OSError, asyncio.IncompleteReadError, SlowConsumerError):
+            # обрыв соединения или отключение медленного клиента - обычное завершение подключения
+            pass
+        except Exception:
+            logger.exception('Ошибка обработки данных клиента %s, клиент отключён.', client.address)
+        logger.info('Клиент %s отключился от сервера.', client.address)
+        self.remove_client(client)
+
+    # Ожидание токена для очередного кадра клиента. Пока сопрограмма подключения ждёт, данные из сокета
+    # не читаются, отправителя замедляет управление потоком TCP. Клиенту отправляется ответ 429, как в Server.pause.
+    async def throttle(self, client):
+        now = time.monotonic()
+        wait = self.limits.take(client.bucket, client.address[0], now)
+        if not wait:
+            return
+        server_metrics.rate_limited_total += 1
+        logger.debug('Клиент %s превысил предел частоты сообщений, чтение приостановлено на %.3f с.',
+                     client.address, wait)
+        if client.limited_at is None or now - client.limited_at >= RATE_NOTICE_INTERVAL:
+            client.limited_at = now
+            send_message(client, {**RESPONSE_429, ERROR: 'Превышена частота сообщений.'}, client.stream)
+        while wait and not client.closed:
+            await asyncio.sleep(wait)
+            wait = self.limits.take(client.bucket, client.address[0], time.monotonic())
+
+    # Быстрая пересылка кадра сообщения, как в Server.relay.
+    def relay(self, client, payload, route):
+        self.process_messages()
+        try:
+            relayed = relay_frame(payload, route, client, self.names)
+        except Exception:
+            logger.info('Связь с клиентом с именем %s была потеряна', route[1])
+            if route[1] in self.names:
+                self.remove_client(self.names[route[1]])
+            return True
+        if relayed and self.history is not None:
+            self.history.record(payload, client.stream.codec.wire, client.stream.compression)
+        return relayed
+
+    # Отправка готовых результатов поиска по истории, вызывается циклом событий по готовности history.fileno().
+    def deliver_results(self):
+        for client, response in self.history.read():
+            if client.closed:
+                continue
+            try:
+                send_message(client, response, client.stream)
+            except (SlowConsumerError, OSError):
+                logger.info('Связь с клиентом с именем %s была потеряна', client.account)
+                self.remove_client(client)
+
+    # Рассылка изменений присутствия раз в интервал Contacts, как в Server.deliver_presence. За тик выполняется
+    # ограниченная часть рассылки, между тиками цикл событий обслуживает подключения.
+    async def push_presence(self):
+        while True:
+            await asyncio.sleep(self.contacts.interval)
+            for client, message in self.contacts.flush():
+                if client.closed:
+                    continue
+                try:
+                    client.sendall(client.stream.encode(message))
+                except (SlowConsumerError, OSError):
+                    logger.info('Связь с клиентом с именем %s была потеряна', client.account)
+                    self.remove_client(client)
+
+    # Если есть сообщения, обрабатываем каждое.
+    def process_messages(self):
+        for i in self.messages:
+            try:
+                failed = process_message(i, self.names, store=self.store, channels=self.channels)
+            except Exception:
+                logger.info('Связь с клиентом с именем %s была потеряна', i[DESTINATION])
+                if i[DESTINATION] in self.names:
+                    self.remove_client(self.names[i[DESTINATION]])
+                continue
+            for client in failed or ():
+                logger.info('Связь с клиентом с именем %s была потеряна', client.account)
+                self.remove_client(client)
+        self.messages.clear()
+
+    # Отправка сохранённых сообщений пользователю по страницам. Следующая страница читается после того,
+    # как буфер транспорта опустеет (drain), предыдущая при этом удаляется из хранилища.
+    async def replay(self, client):
+        try:
+            while not client.closed:
+                self.store.delete(client.account, client.replay_after)
+                rows = self.store.fetch(client.account, client.replay_after)
+                if not rows:
+                    logger.info('Пользователю %s отправлены все сохранённые сообщения.', client.account)
+                    break
+                for row_id, data in rows:
+                    client.sendall(stored_frame(client.stream, data))
+                    client.replay_after = row_id
+                client.flush()
+                await client.writer.drain()
+        except (ConnectionError, SlowConsumerError):
+            pass
+        self.store.finish_replay(client)
+
+    # Отправка скачиваемых файлов подключения. Файл отображается в память (mmap), кусок передаётся транспорту
+    # срезом memoryview без копирования в память процесса, следующий - после drain, поэтому скачивания разных
+    # подключений чередуются в цикле событий, а сообщения чата не ждут за всем файлом.
+    async def send_files(self, client):
+        current, mapped = None, None
+        try:
+            while not client.closed:
+                chunk = self.spool.next_chunk(client)
+                if chunk is None:
+                    break
+                download, offset, count, header = chunk
+                if download is not current:
+                    close_mapping(mapped)
+                    current, mapped = download, mmap.mmap(download.fd, 0, access=mmap.ACCESS_READ)
+                client.write_direct(client.stream.encode(header) + FRAME_HEADER.pack(count))
+                client.writer.write(memoryview(mapped)[offset:offset + count])
+                server_metrics.bytes_out_total += count
+                await client.writer.drain()
+        except (ConnectionError, OSError, ValueError):
+            pass
+        close_mapping(mapped)
+        client.download_task = None
+
+    # Проверка активности клиентов раз в тик колеса таймеров, как в Server.check_idle.
+    async def check_idle(self):
+        while True:
+            await asyncio.sleep(TIMER_TICK)
+            for client in expire_idle(self.timers, time.monotonic(), self.idle_timeout, self.pong_timeout,
+                                      self.raw_idle_timeout):
+                logger.info('Клиент %s не отвечает на проверку связи, соединение закрывается.', client.address)
+                server_metrics.idle_evicted_total += 1
+                self.remove_client(client)
+
+    # Замер запаздывания цикла событий: насколько позже заданного просыпается задача с sleep(interval).
+    async def monitor_lag(self, interval=0.1):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            server_metrics.stages[STAGE_LOOP].add(int((loop.time() - expected) * 1e9))
+
+    # Текущие значения для метрик, вызывается из потока экспорта.
+    def gauges(self):
+        queues = [client.writer.transport.get_write_buffer_size() + client.pending_bytes
+                  for client in list(self.sessions.values()) if not client.closed]
+        return {
+            'connections': len(self.sessions),
+            'users': len(self.names),
+            'channels': len(self.channels),
+            'out_queue_bytes': sum(queues),
+            'out_queue_max_bytes': max(queues, default=0),
+            'replaying': len(self.store.replaying) if self.store is not None else 0,
+            'downloading': len(self.spool.downloading) if self.spool is not None else 0,
+            'presence_pending': len(self.contacts.changes) if self.contacts is not None else 0,
+        }
+
+    # Периодическая запись сохранённых сообщений на диск.
+    async def commit_store(self):
+        while True:
+            await asyncio.sleep(self.store.commit_interval)
+            self.store.flush()
+
+    async def serve(self):
+        logger.info(
+            'Запущен asyncio сервер, порт для подключений: %s , адрес с которого принимаются подключения: %s. Если адрес не указан, принимаются соединения с любых адресов.',
+            self.port, self.addr)
+        server = await asyncio.start_server(self.handle_client, self.addr or None, self.port,
+                                            backlog=MAX_CONNECTIONS, reuse_address=True)
+        # ссылки на задачи хранятся, пока работает сервер
+        committer = asyncio.create_task(self.commit_store()) if self.store is not None else None
+        monitor = asyncio.create_task(self.monitor_lag()) if server_metrics.timing else None
+        reaper = asyncio.create_task(self.check_idle()) if self.timers is not None else None
+        presence = asyncio.create_task(self.push_presence()) if self.contacts is not None else None
+        if self.history is not None:
+            asyncio.get_running_loop().add_reader(self.history.fileno(), self.deliver_results)
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        run_event_loop(self.serve())
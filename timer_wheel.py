@@ -0,0 +1,56 @@
+import math
+
+
+# Хешированное колесо таймеров: срок таймера округляется до тика, таймер попадает в ячейку номер_тика % size.
+# Установка и отмена - O(1), при продвижении колеса просматриваются только ячейки прошедших тиков, а не все
+# таймеры. Таймер со сроком дальше одного оборота колеса остаётся в своей ячейке до нужного оборота.
+# Элемент - любой хешируемый объект, у одного элемента не больше одного таймера.
+class TimerWheel:
+    def __init__(self, tick, size, now):
+        self.tick = tick
+        self.slots = [dict() for _ in range(size)]
+        # элемент - ячейка с его таймером
+        self.timers = dict()
+        # последний обработанный тик
+        self.current = int(now / tick)
+
+    def __len__(self):
+        return len(self.timers)
+
+    # Установка (или перенос) таймера элемента на delay секунд от момента now.
+    def schedule(self, item, delay, now):
+        slot = self.timers.pop(item, None)
+        if slot is not None:
+            del slot[item]
+        due = max(self.current + 1, math.ceil((now + delay) / self.tick))
+        slot = self.slots[due % len(self.slots)]
+        slot[item] = due
+        self.timers[item] = slot
+
+    def cancel(self, item):
+        slot = self.timers.pop(item, None)
+        if slot is not None:
+            del slot[item]
+
+    # Продвижение колеса до момента now, возвращает список элементов с истёкшими таймерами.
+    def advance(self, now):
+        target = int(now / self.tick)
+        expired = []
+        # после долгой паузы каждая ячейка просматривается один раз
+        for tick in range(self.current + 1, min(target, self.current + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            for item, due in list(slot.items()):
+                if due <= target:
+                    del slot[item]
+                    del self.timers[item]
+                    expired.append(item)
+        self.current = max(self.current, target)
+        return expired
+
+    # Время до следующего тика (таймаут select()), None если таймеров нет.
+    def timeout(self, now):
+        if not self.timers:
+            return None
+        return max(0, (self.current + 1) * self.tick - now)
@@ -0,0 +1,28 @@
+import sys
+sys.path.append('../')
+from common.utils import MessageStream
+from common.variables import *
+
+
+# Тестовое подключение (участник канала, подписчик, владелец загрузок) с полями сессии сервера,
+# запоминает поставленные в очередь кадры.
+class TestMember:
+    def __init__(self, account, channels=None, framing=FRAMING_LENGTH):
+        self.account = account
+        self.closed = False
+        self.stream = MessageStream(framing)
+        self.channels = channels
+        self.contacts = None
+        self.uploads = None
+        self.receiving = None
+        self.downloads = None
+        self.replay_after = None
+        self.frames = []
+        self.last_activity = 0
+        self.pinged_at = None
+
+    def sendall(self, data):
+        self.frames.append(data)
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,84 @@
+import sys
+sys.path.append('../')
+import os
+import tempfile
+import unittest
+from attachments import AttachmentSpool, DISCARD
+from common.utils import new_attachment_id
+from common.variables import *
+from errors import AttachmentError
+from unit_tests.helpers import TestMember
+
+
+# Тесты хранилища вложений: загрузка кусками, доступ к скачиванию, отключение посреди загрузки.
+class TestAttachmentSpool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.spool = AttachmentSpool(self.directory.name, max_size=1000)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def upload(self, client, data, to='bob'):
+        attachment_id = new_attachment_id()
+        self.spool.upload(client, {ATTACHMENT: attachment_id, FILE_NAME: '../secret/report.txt', SIZE: len(data),
+                                   DESTINATION: to})
+        meta = None
+        for offset in range(0, len(data), 300):
+            self.spool.chunk(client, {ATTACHMENT: attachment_id, OFFSET: offset})
+            meta = self.spool.write(client, data[offset:offset + 300])
+        return attachment_id, meta
+
+    # файл принимается по кускам, описание готово только после последнего
+    def test_upload(self):
+        alice = TestMember('alice')
+        attachment_id, meta = self.upload(alice, b'x' * 700)
+        self.assertEqual(meta[FILE_NAME], 'report.txt')
+        self.assertEqual((meta[SENDER], meta[DESTINATION], meta[SIZE]), ('alice', 'bob', 700))
+        with open(os.path.join(self.directory.name, attachment_id), 'rb') as file:
+            self.assertEqual(file.read(), b'x' * 700)
+        self.assertEqual(alice.uploads, {})
+
+    # скачивать могут отправитель, получатель и участники канала-получателя, куски идут по порядку
+    def test_download(self):
+        attachment_id, _ = self.upload(TestMember('alice', {'#room'}), b'y' * 700, '#room')
+        with self.assertRaises(AttachmentError):
+            self.spool.download(TestMember('carol'), {ATTACHMENT: attachment_id})
+        dave = TestMember('dave', {'#room'})
+        meta = self.spool.download(dave, {ATTACHMENT: attachment_id})
+        self.assertEqual(meta[SIZE], 700)
+        self.assertIn(dave, self.spool.downloading)
+        offsets = []
+        while True:
+            chunk = self.spool.next_chunk(dave)
+            if chunk is None:
+                break
+            offsets.append((chunk[1], chunk[2]))
+        self.assertEqual(offsets, [(0, 700)])
+        self.assertNotIn(dave, self.spool.downloading)
+
+    # кусок не по порядку отменяет загрузку, его данные отбрасываются; отключение удаляет недокачанный файл
+    def test_abort(self):
+        alice = TestMember('alice')
+        attachment_id = new_attachment_id()
+        self.spool.upload(alice, {ATTACHMENT: attachment_id, FILE_NAME: 'a.bin', SIZE: 500, DESTINATION: 'bob'})
+        with self.assertRaises(AttachmentError):
+            self.spool.chunk(alice, {ATTACHMENT: attachment_id, OFFSET: 100})
+        self.assertIs(alice.receiving, DISCARD)
+        self.assertIsNone(self.spool.write(alice, b'z' * 100))
+        self.assertEqual(os.listdir(self.directory.name), [])
+        self.spool.upload(alice, {ATTACHMENT: attachment_id, FILE_NAME: 'a.bin', SIZE: 500, DESTINATION: 'bob'})
+        self.spool.release(alice)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_bad_upload(self):
+        alice = TestMember('alice')
+        for request in ({ATTACHMENT: '../x', FILE_NAME: 'a', SIZE: 1, DESTINATION: 'bob'},
+                        {ATTACHMENT: new_attachment_id(), FILE_NAME: 'a', SIZE: 1001, DESTINATION: 'bob'},
+                        {ATTACHMENT: new_attachment_id(), FILE_NAME: 'a', SIZE: 1, DESTINATION: '#room'}):
+            with self.assertRaises(AttachmentError):
+                self.spool.upload(alice, request)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,12 @@
 import sys
 sys.path.append('../')
-from client import create_presence, process_response_ans
+from client import create_presence, process_response_ans, create_text_message, is_user_message
 from common.variables import *
 import unittest
 from errors import ReqFieldMissingError, ServerError
+from client_async import headless_command, AsyncClient, main_headless
+from common.utils import MessageStream, COMPRESSIONS, DEFAULT_CODEC, pack_payload, read_route, run_event_loop
+import asyncio
 
 
 # Класс с тестами
@@ -22,10 +25,54 @@ class TestClass(unittest.TestCase):
     def test_400_ans(self):
         self.assertRaises(ServerError, process_response_ans , {RESPONSE: 400, ERROR: 'Bad Request'})
 
+    # тест сообщения пользователю и его проверки на стороне получателя
+    def test_text_message(self):
+        test = create_text_message('Guest', 'Friend', 'Hi')
+        test[TIME] = 1.1
+        self.assertEqual(test, {ACTION: MESSAGE, SENDER: 'Guest', DESTINATION: 'Friend', TIME: 1.1,
+                                MESSAGE_TEXT: 'Hi'})
+        self.assertTrue(is_user_message(test, 'Friend'))
+        self.assertFalse(is_user_message(test, 'Guest'))
+
     # тест исключения без поля RESPONSE
     def test_no_response(self):
         self.assertRaises(ReqFieldMissingError, process_response_ans, {ERROR: 'Bad Request'})
 
+    # тест разбора команд клиента без интерфейса
+    def test_headless_command(self):
+        test = headless_command('Guest', b'{"to": "Friend", "text": "Hi"}')
+        test[TIME] = 1.1
+        self.assertEqual(test, {ACTION: MESSAGE, SENDER: 'Guest', DESTINATION: 'Friend', TIME: 1.1,
+                                MESSAGE_TEXT: 'Hi'})
+        self.assertEqual(headless_command('Guest', '{"join": "#room"}')[ROOM], '#room')
+        for line in ('not json', '[1]', '{"text": "Hi"}'):
+            self.assertRaises(ValueError, headless_command, 'Guest', line)
+        # отсутствующий файл команд - ошибка до подключения к серверу
+        self.assertEqual(run_event_loop(main_headless(DEFAULT_IP_ADDRESS, 1, 'Guest', '/nonexistent/commands')), 1)
+
+    # испорченный сжатый кадр с корректным заголовком маршрута сервер пересылает без распаковки (peek_route),
+    # получатель пропускает его и принимает следующие сообщения
+    def test_corrupt_compressed_relay(self):
+        compression = COMPRESSIONS['zlib']
+        stream = MessageStream(FRAMING_LENGTH, DEFAULT_CODEC, compression)
+        corrupt = pack_payload(b'x' * 100, compression, DEFAULT_CODEC.wire, ('Guest', 'Friend'))
+        _, offset = read_route(corrupt)
+        corrupt = corrupt[:offset] + b'garbage' * 4
+        self.assertEqual(stream.peek_route(corrupt), ('Guest', 'Friend'))
+        message = create_text_message('Guest', 'Friend', 'Hi')
+        received = []
+
+        async def receive():
+            client = AsyncClient('Friend', on_message=lambda client, message: received.append(message))
+            client.stream = MessageStream(FRAMING_LENGTH, DEFAULT_CODEC, compression)
+            client.reader = asyncio.StreamReader()
+            client.reader.feed_data(client.stream.frame(corrupt) + client.stream.encode(message))
+            client.reader.feed_eof()
+            await client.receive()
+
+        run_event_loop(receive())
+        self.assertEqual(received, [message])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,73 @@
+import sys
+sys.path.append('../')
+import tempfile
+import unittest
+from cluster import WorkerBus
+from common.variables import *
+
+
+# Тесты шины между рабочими процессами.
+class TestWorkerBus(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.buses = []
+
+    def tearDown(self):
+        for bus in self.buses:
+            bus.close()
+        self.directory.cleanup()
+
+    def start(self, worker_id):
+        bus = WorkerBus(worker_id, 2, self.directory.name)
+        self.buses.append(bus)
+        bus.publish_hello()
+        return bus
+
+    # обмен датаграммами, пока они есть у обоих процессов; возвращает сообщения, принятые вторым
+    def exchange(self, first, second):
+        messages = []
+        for _ in range(100):
+            for bus in (first, second):
+                bus.retry_at = [0, 0]
+                bus.flush()
+            first.read()
+            messages += second.read()
+            if not first.pending and not second.pending:
+                break
+        return messages
+
+    # процесс, запущенный позже или перезапущенный, восстанавливает реестр по ответам на hello
+    def test_resync(self):
+        first = self.start(0)
+        first.publish_online('alice')
+        self.assertEqual(first.pending, 2)
+        second = self.start(1)
+        self.exchange(first, second)
+        self.assertEqual(second.remote_names, {'alice': 0})
+        second.publish_online('bob')
+        self.exchange(first, second)
+        self.assertEqual(first.remote_names, {'bob': 1})
+
+        second.close()
+        second = self.start(1)
+        self.assertEqual(second.remote_names, {})
+        self.exchange(first, second)
+        self.assertEqual(second.remote_names, {'alice': 0})
+        self.assertEqual(first.remote_names, {})
+        self.assertIn(('alice', True), second.changes)
+
+    # сообщение длиннее датаграммы передаётся частями
+    def test_long_message(self):
+        first, second = self.start(0), self.start(1)
+        self.exchange(first, second)
+        second.publish_online('bob')
+        self.exchange(second, first)
+        message = {ACTION: MESSAGE, SENDER: 'alice', DESTINATION: 'bob', TIME: 1.1,
+                   MESSAGE_TEXT: 'x' * (BUS_FRAGMENT_SIZE * 5)}
+        self.assertTrue(first.forward(message))
+        self.assertEqual(self.exchange(first, second), [message])
+        self.assertEqual(second.fragments, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import sys
+sys.path.append('../')
+from contacts import Contacts
+from common.variables import *
+from unit_tests.helpers import TestMember
+import unittest
+
+
+# Тесты списков контактов и рассылки изменений присутствия.
+class TestContacts(unittest.TestCase):
+    def setUp(self):
+        self.contacts = Contacts(':memory:', interval=0)
+
+    def tearDown(self):
+        self.contacts.close()
+
+    def login(self, account):
+        member = TestMember(account)
+        self.contacts.login(member)
+        return member
+
+    # список контактов сохраняется между входами, подписчик получает одно сообщение со всеми изменениями
+    def test_subscriptions(self):
+        alice = self.login('alice')
+        self.contacts.add(alice, 'bob')
+        self.contacts.add(alice, 'carol')
+        self.contacts.logout(alice)
+        self.assertEqual(self.contacts.watchers, {})
+        alice = self.login('alice')
+        self.assertEqual(self.contacts.status(alice), {'bob': False, 'carol': False})
+        self.contacts.flush()
+        bob, carol = self.login('bob'), self.login('carol')
+        updates = self.contacts.flush()
+        self.assertEqual(len(updates), 1)
+        self.assertIs(updates[0][0], alice)
+        self.assertEqual(updates[0][1][CONTACTS], {'bob': True, 'carol': True})
+        self.contacts.remove(alice, 'carol')
+        self.contacts.logout(bob)
+        self.contacts.logout(carol)
+        self.assertEqual(self.contacts.flush()[0][1][CONTACTS], {'bob': False})
+
+    # вход и выход до рассылки взаимно сокращаются, повторное событие не учитывается
+    def test_coalesce(self):
+        alice = self.login('alice')
+        self.contacts.add(alice, 'bob')
+        self.contacts.flush()
+        self.contacts.changed('bob', True)
+        self.contacts.changed('bob', True)
+        self.contacts.changed('bob', False)
+        self.assertEqual(self.contacts.flush(), [])
+        self.assertIsNone(self.contacts.timeout())
+
+    # за тик не больше max_fanout доставок, рассылка одного пользователя может растянуться на несколько тиков
+    def test_fanout_limit(self):
+        self.contacts.max_fanout = 3
+        watchers = [self.login(f'user{i}') for i in range(5)]
+        for watcher in watchers:
+            self.contacts.add(watcher, 'star')
+        self.contacts.flush()
+        self.contacts.changed('star', True)
+        first, second = self.contacts.flush(), self.contacts.flush()
+        self.assertEqual((len(first), len(second)), (3, 2))
+        self.assertEqual({client for client, message in first + second}, set(watchers))
+        self.assertEqual(self.contacts.flush(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import sys
+sys.path.append('../')
+import logging
+import unittest
+from decos import log, logger
+
+
+# Объект, считающий обращения к своему представлению.
+class CountingRepr:
+    def __init__(self):
+        self.calls = 0
+
+    def __repr__(self):
+        self.calls += 1
+        return 'CountingRepr'
+
+
+@log
+def decorated(arg):
+    return arg
+
+
+# Тесты декоратора логирования.
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.level = logger.level
+
+    def tearDown(self):
+        logger.setLevel(self.level)
+
+    # при выключенном DEBUG аргументы вызова не форматируются
+    def test_no_format_without_debug(self):
+        logger.setLevel(logging.INFO)
+        arg = CountingRepr()
+        self.assertIs(decorated(arg), arg)
+        self.assertEqual(arg.calls, 0)
+
+    # декоратор сохраняет имя функции
+    def test_wraps(self):
+        self.assertEqual(decorated.__name__, 'decorated')
+
+
+if __name__ == '__main__':
+    unittest.main()
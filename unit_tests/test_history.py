@@ -0,0 +1,77 @@
+import sys
+sys.path.append('../')
+import os
+import select
+import tempfile
+import unittest
+from history import History, PostingCursor, intersect, tokenize
+from common.variables import *
+from unit_tests.helpers import TestMember
+
+
+# Тесты истории сообщений и поиска по ней.
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'history.sqlite3')
+        self.history = History(self.path, flush_interval=60)
+
+    def tearDown(self):
+        self.history.close()
+        self.directory.cleanup()
+
+    def search(self, client, **request):
+        self.history.search(client, request)
+        select.select([self.history], [], [], 5)
+        results = self.history.read()
+        self.assertEqual(len(results), 1)
+        self.assertIs(results[0][0], client)
+        return results[0][1]
+
+    def record(self, sender, destination, text):
+        self.history.record({ACTION: MESSAGE, SENDER: sender, DESTINATION: destination, TIME: 1.1,
+                             MESSAGE_TEXT: text})
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize('Привет, Мир! hello-world'), {'привет', 'мир', 'hello', 'world'})
+
+    # в результатах только сообщения со всеми словами, где пользователь участник или из его каналов,
+    # от новых к старым
+    def test_search(self):
+        self.record('alice', 'bob', 'quick brown fox')
+        self.record('bob', 'alice', 'lazy brown dog')
+        self.record('carol', 'dave', 'brown fox')
+        self.record('carol', '#room', 'brown fox in room')
+        response = self.search(TestMember('alice'), **{QUERY: 'Brown'})
+        self.assertEqual(response[RESPONSE], 200)
+        self.assertEqual([item[MESSAGE_TEXT] for item in response[RESULTS]], ['lazy brown dog', 'quick brown fox'])
+        response = self.search(TestMember('bob', {'#room'}), **{QUERY: 'fox brown'})
+        self.assertEqual([item[MESSAGE_TEXT] for item in response[RESULTS]], ['brown fox in room', 'quick brown fox'])
+        self.assertEqual(self.search(TestMember('dave'), **{QUERY: 'dog'})[RESULTS], [])
+
+    # постраничная выдача: следующая страница - сообщения старше before; индекс, записанный в базу,
+    # и индекс в памяти дают одинаковый результат
+    def test_pages(self):
+        for i in range(50):
+            self.record('alice', 'bob', f'note {i} {"even" if i % 2 == 0 else "odd"}')
+        client = TestMember('bob')
+        first = self.search(client, **{QUERY: 'even note', LIMIT: 10})[RESULTS]
+        self.assertEqual([item[MESSAGE_TEXT] for item in first], [f'note {i} even' for i in range(48, 28, -2)])
+        second = self.search(client, **{QUERY: 'even', LIMIT: 10, BEFORE: first[-1][MESSAGE_ID]})[RESULTS]
+        self.assertEqual([item[MESSAGE_TEXT] for item in second], [f'note {i} even' for i in range(28, 8, -2)])
+        self.history.close()
+        self.history = History(self.path, flush_interval=60)
+        self.assertEqual(self.search(client, **{QUERY: 'even note', LIMIT: 10})[RESULTS], first)
+
+    def test_bad_request(self):
+        self.assertEqual(self.search(TestMember('alice'), **{QUERY: 'x', LIMIT: 'many'})[RESPONSE], 400)
+
+    # пересечение переходит по блокам индекса, не читая их все подряд
+    def test_intersect(self):
+        memory = {'a': list(range(1, 100)), 'b': list(range(3, 100, 7))}
+        cursors = [PostingCursor(None, token, 0, 10, ids) for token, ids in memory.items()]
+        self.assertEqual(list(intersect(cursors, 60)), [59, 52, 45, 38, 31, 24, 17, 10])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import sys
+sys.path.append('../')
+import time
+import unittest
+from metrics import ServerMetrics, STAGE_PARSE
+
+
+# Тесты метрик сервера.
+class TestMetrics(unittest.TestCase):
+    # счётчики и значения сервера выводятся в формате Prometheus
+    def test_render(self):
+        metrics = ServerMetrics()
+        metrics.messages_in_total += 3
+        metrics.gauges = lambda: {'connections': 2}
+        text = metrics.render()
+        self.assertIn('messenger_messages_in_total 3\n', text)
+        self.assertIn('messenger_connections 2\n', text)
+        self.assertNotIn('stage', text)
+
+    # замер этапа возвращает начало следующего
+    def test_observe(self):
+        metrics = ServerMetrics()
+        metrics.timing = True
+        started = time.perf_counter_ns()
+        self.assertGreaterEqual(metrics.observe(STAGE_PARSE, started), started)
+        self.assertEqual(metrics.stages[STAGE_PARSE].count, 1)
+        self.assertIn('messenger_stage_seconds_count{stage="parse"} 1', metrics.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import sys
+sys.path.append('../')
+from offline_store import OfflineStore, stored_frame
+from common.utils import *
+from common.variables import *
+import unittest
+
+
+# Тесты хранилища сообщений для пользователей не в сети.
+class TestOfflineStore(unittest.TestCase):
+    message = {ACTION: MESSAGE, SENDER: 'Guest', DESTINATION: 'test', TIME: 1.1, MESSAGE_TEXT: 'hi'}
+
+    def setUp(self):
+        self.store = OfflineStore(':memory:', commit_interval=60)
+
+    def tearDown(self):
+        self.store.close()
+
+    # сообщения выдаются по страницам в порядке поступления, удаляются только доставленные
+    def test_pages(self):
+        for i in range(5):
+            self.store.append('test', dict(self.message, **{MESSAGE_TEXT: str(i)}))
+        self.store.append('other', self.message)
+        self.assertTrue(self.store.has_messages('test'))
+        page = self.store.fetch('test', 0, 3)
+        self.assertEqual([json.loads(data)[MESSAGE_TEXT] for row_id, data in page], ['0', '1', '2'])
+        self.store.delete('test', page[-1][0])
+        self.assertEqual(len(self.store.fetch('test', 0)), 2)
+        self.store.delete('test', self.store.fetch('test', 0)[-1][0])
+        self.assertFalse(self.store.has_messages('test'))
+        self.assertTrue(self.store.has_messages('other'))
+
+    # принятое сообщение хранится и отправляется исходными байтами
+    def test_stored_frame(self):
+        payload = json.dumps(self.message, separators=(',', ':')).encode(ENCODING)
+        self.store.append('test', MessageStream().decode(payload))
+        row_id, data = self.store.fetch('test', 0)[0]
+        self.assertEqual(data, payload)
+        stream = MessageStream(FRAMING_LENGTH)
+        self.assertEqual(stored_frame(stream, data), FRAME_HEADER.pack(len(payload)) + payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
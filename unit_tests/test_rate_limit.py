@@ -0,0 +1,51 @@
+import sys
+sys.path.append('../')
+from rate_limit import TokenBucket, RateLimits
+import unittest
+
+
+# Тесты ограничений нагрузки.
+class TestRateLimit(unittest.TestCase):
+    # запас расходуется сразу, дальше токены появляются с заданной частотой
+    def test_token_bucket(self):
+        bucket = TokenBucket(10, 3, 0)
+        self.assertEqual([bucket.take(0) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(0), 0.1)
+        self.assertAlmostEqual(bucket.take(0.05), 0.05)
+        self.assertEqual(bucket.take(0.1), 0)
+        self.assertEqual(bucket.take(100), 0)
+        self.assertAlmostEqual(bucket.tokens, 2)
+
+    # предел сообщений с адреса общий для всех его подключений
+    def test_ip_messages(self):
+        limits = RateLimits((10, 5), (10, 8))
+        first, second = limits.session_bucket(0), limits.session_bucket(0)
+        for bucket in (first, second):
+            self.assertIsNone(limits.accept('10.0.0.1', 0))
+        self.assertEqual([limits.take(first, '10.0.0.1', 0) for _ in range(5)], [0] * 5)
+        self.assertGreater(limits.take(first, '10.0.0.1', 0), 0)
+        self.assertEqual([limits.take(second, '10.0.0.1', 0) for _ in range(3)], [0] * 3)
+        self.assertGreater(limits.take(second, '10.0.0.1', 0), 0)
+        # токен подключения, не пропущенный пределом адреса, возвращается
+        self.assertAlmostEqual(second.tokens, 2)
+
+    # число и частота подключений с адреса, состояние адреса удаляется после наполнения вёдер
+    def test_connections(self):
+        limits = RateLimits(ip_accept_rate=(1, 3), ip_max_connections=2)
+        self.assertIsNone(limits.accept('10.0.0.1', 0))
+        self.assertIsNone(limits.accept('10.0.0.1', 0))
+        self.assertIsNotNone(limits.accept('10.0.0.1', 0))
+        limits.release('10.0.0.1', 0)
+        limits.release('10.0.0.1', 0)
+        self.assertIsNone(limits.accept('10.0.0.1', 0))
+        self.assertIsNotNone(limits.accept('10.0.0.1', 0))
+        limits.release('10.0.0.1', 0)
+        self.assertIsNone(limits.accept('10.0.0.2', 0))
+        limits.prune(2)
+        self.assertIn('10.0.0.1', limits.ips)
+        limits.prune(3)
+        self.assertEqual(list(limits.ips), ['10.0.0.2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
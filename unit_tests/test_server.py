@@ -0,0 +1,304 @@
+import sys
+sys.path.append('../')
+from server import Server, Session, broadcast, join_channel, leave_channel, expire_idle, process_client_message
+from timer_wheel import TimerWheel
+from common.utils import MessageStream, FRAME_HEADER, multiplex_tag
+from common.variables import *
+import selectors
+import socket
+import json
+import unittest
+from errors import SlowConsumerError
+from client import create_presence, create_text_message
+from unit_tests.helpers import TestMember
+
+
+# Тестовый сокет, за один вызов send или sendmsg принимает не больше limit байт.
+class TestSocket:
+    def __init__(self, limit):
+        self.limit = limit
+        self.sent = b''
+        self.calls = 0
+
+    def fileno(self):
+        return 3
+
+    def send(self, data):
+        chunk = bytes(data[:self.limit])
+        self.sent += chunk
+        return len(chunk)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.send(b''.join(buffers))
+
+    def close(self):
+        pass
+
+
+# Тестовый селектор, запоминает последнюю маску событий.
+class TestSelector:
+    def __init__(self):
+        self.events = None
+
+    def modify(self, fileobj, events, data=None):
+        self.events = events
+
+
+# Тесты очереди отправки подключения.
+class TestConnection(unittest.TestCase):
+    def make_connection(self, limit, policy=SLOW_POLICY_DROP):
+        return Session(TestSocket(limit), ('127.0.0.1', 1), TestSelector(), set(), high_watermark=10,
+                       low_watermark=4, slow_policy=policy)
+
+    # частичная отправка досылается при следующей готовности сокета
+    def test_partial_flush(self):
+        conn = self.make_connection(3)
+        conn.sendall(b'abcde')
+        self.assertIn(conn, conn.dirty)
+        conn.flush()
+        self.assertEqual(conn.sock.sent, b'abc')
+        self.assertEqual(conn.selector.events, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        conn.flush()
+        self.assertEqual(conn.sock.sent, b'abcde')
+        self.assertEqual(conn.out_bytes, 0)
+        self.assertEqual(conn.selector.events, selectors.EVENT_READ)
+
+    # накопленные кадры уходят одним вызовом sendmsg, не больше max_batch кадров за вызов
+    def test_batch_flush(self):
+        conn = self.make_connection(100)
+        for data in (b'ab', b'cd', b'ef'):
+            conn.sendall(data)
+        conn.flush()
+        self.assertEqual((conn.sock.sent, conn.sock.calls), (b'abcdef', 1))
+        for data in (b'gh', b'ij', b'kl'):
+            conn.sendall(data)
+        conn.flush(max_batch=2)
+        self.assertEqual((conn.sock.sent, conn.sock.calls), (b'abcdefghijkl', 3))
+        self.assertIsNone(conn.out_queue)
+
+    # при переполнении кадры отбрасываются до опустошения очереди ниже нижней границы
+    def test_drop_policy(self):
+        conn = self.make_connection(2)
+        conn.sendall(b'123456')
+        conn.sendall(b'7890a')
+        self.assertTrue(conn.congested)
+        conn.flush()
+        conn.sendall(b'bc')
+        self.assertEqual(conn.dropped, 2)
+        conn.flush()
+        conn.flush()
+        self.assertFalse(conn.congested)
+        self.assertEqual(conn.sock.sent, b'123456')
+
+    # при политике отключения переполнение очереди вызывает исключение
+    def test_disconnect_policy(self):
+        conn = self.make_connection(2, SLOW_POLICY_DISCONNECT)
+        conn.sendall(b'123456')
+        self.assertRaises(SlowConsumerError, conn.sendall, b'7890a')
+
+
+# Тесты обработки сообщений клиентов.
+class TestProcessMessage(unittest.TestCase):
+    def response(self, member):
+        return json.loads(member.frames[-1][FRAME_HEADER.size:])
+
+    # имя пользователя не может быть пустым или именем канала
+    def test_presence_name(self):
+        for name in ('#room', '', 42):
+            names = {}
+            member = TestMember(None)
+            process_client_message({ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: name}}, [], member, names)
+            self.assertEqual(self.response(member)[RESPONSE], 400)
+            self.assertTrue(member.closed)
+            self.assertEqual((names, member.account), ({}, None))
+        member = TestMember(None)
+        process_client_message({ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'alice'}}, [], member, names)
+        self.assertEqual(self.response(member)[RESPONSE], 200)
+        self.assertEqual(names, {'alice': member})
+
+    # сообщение от имени другого пользователя не принимается
+    def test_message_sender(self):
+        messages = []
+        member = TestMember('mallory')
+        message = {ACTION: MESSAGE, SENDER: 'alice', DESTINATION: 'bob', TIME: 1.1, MESSAGE_TEXT: 'hi'}
+        process_client_message(message, messages, member, {})
+        self.assertEqual((messages, self.response(member)[RESPONSE]), ([], 400))
+        process_client_message({**message, SENDER: 'mallory'}, messages, member, {})
+        self.assertEqual(len(messages), 1)
+
+
+# Тесты каналов.
+class TestChannels(unittest.TestCase):
+    message = {ACTION: MESSAGE, SENDER: 'a', DESTINATION: '#room', TIME: 1.1, MESSAGE_TEXT: 'hi'}
+
+    # сообщение кодируется один раз на формат потока, отправитель его не получает
+    def test_broadcast(self):
+        members = [TestMember(name) for name in 'abc'] + [TestMember('d', framing=FRAMING_RAW)]
+        self.assertEqual(broadcast(self.message, members, 'a'), [])
+        self.assertEqual(members[0].frames, [])
+        self.assertIs(members[1].frames[0], members[2].frames[0])
+        self.assertEqual(json.loads(members[3].frames[0]), self.message)
+
+    # пустой канал удаляется из индекса
+    def test_join_leave(self):
+        channels = {}
+        member = TestMember('a')
+        join_channel(channels, member, '#room')
+        self.assertEqual(channels, {'#room': {member}})
+        leave_channel(channels, member, '#room')
+        self.assertEqual(channels, {})
+        self.assertFalse(member.channels)
+
+
+# Тесты проверки активности клиентов.
+class TestIdle(unittest.TestCase):
+    # молчащему клиенту отправляется PING, ответивший остаётся, не ответивший отключается
+    def test_expire_idle(self):
+        timers = TimerWheel(1.0, 16, 0)
+        active, silent = TestMember('active'), TestMember('silent')
+        for member in (active, silent):
+            timers.schedule(member, 10, 0)
+        active.last_activity = 5
+        self.assertEqual(expire_idle(timers, 10, 10, 3), [])
+        self.assertEqual((active.frames, len(silent.frames)), ([], 1))
+        self.assertEqual(json.loads(silent.frames[0][FRAME_HEADER.size:])[ACTION], PING)
+        silent.last_activity = 11
+        self.assertEqual(expire_idle(timers, 13, 10, 3), [])
+        self.assertIsNone(silent.pinged_at)
+        self.assertEqual(expire_idle(timers, 15, 10, 3), [])
+        self.assertEqual(len(active.frames), 1)
+        self.assertEqual(expire_idle(timers, 18, 10, 3), [active])
+
+
+# Тесты сервера на реакторе: клиенты подключены через пары сокетов, итерации цикла сервера выполняются в тесте.
+class TestReactor(unittest.TestCase):
+    def setUp(self):
+        self.server = Server('127.0.0.1', 0, idle_timeout=0)
+        self.clients = []
+
+    def tearDown(self):
+        for sock, stream in self.clients:
+            sock.close()
+        for session in list(self.server.sessions.values()):
+            self.server.remove_client(session)
+        self.server.selector.close()
+
+    # Подключение и регистрация клиента, multiplex - шлюз мультиплексированного подключения,
+    # framing=None - старый клиент без кадров длины.
+    def connect(self, account, multiplex=False, framing=FRAMING_LENGTH):
+        sock, server_sock = socket.socketpair()
+        sock.settimeout(1)
+        server_sock.setblocking(False)
+        session = Session(server_sock, ('127.0.0.1', 1), self.server.selector, self.server.dirty)
+        self.server.sessions[session.fd] = session
+        self.server.selector.register(server_sock, selectors.EVENT_READ, session)
+        client = (sock, MessageStream())
+        self.clients.append(client)
+        self.send(client, create_presence(account, framing, multiplex=multiplex))
+        (tag, response), = self.receive(client)
+        self.assertEqual(response[RESPONSE], 200)
+        client[1].configure(response)
+        return client
+
+    # Отправка сообщений или готовых кадров (tag - метка пользователя шлюза перед ними) и итерация цикла сервера.
+    def send(self, client, *messages, tag=None):
+        sock, stream = client
+        data = multiplex_tag(tag) if tag is not None else b''
+        sock.sendall(data + b''.join(message if isinstance(message, bytes) else stream.encode(message)
+                                     for message in messages))
+        for key, mask in self.server.selector.select(0.1):
+            self.server.read_client(key.data)
+        self.server.process_messages(self.server.messages, None)
+        self.server.messages.clear()
+        self.server.flush_sessions()
+
+    # Принятые клиентом сообщения: список (метка, сообщение).
+    def receive(self, client):
+        sock, stream = client
+        stream.feed(sock.recv(RECV_BUFFER_SIZE))
+        messages = []
+        while True:
+            payload = stream.next_frame()
+            if payload is None:
+                return messages
+            messages.append((stream.tag, stream.decode(payload)))
+
+    # молчащему старому клиенту PING не отправляется, его отключают только после raw_idle_timeout
+    def test_idle_raw_client(self):
+        self.server.selector.close()
+        self.server = Server('127.0.0.1', 0, idle_timeout=10, pong_timeout=3, raw_idle_timeout=100)
+        legacy, alice = self.connect('legacy', framing=None), self.connect('alice')
+        start = self.server.now
+        for session in self.server.sessions.values():
+            self.server.timers.schedule(session, self.server.idle_timeout, start)
+        self.server.now = start + 11
+        self.server.check_idle()
+        self.server.flush_sessions()
+        self.assertEqual([message[ACTION] for tag, message in self.receive(alice)], [PING])
+        self.assertEqual(set(self.server.names), {'legacy', 'alice'})
+        self.server.now = start + 15
+        self.server.check_idle()
+        self.assertEqual(list(self.server.names), ['legacy'])
+        legacy[0].setblocking(False)
+        self.assertRaises(BlockingIOError, legacy[0].recv, RECV_BUFFER_SIZE)
+        self.server.now = start + 101
+        self.server.check_idle()
+        self.assertEqual((self.server.names, self.server.sessions), ({}, {}))
+
+    # сообщение без отправителя верхнего уровня не пересылается и не отключает отправителя: ответ 400
+    def test_relay_nested_sender(self):
+        alice, bob = self.connect('alice'), self.connect('bob')
+        frame = alice[1].frame(b'{"action":"message","to":"bob","time":1,"mess_text":"x","n":{"from":"alice"}}')
+        self.send(alice, frame)
+        self.assertEqual([message[RESPONSE] for tag, message in self.receive(alice)], [400])
+        self.assertEqual(set(self.server.names), {'alice', 'bob'})
+
+    # обмен сообщениями клиента и пользователей шлюза: кадры помечаются метками пользователей
+    def test_multiplex_tags(self):
+        gateway = self.connect('g0', multiplex=True)
+        self.send(gateway, create_presence('g1'), tag='g1')
+        self.assertEqual([(tag, response[RESPONSE]) for tag, response in self.receive(gateway)], [('g1', 200)])
+        bob = self.connect('bob')
+        self.send(gateway, create_text_message('g1', 'bob', 'from g1'), tag='g1')
+        self.send(gateway, create_text_message('g0', 'bob', 'from g0'), tag='g0')
+        self.assertEqual([(message[SENDER], message[MESSAGE_TEXT]) for tag, message in self.receive(bob)],
+                         [('g1', 'from g1'), ('g0', 'from g0')])
+        self.send(bob, create_text_message('bob', 'g1', 'to g1'), create_text_message('bob', 'g0', 'to g0'))
+        self.assertEqual([(tag, message[DESTINATION]) for tag, message in self.receive(gateway)],
+                         [('g1', 'g1'), ('g0', 'g0')])
+        # сообщение от имени другого пользователя шлюза не принимается
+        self.send(gateway, create_text_message('g0', 'bob', 'spoofed'), tag='g1')
+        self.assertEqual([(tag, message[RESPONSE]) for tag, message in self.receive(gateway)], [('g1', 400)])
+
+    # пользователь шлюза регистрируется только под именем из метки
+    def test_multiplex_presence_name(self):
+        gateway = self.connect('g0', multiplex=True)
+        self.send(gateway, create_presence('other'), tag='g1')
+        self.assertEqual([(tag, response[RESPONSE]) for tag, response in self.receive(gateway)], [('g1', 400)])
+        self.assertEqual(set(self.server.names), {'g0'})
+        session = self.server.names['g0']
+        self.assertFalse(session.subs)
+        self.send(gateway, create_presence('g1'), tag='g1')
+        self.assertEqual(set(self.server.names), {'g0', 'g1'})
+
+    # выход пользователя шлюза освобождает только его имя, отключение шлюза - имена всех его пользователей
+    def test_multiplex_release(self):
+        gateway = self.connect('g0', multiplex=True)
+        self.send(gateway, create_presence('g1'), create_presence('g2'), tag='g1')
+        self.send(gateway, create_presence('g2'), tag='g2')
+        self.receive(gateway)
+        self.assertEqual(set(self.server.names), {'g0', 'g1', 'g2'})
+        self.send(gateway, {ACTION: EXIT, TIME: 1.1, ACCOUNT_NAME: 'g1'}, tag='g1')
+        self.assertEqual(set(self.server.names), {'g0', 'g2'})
+        self.assertEqual(set(self.server.names['g0'].subs), {'g2'})
+        self.send(gateway, create_presence('g1'), tag='g1')
+        self.assertEqual(set(self.server.names), {'g0', 'g1', 'g2'})
+        gateway[0].close()
+        self.clients.remove(gateway)
+        self.send(self.connect('bob'))
+        self.assertEqual(set(self.server.names), {'bob'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import sys
+sys.path.append('../')
+import asyncio
+import unittest
+from server_async import AsyncServer
+from client_async import AsyncClient
+from common.utils import run_event_loop
+from common.variables import *
+from errors import ServerError
+
+
+# Тесты asyncio варианта сервера: сервер и клиенты работают в одном цикле событий.
+class TestAsyncServer(unittest.TestCase):
+    def setUp(self):
+        self.server = AsyncServer('127.0.0.1', 0, idle_timeout=0)
+
+    def run_with_server(self, test):
+        async def run():
+            listener = await asyncio.start_server(self.server.handle_client, '127.0.0.1', 0)
+            try:
+                await test(listener.sockets[0].getsockname()[1])
+            finally:
+                listener.close()
+                await listener.wait_closed()
+
+        run_event_loop(run())
+
+    # ожидание условия, пока сервер обрабатывает данные в том же цикле событий
+    async def wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('условие не выполнено')
+
+    # регистрация, сообщение пользователю и выход
+    def test_round_trip(self):
+        received = []
+
+        async def test(port):
+            alice = AsyncClient('alice', server_port=port)
+            bob = AsyncClient('bob', server_port=port, on_message=lambda client, message: received.append(message))
+            self.assertEqual(await alice.connect(), '200 : OK')
+            await bob.connect()
+            self.assertEqual(set(self.server.names), {'alice', 'bob'})
+            alice.send('bob', 'Hi')
+            await alice.drain()
+            await self.wait_for(lambda: received)
+            self.assertEqual((received[0][SENDER], received[0][MESSAGE_TEXT]), ('alice', 'Hi'))
+            # занятое имя не выдаётся второму подключению
+            intruder = AsyncClient('bob', server_port=port)
+            with self.assertRaises(ServerError):
+                await intruder.connect()
+            intruder.writer.close()
+            await alice.close()
+            await self.wait_for(lambda: 'alice' not in self.server.names)
+            await bob.close()
+            await self.wait_for(lambda: not self.server.names and not self.server.sessions)
+
+        self.run_with_server(test)
+
+    # ошибка в обработке данных клиента записывается в журнал, клиент отключается
+    def test_handler_error(self):
+        def broken():
+            raise KeyError('broken')
+
+        async def test(port):
+            alice = AsyncClient('alice', server_port=port)
+            await alice.connect()
+            self.server.process_messages = broken
+            with self.assertLogs('server', 'ERROR') as logs:
+                alice.send('alice', 'Hi')
+                await alice.drain()
+                await self.wait_for(lambda: not self.server.sessions)
+            self.assertIn('KeyError', logs.output[0])
+            await alice.close()
+
+        self.run_with_server(test)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import sys
+sys.path.append('../')
+from timer_wheel import TimerWheel
+import unittest
+
+
+# Тесты колеса таймеров.
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(1.0, 8, 100.0)
+
+    # таймер срабатывает на тике своего срока, не раньше
+    def test_expire(self):
+        self.wheel.schedule('a', 2.5, 100.0)
+        self.wheel.schedule('b', 1, 100.0)
+        self.assertEqual(self.wheel.advance(101.0), ['b'])
+        self.assertEqual(self.wheel.advance(102.5), [])
+        self.assertEqual(self.wheel.advance(103.0), ['a'])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertIsNone(self.wheel.timeout(103.0))
+
+    # срок дальше оборота колеса и долгая пауза между продвижениями
+    def test_long_delay(self):
+        self.wheel.schedule('a', 20, 100.0)
+        self.wheel.schedule('b', 3, 100.0)
+        self.assertEqual(self.wheel.advance(112.0), ['b'])
+        self.assertEqual(self.wheel.advance(119.0), [])
+        self.assertEqual(self.wheel.advance(150.0), ['a'])
+
+    # перенос и отмена таймера
+    def test_reschedule_cancel(self):
+        self.wheel.schedule('a', 1, 100.0)
+        self.wheel.schedule('a', 5, 100.0)
+        self.wheel.schedule('b', 1, 100.0)
+        self.wheel.cancel('b')
+        self.assertEqual(self.wheel.advance(104.0), [])
+        self.assertEqual(self.wheel.timeout(104.5), 0.5)
+        self.assertEqual(self.wheel.advance(105.0), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
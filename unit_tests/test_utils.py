@@ -3,7 +3,7 @@ sys.path.append('../')
 from common.utils import *
 from common.variables import *
 import unittest
-from errors import NonDictInputError
+from errors import NonDictInputError, IncorrectDataRecivedError
 
 
 # Тестовый класс для тестирования отпраки и получения, при создании требует словарь, который будет прогонятся
@@ -58,6 +58,133 @@ class Tests(unittest.TestCase):
         # тест корректной расшифровки ошибочного словаря
         self.assertEqual(get_message(test_sock_err), self.test_dict_recv_err)
 
+    # несколько кадров с префиксом длины в одном recv и кадр, разбитый на части
+    def test_stream_length_frames(self):
+        stream = MessageStream(FRAMING_LENGTH)
+        data = stream.encode(self.test_dict_recv_ok) + stream.encode(self.test_dict_recv_err)
+        stream.feed(data[:-3])
+        self.assertEqual(stream.decode(stream.next_frame()), self.test_dict_recv_ok)
+        self.assertIsNone(stream.next_frame())
+        stream.feed(data[-3:])
+        self.assertEqual(stream.decode(stream.next_frame()), self.test_dict_recv_err)
+        self.assertIsNone(stream.next_frame())
+
+    # склеенные JSON сообщения старых клиентов разбираются по отдельности
+    def test_stream_raw_frames(self):
+        stream = MessageStream()
+        stream.feed(json.dumps(self.test_dict_send).encode(ENCODING) + b'{"response": 2')
+        self.assertEqual(stream.decode(stream.next_frame()), self.test_dict_send)
+        self.assertIsNone(stream.next_frame())
+        stream.feed(b'00}')
+        self.assertEqual(stream.decode(stream.next_frame()), self.test_dict_recv_ok)
+        stream.feed(b'[1, 2]')
+        self.assertRaises(IncorrectDataRecivedError, stream.next_frame)
+
+    # после согласования остаток буфера разбирается в новом формате, в том числе префикс длины,
+    # не являющийся корректным UTF-8
+    def test_stream_switch_framing(self):
+        framed = MessageStream(FRAMING_LENGTH)
+        stream = MessageStream()
+        # длина 202 байта, префикс 00 00 00 ca
+        long_message = {MESSAGE_TEXT: 'x' * 185}
+        stream.feed(json.dumps(self.test_dict_recv_ok).encode(ENCODING) + framed.encode(long_message) +
+                    framed.encode(self.test_dict_recv_err))
+        self.assertEqual(stream.decode(stream.next_frame()), self.test_dict_recv_ok)
+        stream.framing = FRAMING_LENGTH
+        self.assertEqual(stream.decode(stream.next_frame()), long_message)
+        self.assertEqual(stream.decode(stream.next_frame()), self.test_dict_recv_err)
+
+    # сообщение кодируется и декодируется каждым доступным кодеком
+    def test_codecs(self):
+        for name in CODECS:
+            stream = MessageStream(FRAMING_LENGTH, CODECS[name])
+            stream.feed(stream.encode(self.test_dict_send))
+            self.assertEqual(stream.decode(stream.next_frame()), self.test_dict_send)
+
+    # принятое сообщение пересылается без повторного кодирования, пока его не изменили
+    def test_raw_message_passthrough(self):
+        stream = MessageStream(FRAMING_LENGTH)
+        payload = json.dumps(self.test_dict_send, separators=(',', ':')).encode(ENCODING)
+        message = stream.decode(payload)
+        self.assertEqual(stream.encode(message)[FRAME_HEADER.size:], payload)
+        message[TIME] = 1.1
+        self.assertIsNone(message.payload)
+        self.assertEqual(json.loads(stream.encode(message)[FRAME_HEADER.size:]), message)
+
+    # согласование: старые клиенты без полей, неизвестные кодеки пропускаются
+    def test_negotiate_stream(self):
+        self.assertEqual(negotiate_stream(self.test_dict_send), {})
+        presence = dict(self.test_dict_send, **{FRAMING: FRAMING_LENGTH, CODECS_OFFER: ['unknown', CODEC_JSON]})
+        self.assertEqual(negotiate_stream(presence), {FRAMING: FRAMING_LENGTH, CODEC: CODEC_JSON})
+
+    # маршрут для пересылки: отправитель и получатель сообщения, остальные кадры разбираются полностью
+    def test_peek_route(self):
+        message = {ACTION: MESSAGE, SENDER: 'Guest', DESTINATION: 'Иван \\"1\\"', TIME: 1.1, MESSAGE_TEXT: ',"to":"x"'}
+        self.assertEqual(peek_json_route(json.dumps(message).encode(ENCODING)), ('Guest', 'Иван \\"1\\"'))
+        self.assertIsNone(peek_json_route(json.dumps(self.test_dict_send).encode(ENCODING)))
+        # маршрут берётся только из полей верхнего уровня
+        message[MESSAGE_TEXT] = {DESTINATION: 'x'}
+        self.assertEqual(peek_json_route(json.dumps(message).encode(ENCODING)), ('Guest', 'Иван \\"1\\"'))
+        self.assertIsNone(peek_json_route(
+            b'{"action":"message","to":"bob","time":1,"mess_text":"x","n":{"from":"alice"}}'))
+        self.assertIsNone(MessageStream(codec=CODECS[CODEC_JSON]).peek_route(b'{}'))
+        # кадр с маршрутом, но некорректным JSON, пересылать нельзя
+        message[MESSAGE_TEXT] = 'x'
+        payload = json.dumps(message).encode(ENCODING)
+        self.assertIsNone(peek_json_route(payload[:-1] + b' !!!'))
+        self.assertIsNone(peek_json_route(payload + payload))
+
+    # сжатие согласуется вместе с кодеком, сжатый кадр распаковывается в исходные данные
+    def test_compression(self):
+        presence = dict(self.test_dict_send, **{FRAMING: FRAMING_LENGTH, COMPRESSIONS_OFFER: ['unknown', 'zlib']})
+        self.assertEqual(negotiate_stream(presence), {FRAMING: FRAMING_LENGTH, COMPRESSION: 'zlib'})
+        for compression in COMPRESSIONS.values():
+            stream = MessageStream(FRAMING_LENGTH, DEFAULT_CODEC, compression)
+            message = {ACTION: MESSAGE, SENDER: 'Guest', DESTINATION: 'Friend', TIME: 1.1, MESSAGE_TEXT: 'x' * 500}
+            frame = stream.encode(message)
+            self.assertLess(len(frame), 200)
+            stream.feed(frame)
+            payload = stream.next_frame()
+            # маршрут читается из заголовка, данные не распаковываются
+            self.assertEqual(stream.peek_route(payload), ('Guest', 'Friend'))
+            decoded = stream.decode(payload)
+            self.assertEqual(decoded, message)
+            self.assertEqual(decoded.payload, DEFAULT_CODEC.dumps(message))
+            # короткие кадры не сжимаются
+            self.assertEqual(stream.encode({RESPONSE: 200})[FRAME_HEADER.size], 0)
+            self.assertRaises(IncorrectDataRecivedError, stream.decode, bytes((FRAME_COMPRESSED,)) + b'garbage')
+
+    # маршрут из заголовка кадра главнее отправителя в данных
+    def test_compression_route(self):
+        stream = MessageStream(FRAMING_LENGTH, DEFAULT_CODEC, COMPRESSIONS['zlib'])
+        message = {ACTION: MESSAGE, SENDER: 'Admin', DESTINATION: 'Friend', TIME: 1.1, MESSAGE_TEXT: 'hi'}
+        payload = pack_payload(DEFAULT_CODEC.dumps(message), stream.compression, CODEC_JSON, ('Guest', 'Friend'))
+        self.assertEqual(stream.decode(payload)[SENDER], 'Guest')
+
+    # метки мультиплексированного подключения: метка относится ко всем следующим кадрам, без согласования
+    # метка - ошибка
+    def test_multiplex_tags(self):
+        presence = dict(self.test_dict_send, **{FRAMING: FRAMING_LENGTH, MULTIPLEX: True})
+        self.assertEqual(negotiate_stream(presence), {FRAMING: FRAMING_LENGTH, MULTIPLEX: True})
+        stream = MessageStream(FRAMING_LENGTH)
+        stream.configure({FRAMING: FRAMING_LENGTH, MULTIPLEX: True})
+        data = (stream.encode(self.test_dict_recv_ok) + multiplex_tag('Иван') + stream.encode(self.test_dict_recv_err) +
+                stream.encode(self.test_dict_recv_ok) + multiplex_tag('Guest') + multiplex_tag('Friend'))
+        stream.feed(data[:-5])
+        self.assertEqual(stream.decode(stream.next_frame()), self.test_dict_recv_ok)
+        self.assertIsNone(stream.tag)
+        self.assertEqual(stream.decode(stream.next_frame()), self.test_dict_recv_err)
+        self.assertEqual(stream.tag, 'Иван')
+        self.assertEqual(stream.decode(stream.next_frame()), self.test_dict_recv_ok)
+        self.assertEqual(stream.tag, 'Иван')
+        self.assertIsNone(stream.next_frame())
+        stream.feed(data[-5:] + stream.encode(self.test_dict_send))
+        self.assertEqual(stream.decode(stream.next_frame()), self.test_dict_send)
+        self.assertEqual(stream.tag, 'Friend')
+        plain = MessageStream(FRAMING_LENGTH)
+        plain.feed(multiplex_tag('Guest'))
+        self.assertRaises(IncorrectDataRecivedError, plain.next_frame)
+
 
 if __name__ == '__main__':
     unittest.main()